@@ -6,7 +6,8 @@
 ## usage: FBNeo_dat_gen.py [-h] -dat DAT -path PATH [-output_file OUTPUT_FILE]
 ##                       [-header_name HEADER_NAME]
 ##                       [-header_description HEADER_DESCRIPTION]
-##                       [-header_version HEADER_VERSION]
+##                       [-header_version HEADER_VERSION] [-jobs JOBS]
+##                       [-cache CACHE] [-no_cache]
 ## 
 ## Generates Final Burn Neo .dat file needed for RetroArch/libretro-
 ## db/c_converter
@@ -23,6 +24,12 @@
 ##                         .dat
 ##   -header_version HEADER_VERSION
 ##                         Override the clrmamepro(version) in the output .dat
+##   -jobs JOBS            Number of files hashed in parallel; defaults to the
+##                         number of cores
+##   -cache CACHE          Hash cache file reused between runs; defaults to
+##                         ~/.cache/libretro-database/hashes.sqlite
+##   -no_cache             Hash every file without reading or updating the hash
+##                         cache
 ## 
 ## required arguments:
 ##   -dat DAT              Misc -> Generate dat file -> Generate dat (Arcade 
@@ -44,26 +51,37 @@
 #-   <http://creativecommons.org/publicdomain/zero/1.0/>.
 
 import argparse
-import hashlib
+import functools
 import operator
 import os
 import os.path
 import sys
-import xml.etree.ElementTree as ET
-import zlib
 
-def main():
-    parser = setup_argparse()
-    args = parser.parse_args()
+from concurrent.futures import ThreadPoolExecutor
+
+import hashcache
+from hashcache import hash_file
+
+def main(argv=None):
+    parser = setup_argparse(argv)
+    args = parser.parse_args(argv)
     dat_root = get_datroot(args.dat, parser)
     header_name = get_header_name(args)
     header_version = get_header_version(args, dat_root, parser)
     header_description = get_header_description(args, header_version)
     header = generate_dat_header(header_name, header_description, header_version)
-    game_list = generate_game_list(dat_root, args.path)
+    if args.no_cache:
+        game_list = generate_game_list(dat_root, args.path, args.jobs)
+    else:
+        with hashcache.HashCache(args.cache) as cache:
+            game_list = generate_game_list(dat_root, args.path, args.jobs, cache)
+            cache.prune(args.path)
+        # stdout may be carrying the dat itself
+        print(cache.summary(), file=sys.stderr)
     output(args, header, game_list)
+    return 0
 
-def setup_argparse():
+def setup_argparse(argv=None):
     """Set up the argparse arguments and return the argparse instance"""
     parser = argparse.ArgumentParser(prog='FBgen.py', description='Generates Final Burn Neo .dat file needed for RetroArch/libretro-db/c_converter')
     required_arguments = parser.add_argument_group('required arguments')
@@ -73,8 +91,11 @@ def setup_argparse():
     parser.add_argument('-header_name', help='Override the clrmamepro(name) in the output .dat')
     parser.add_argument('-header_description', help='Override the clrmamepro(description) in the output .dat')
     parser.add_argument('-header_version', help='Override the clrmamepro(version) in the output .dat')
+    parser.add_argument('-jobs', type=int, default=os.cpu_count() or 1, help='Number of files hashed in parallel; defaults to the number of cores')
+    parser.add_argument('-cache', default=hashcache.default_path(), help='Hash cache file reused between runs; defaults to %(default)s')
+    parser.add_argument('-no_cache', action='store_true', help='Hash every file without reading or updating the hash cache')
 
-    if len(sys.argv[1:])==0:
+    if len(sys.argv[1:] if argv is None else argv)==0:
         parser.print_help()
         print('\n'.join(['',
                          'example usage: python3 FBA_dat_gen.py -dat "FBNeo v0.2.97.42 (ClrMame Pro ', 
@@ -91,6 +112,8 @@ def get_datroot(dat, parser):
         parser.print_help()
         parser.exit()
     else:
+        # Only needed here, so importing the tool stays cheap
+        import xml.etree.ElementTree as ET
         dat_tree = ET.parse(dat)
         dat_root = dat_tree.getroot()
     return dat_root
@@ -134,15 +157,14 @@ def generate_dat_header(name, description, version):
               ')']
     return '\n'.join(header)
 
-def generate_game_list(dat_root, path):
+def generate_game_list(dat_root, path, jobs=None, cache=None):
     """Generate the sorted list of games with all metadata and return a textual dat list"""
     game_list = []
     
     if not os.path.isdir(path):
         print('Path not found: ' + path)
         print('')
-        parser.print_help()
-        parser.exit()
+        raise SystemExit()
     else:
         game_entries = []
         for game in dat_root.iter('game'):
@@ -161,20 +183,20 @@ def generate_game_list(dat_root, path):
                         entry.publisher = game.find('manufacturer').text
                         # set zip filename
                         entry.zip = game.get('name') + '.zip'
-                        zip_path = os.path.join(path, entry.zip)
-                        # set zip size
-                        entry.size = os.path.getsize(zip_path)
-                        # set zip crc
-                        entry.crc = get_crc(zip_path)
-                        # set zip md5
-                        entry.md5 = get_md5(zip_path)
-                        # set zip sha1
-                        entry.sha1 = get_sha1(zip_path)
                         # Add to game_entries list
                         game_entries.append(entry)
 
-            # Sort game_entries list
-            game_entries.sort(key=operator.attrgetter('name'))
+        # Hash every zip once, reading each file a single time. The digests
+        # release the GIL on large buffers, so threads scale with the disk.
+        # Unchanged files are served from the hash cache without reading them.
+        zip_paths = [os.path.join(path, entry.zip) for entry in game_entries]
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            results = executor.map(functools.partial(get_hashes, cache=cache), zip_paths)
+            for entry, hashes in zip(game_entries, results):
+                entry.size, entry.crc, entry.md5, entry.sha1 = hashes
+
+        # Sort game_entries list
+        game_entries.sort(key=operator.attrgetter('name'))
         
         # Generate formatted textual list
         for entry in game_entries:
@@ -208,28 +230,23 @@ class GameEntry:
     md5 = None
     sha1 = None
     
-def get_crc(file):
+def get_hashes(file, cache=None):
+    """Return the size, CRC32, MD5 and SHA1 of <file>, from <cache> if it has them"""
+    if cache is not None:
+        return cache.get(file, hash_file)
+    return hash_file(file)
+
+def get_crc(file, cache=None):
     """Return the CRC32 hash of <file>"""
-    prev = 0
-    for eachLine in open(file, 'rb'):
-        prev = zlib.crc32(eachLine, prev)
-    return str("%X"%(prev & 0xFFFFFFFF)).zfill(8)
+    return get_hashes(file, cache)[1]
 
-def get_md5(file):
+def get_md5(file, cache=None):
     """Return the MD5 hash of <file>"""
-    m = hashlib.md5()
-    with open(file, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            m.update(chunk)
-    return m.hexdigest().zfill(32)
+    return get_hashes(file, cache)[2]
 
-def get_sha1(file):
+def get_sha1(file, cache=None):
     """Return the SHA1 hash of <file>"""
-    m = hashlib.sha1()
-    with open(file, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            m.update(chunk)
-    return m.hexdigest().zfill(40)
+    return get_hashes(file, cache)[3]
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the DAT and cheat tools, run on synthetic inputs.
+#
+#     benchmark.py [--games N] [--machines N] [--cht-files N] [--zips N]
+#                  [--site-games N] [--workdir DIR] [--output FILE] [--baseline FILE] [BENCHMARK...]
+#
+# Fixtures are generated from a fixed seed, so every run sees the same data:
+#   a ClrMamePro DAT of --games games in random order (10k by default; the
+#     real DATs range up to about 500k),
+#   a MAME -listxml of --machines machines, some sharing ROM CRCs,
+#   --cht-files GBA .cht files whose cheats are encrypted behind a `9` master
+#     code, and
+#   an FBNeo XML DAT with a directory of --zips small zip files, and
+#   a scraperfixture.py site with --site-games games per code type, crawled
+#     by scraper.py over HTTP on localhost (needs requests and lxml).
+#
+# Every benchmark runs in a fresh worker process, so the peak RSS reported
+# for it is its own. The results (seconds, items and bytes per second, peak
+# RSS in KiB) are printed as JSON; with --baseline, a benchmark that became
+# more than --tolerance slower than in a previous result file fails the run.
+#
+# The tools are imported as modules, including the ones whose file names
+# are not valid module names.
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr
+from typing import Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from tools import load_script
+
+REGIONS = ('USA', 'Europe', 'Japan', 'World', 'France', 'Germany')
+WORDS = ('Super', 'Mega', 'Dragon', 'Quest', 'Fighter', 'Racing', 'Star', 'Legend', 'Space',
+         'Ninja', 'Soccer', 'Puzzle', 'Tennis', 'Castle', 'Shadow', 'Battle', 'World', 'Hero')
+
+Result = Dict[str, object]
+
+
+def _title(rng: random.Random, i: int) -> str:
+    return '%s %s %d (%s)' % (rng.choice(WORDS), rng.choice(WORDS), i, rng.choice(REGIONS))
+
+
+def _hex(rng: random.Random, digits: int) -> str:
+    return '%0*X' % (digits, rng.getrandbits(digits * 4))
+
+
+def make_dat(path: str, games: int, seed: int = 1) -> None:
+    rng = random.Random(seed)
+    order = list(range(games))
+    rng.shuffle(order)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('clrmamepro (\n\tname "Synthetic"\n\tdescription "Synthetic"\n)\n\n')
+        for i in order:
+            title = _title(rng, i)
+            f.write('game (\n\tname "%s"\n\tdescription "%s"\n\tserial "SYN-%05d"\n'
+                    '\trom ( name "%s.bin" size %d crc %s md5 %s sha1 %s )\n)\n\n' % (
+                        title, title, i, title, rng.randrange(1 << 12, 1 << 22),
+                        _hex(rng, 8), _hex(rng, 32), _hex(rng, 40)))
+
+
+def make_listxml(path: str, machines: int, seed: int = 2) -> None:
+    rng = random.Random(seed)
+    shared = [_hex(rng, 8).lower() for _ in range(max(1, machines // 20))]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0"?>\n<mame build="0.250 (mame0250)" debug="no" mameconfig="10">\n')
+        for i in range(machines):
+            f.write('\t<machine name="m%05d" sourcefile="synthetic.cpp">\n' % i)
+            f.write('\t\t<description>%s</description>\n' % _title(rng, i))
+            f.write('\t\t<year>19%02d</year>\n\t\t<manufacturer>%s</manufacturer>\n' % (
+                rng.randrange(78, 100), rng.choice(WORDS)))
+            for r in range(rng.randrange(2, 12)):
+                crc = rng.choice(shared) if rng.random() < 0.2 else _hex(rng, 8).lower()
+                f.write('\t\t<rom name="m%05d.%d" size="%d" crc="%s" sha1="%s" region="maincpu"/>\n' % (
+                    i, r, 1 << rng.randrange(12, 20), crc, _hex(rng, 40).lower()))
+            if rng.random() < 0.9:
+                f.write('\t\t<input players="2" coins="1">\n\t\t\t<control type="joy" ways="8"/>\n\t\t</input>\n')
+            else:
+                f.write('\t\t<input players="1">\n\t\t\t<control type="keyboard"/>\n\t\t</input>\n')
+            f.write('\t</machine>\n')
+        f.write('</mame>\n')
+
+
+def make_gba_cheats(directory: str, files: int, seed: int = 3) -> None:
+    chtfile = load_script('chtfile.py')
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(files):
+        cheats = [('Master Code', '9' + _hex(rng, 11) + '+' + _hex(rng, 12))]
+        for n in range(rng.randrange(5, 40)):
+            codes = [_hex(rng, 12) for _ in range(rng.randrange(1, 5))]
+            cheats.append(('Cheat %d' % n, '+'.join(codes)))
+        with open(os.path.join(directory, 'Game %05d (USA).cht' % i), 'wb') as f:
+            chtfile.write_cheats(f, cheats)
+
+
+def make_fbneo(dat: str, directory: str, zips: int, seed: int = 4) -> None:
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    with open(dat, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0"?>\n<datafile>\n\t<header>\n\t\t<name>FBNeo</name>\n'
+                '\t\t<version>1.0.0.0</version>\n\t</header>\n')
+        for i in range(zips):
+            name = 'g%05d' % i
+            f.write('\t<game name="%s">\n\t\t<description>%s</description>\n\t\t<year>19%02d</year>\n'
+                    '\t\t<manufacturer>%s</manufacturer>\n\t</game>\n' % (
+                        name, _title(rng, i), rng.randrange(78, 100), rng.choice(WORDS)))
+            with zipfile.ZipFile(os.path.join(directory, name + '.zip'), 'w') as z:
+                for r in range(rng.randrange(1, 4)):
+                    z.writestr('%s.%d' % (name, r), rng.randbytes(rng.randrange(1 << 10, 1 << 16)))
+        f.write('</datafile>\n')
+
+
+def _result(name: str, seconds: float, items: int, unit: str, size: int = 0) -> Result:
+    result: Result = {'name': name, 'seconds': round(seconds, 4), 'items': items, 'unit': unit,
+                      'items_per_second': round(items / max(seconds, 1e-9), 1)}
+    if size:
+        result['bytes'] = size
+        result['mb_per_second'] = round(size / 1e6 / max(seconds, 1e-9), 2)
+    return result
+
+
+def bench_sortdat(fixtures: Dict[str, str]) -> List[Result]:
+    sorter = load_script('clrmamepro-sorter.py')
+    with open(fixtures['dat'], encoding='utf-8') as f:
+        text = f.read()
+    games = text.count('\ngame (')
+    results = []
+    for key in ('text', 'crc'):
+        began = time.perf_counter()
+        sorter.sortdat(text, key)
+        results.append(_result('sortdat.' + key, time.perf_counter() - began, games, 'games', len(text.encode())))
+    return results
+
+
+def bench_fbneo(fixtures: Dict[str, str]) -> List[Result]:
+    fbneo = load_script('FBNeo_dat_gen.py')
+    import xml.etree.ElementTree as ET
+    began = time.perf_counter()
+    root = ET.parse(fixtures['fbneo_dat']).getroot()
+    listing = fbneo.generate_game_list(root, fixtures['zips'], jobs=os.cpu_count() or 1)
+    seconds = time.perf_counter() - began
+    size = sum(entry.stat().st_size for entry in os.scandir(fixtures['zips']))
+    return [_result('fbneo.generate_game_list', seconds, listing.count('game ('), 'zips', size)]
+
+
+def bench_mame_member(fixtures: Dict[str, str]) -> List[Result]:
+    member = load_script('mame-member.py')
+    size = os.path.getsize(fixtures['listxml'])
+    with redirect_stderr(io.StringIO()):
+        began = time.perf_counter()
+        head, info = member.stream(fixtures['listxml'])
+        parsed = time.perf_counter()
+        unique = member.crcmap(info)
+        mapped = time.perf_counter()
+        member.emit(head, unique, io.StringIO())
+        emitted = time.perf_counter()
+    return [_result('mame-member.stream', parsed - began, len(info), 'machines', size),
+            _result('mame-member.crcmap', mapped - parsed, len(info), 'machines'),
+            _result('mame-member.emit', emitted - mapped, len(unique), 'games')]
+
+
+def bench_gba_decrypt(fixtures: Dict[str, str]) -> List[Result]:
+    decrypt = load_script('gba-cht-decrypt.py')
+    chtfile = load_script('chtfile.py')
+    paths = sorted(os.path.join(fixtures['cht'], name) for name in os.listdir(fixtures['cht']))
+    began = time.perf_counter()
+    size = 0
+    for path in paths:
+        cht = chtfile.ChtFile.load(path)
+        size += len(cht.raw)
+        output, encrypted, bad = decrypt.decrypt_cht(cht)
+        if bad or not encrypted:
+            raise RuntimeError('%s did not decrypt' % path)
+    return [_result('gba-cht-decrypt', time.perf_counter() - began, len(paths), 'files', size)]
+
+
+def bench_scraper(fixtures: Dict[str, str]) -> List[Result]:
+    try:
+        import lxml, requests
+    except ImportError as e:
+        print('scraper: skipped, %s' % e, file=sys.stderr)
+        return []
+    scraper = load_script('scraper.py')
+    scraperfixture = load_script('scraperfixture.py')
+    site = scraperfixture.Site(games=int(fixtures['site_games']))
+    server = scraperfixture.serve(site)
+    try:
+        began = time.perf_counter()
+        counts = scraper.scrape(server.url, outdir=fixtures['scraped'], jobs=os.cpu_count() or 1)
+        seconds = time.perf_counter() - began
+    finally:
+        server.shutdown()
+    if counts['failed'] or counts['fetched'] != site.pages:
+        raise RuntimeError('scraped %d of %d pages, %d failed' % (counts['fetched'], site.pages, counts['failed']))
+    return [_result('scraper', seconds, counts['fetched'], 'pages')]
+
+
+BENCHMARKS: Dict[str, Callable[[Dict[str, str]], List[Result]]] = {
+    'sortdat': bench_sortdat,
+    'fbneo': bench_fbneo,
+    'mame-member': bench_mame_member,
+    'scraper': bench_scraper,
+    'gba-cht-decrypt': bench_gba_decrypt,
+}
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident set size of this process in KiB"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def _run(job) -> List[Result]:
+    name, fixtures = job
+    results = BENCHMARKS[name](fixtures)
+    rss = peak_rss()
+    for result in results:
+        result['benchmark'] = name
+        result['peak_rss_kb'] = rss
+    return results
+
+
+def make_fixtures(workdir: str, args: argparse.Namespace) -> Dict[str, str]:
+    fixtures = {
+        'dat': os.path.join(workdir, 'synthetic.dat'),
+        'listxml': os.path.join(workdir, 'listxml.xml'),
+        'cht': os.path.join(workdir, 'cht'),
+        'fbneo_dat': os.path.join(workdir, 'fbneo.xml'),
+        'zips': os.path.join(workdir, 'zips'),
+        'scraped': os.path.join(workdir, 'scraped'),
+        'site_games': str(args.site_games),
+    }
+    make_dat(fixtures['dat'], args.games)
+    make_listxml(fixtures['listxml'], args.machines)
+    make_gba_cheats(fixtures['cht'], args.cht_files)
+    make_fbneo(fixtures['fbneo_dat'], fixtures['zips'], args.zips)
+    return fixtures
+
+
+def compare(results: List[Result], baseline: List[Result], tolerance: float) -> List[str]:
+    """Return a line for every result more than <tolerance> slower than in <baseline>"""
+    before = {result['name']: result for result in baseline}
+    slower = []
+    for result in results:
+        old = before.get(result['name'])
+        if old is None or old['items'] != result['items']:
+            continue
+        if result['seconds'] > old['seconds'] * (1 + tolerance):
+            slower.append('%s: %.3fs, was %.3fs' % (result['name'], result['seconds'], old['seconds']))
+    return slower
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the DAT and cheat tools on synthetic inputs')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run: %s (default: all)' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--games', type=int, default=10000, help='games in the synthetic DAT (default: %(default)s)')
+    parser.add_argument('--machines', type=int, default=5000, help='machines in the listxml (default: %(default)s)')
+    parser.add_argument('--cht-files', type=int, default=2000, help='GBA .cht files (default: %(default)s)')
+    parser.add_argument('--zips', type=int, default=1000, help='zip files for FBNeo (default: %(default)s)')
+    parser.add_argument('--site-games', type=int, default=20,
+                        help='games per code type of the scraped site (default: %(default)s)')
+    parser.add_argument('--workdir', help='keep the fixtures in this directory instead of a temporary one')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown relative to the baseline that fails the run (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmark: %s' % ', '.join(unknown))
+    names = args.benchmarks or sorted(BENCHMARKS)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='libretro-database-bench-')
+    try:
+        began = time.perf_counter()
+        fixtures = make_fixtures(workdir, args)
+        print('fixtures generated in %.2fs' % (time.perf_counter() - began), file=sys.stderr)
+        results: List[Result] = []
+        for name in names:
+            # A fresh process per benchmark keeps the peak RSS figures apart
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                for result in executor.submit(_run, (name, fixtures)).result():
+                    print('%-26s %9.3fs %12.1f %s/s' % (
+                        result['name'], result['seconds'], result['items_per_second'], result['unit']), file=sys.stderr)
+                    results.append(result)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {'games': args.games, 'machines': args.machines, 'cht_files': args.cht_files, 'zips': args.zips,
+                       'site_games': args.site_games},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f)['results'], args.tolerance)
+        for line in slower:
+            print('slower: ' + line, file=sys.stderr)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,67 +1,144 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # public domain by @bparker06
 # https://github.com/libretro/libretro-database/issues/388
 # https://raw.githubusercontent.com/mupen64plus/mupen64plus-core/master/data/mupencheat.txt
-import re, os
+#
+# usage: cht64write.py [mupencheat.txt] [--output DIR] [--jobs N]
+#
+# The cheat database is read line by line and one game is held in memory at
+# a time. Games without cheats get no file. Two games whose file names only
+# differ in case or in characters dropped by slugify() keep the name in the
+# order they appear in the database, the later ones get " (2)", " (3)", ...
+# Files are written by a pool of threads, atomically, and only when their
+# content changed, so running it again on the same database touches nothing.
+import argparse, collections, os, re, sys, tempfile, unicodedata
+from concurrent.futures import ThreadPoolExecutor
 
-cheatfile = ''
-cheats = ''
-game = ''
-gamefile = None
-gamefilename = ''
-cheatnum = -1
-subcheatnum = 0
+import chtfile
+
+Game = collections.namedtuple('Game', 'name crc cheats')
 
 def slugify(value):
-    # ripped off from Django and modified
-    import unicodedata
-    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
-    value = unicode(re.sub('[^\w\s\-\.\(\)]', '', value).strip())
-
-    return value
-
-with open('mupencheat.txt', 'rb') as f:
-  cheatfile = f.read()
-
-for line in cheatfile.split('\n'):
-  if line.startswith('gn '):
-    if gamefile is not None:
-      if cheatnum >= 0:
-        gamefile.write('cheats = ' + str(cheatnum + 1) + '\n')
-        gamefile.write(cheats + '\"\n')
-
-      gamefile.close()
-      gamefile = None
-      subcheatnum = 0
-      cheats = ''
-
-      if cheatnum < 0:
-        os.unlink(gamefilename)
-
-      cheatnum = -1
-
-    game = line.split('gn ')[1]
-    game = re.sub(r'^[\s*|=]', '', game)
-    gamefilename = 'cheats/' + str(slugify(unicode(game))) + '.cht'
-    gamefile = open(gamefilename, 'wb')
-  elif line.startswith(' cn '):
-    name = line.split(' cn ')[1]
-    cheatnum += 1
-
-    if subcheatnum > 0:
-      cheats += '\"\n'
-      subcheatnum = 0
-
-    cheats += 'cheat' + str(cheatnum) + '_desc = \"' + name + '\"\n'
-    cheats += 'cheat' + str(cheatnum) + '_enable = false\n'
-  elif line.startswith('  ') and not line.startswith('  cd '):
-    cheat = line.split('  ')[1]
-    cheat = re.sub(r'(\?\?\?\?).*', '\\1', cheat)
-    cheat = re.sub(r'\?\?\?\?', 'XXXX', cheat)
-
-    if subcheatnum == 0:
-      cheats += 'cheat' + str(cheatnum) + '_code = \"' + cheat
-    else:
-      cheats += ';' + cheat
-
-    subcheatnum += 1
+  # ripped off from Django and modified
+  value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
+  value = re.sub(r'[^\w\s\-\.\(\)]', '', value).strip()
+
+  return value
+
+def parse(lines):
+  """Yield a Game for every `gn` entry of the mupencheat.txt <lines>
+
+  The cheats of a game are (description, [code, ...]) pairs; `????` values
+  of codes with options become XXXX and the options are dropped.
+  """
+  crc = None
+  game = None
+  for line in lines:
+    line = line.rstrip('\r\n')
+    if line.startswith('crc '):
+      crc = line[4:].strip()
+    elif line.startswith('gn '):
+      if game is not None:
+        yield game
+      game = Game(re.sub(r'^[\s*|=]', '', line[3:]), crc, [])
+      crc = None
+    elif game is None:
+      continue
+    elif line.startswith(' cn '):
+      game.cheats.append((line[4:], []))
+    elif line.startswith('  ') and not line.startswith('  cd ') and game.cheats:
+      cheat = line.split('  ')[1]
+      cheat = re.sub(r'(\?\?\?\?).*', '\\1', cheat)
+      cheat = re.sub(r'\?\?\?\?', 'XXXX', cheat)
+      game.cheats[-1][1].append(cheat)
+  if game is not None:
+    yield game
+
+def render(game):
+  """Return the .cht file of <game>"""
+  out = [chtfile.format_entry('cheats', str(len(game.cheats)), quote=False)]
+  for i, (desc, codes) in enumerate(game.cheats):
+    out.append(chtfile.format_entry('cheat%d_desc' % i, desc))
+    out.append(chtfile.format_entry('cheat%d_enable' % i, 'false', quote=False))
+    # A cheat without codes is still listed, just without a code line
+    if codes:
+      out.append(chtfile.format_entry('cheat%d_code' % i, ';'.join(codes)))
+  return b''.join(out)
+
+class Names:
+  """Hand out file names, the same for the same sequence of games"""
+
+  def __init__(self):
+    self.taken = set()
+
+  def name(self, game):
+    base = slugify(game.name) or slugify(game.crc or '') or 'Unknown'
+    name = base
+    n = 1
+    # Compare case-insensitively, the output may live on such a file system
+    while name.lower() in self.taken:
+      n += 1
+      name = '%s (%d)' % (base, n)
+    self.taken.add(name.lower())
+    return name + '.cht'
+
+def write_if_changed(path, data):
+  """Atomically write <data> to <path> unless it already holds it; returns whether it wrote"""
+  try:
+    with open(path, 'rb') as f:
+      if f.read() == data:
+        return False
+  except FileNotFoundError:
+    pass
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+  except BaseException:
+    os.unlink(tmp)
+    raise
+  return True
+
+def convert(lines, outdir, jobs=None):
+  """Write a .cht file to <outdir> for every game of <lines> that has cheats
+
+  Returns a Counter of written, unchanged and empty games.
+  """
+  os.makedirs(outdir, exist_ok=True)
+  counts = collections.Counter()
+  names = Names()
+  jobs = jobs or os.cpu_count() or 1
+  pending = collections.deque()
+  with ThreadPoolExecutor(max_workers=jobs) as executor:
+    for game in parse(lines):
+      if not game.cheats:
+        counts['empty'] += 1
+        continue
+      path = os.path.join(outdir, names.name(game))
+      pending.append(executor.submit(write_if_changed, path, render(game)))
+      # Keep only a few games per thread in memory
+      while len(pending) > jobs * 4:
+        counts['written' if pending.popleft().result() else 'unchanged'] += 1
+    while pending:
+      counts['written' if pending.popleft().result() else 'unchanged'] += 1
+  return counts
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Convert mupen64plus cheats to .cht files')
+  parser.add_argument('source', nargs='?', default='mupencheat.txt', help='mupencheat.txt to convert')
+  parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cht', 'Nintendo - Nintendo 64'),
+                      help='directory to write the .cht files to (default: cht/Nintendo - Nintendo 64)')
+  parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                      help='number of writer threads (default: all cores)')
+  args = parser.parse_args(argv)
+
+  with open(args.source, 'r', encoding='utf-8', errors='surrogateescape', newline='') as f:
+    counts = convert(f, args.output, args.jobs)
+  print('%d files written, %d unchanged, %d games without cheats' % (
+    counts['written'], counts['unchanged'], counts['empty']), file=sys.stderr)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+# Reader and writer for RetroArch .cht cheat files, shared by the cheat tools.
+#
+# A .cht file is a list of `key = value` lines:
+#
+#     cheats = 2
+#
+#     cheat0_desc = "Infinite Lives"
+#     cheat0_code = "1f0142:09"
+#     cheat0_enable = false
+#
+# Values are bare words or double quoted strings. A quoted value that is not
+# closed on its own line continues on the following lines (several
+# PlayStation and N64 descriptions are written that way), unless another
+# `key =` line comes first, in which case it simply runs to the end of the
+# line. Lines that are not assignments are kept as they are.
+#
+# ChtFile only records the byte offsets of every assignment in a handful of
+# arrays; keys and values are decoded when they are first asked for, and
+# writing a file copies every untouched line verbatim, so loading and saving
+# a file reproduces it byte for byte.
+#
+#     cht = ChtFile.load(path)
+#     for cheat in cht.cheats():
+#         print(cheat.desc, cheat.code, cheat.enable)
+#
+#     with open(path, 'wb') as f:
+#         writer = ChtWriter(f, len(cheats))
+#         for desc, code in cheats:
+#             writer.add(desc, code)
+#
+# Running the module directly loads every .cht file below the given paths
+# and checks that it parses like the plain line reader read_lines(), that
+# it round-trips byte for byte and that changed values read back.
+
+import os
+import re
+import sys
+import time
+
+from array import array
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+
+# One assignment line: key, then either a quoted value (with the closing
+# quote, if any, in its own group) or a bare value without trailing blanks.
+# A carriage return is only a line ending when nothing but blanks follow it.
+ENTRY = re.compile(rb'^[ \t]*([^\s="]+)[ \t]*=[ \t]*(?:"([^"\r\n]*(?:\r(?![ \t\r]*$)[^"\r\n]*)*)'
+                   rb'(?:(")[^\n]*?)?|([^\r\n]*?(?:\r(?![ \t\r]*$)[^\r\n]*?)*))[ \t\r]*$', re.M)
+
+# Any line that starts like an assignment; it ends a multi-line value.
+ASSIGNMENT = re.compile(rb'^[ \t]*[^\s="]+[ \t]*=', re.M)
+
+CHEAT_KEY = re.compile(r'cheat(\d+)_(\w+)$')
+
+
+def _decode(raw: bytes) -> str:
+    return raw.decode('utf-8', 'surrogateescape')
+
+
+def _encode(text: str) -> bytes:
+    return text.encode('utf-8', 'surrogateescape')
+
+
+class Cheat:
+    """A lazy view of the `cheatN_*` fields of one cheat in a ChtFile"""
+    __slots__ = ('file', 'index')
+
+    def __init__(self, file: 'ChtFile', index: int):
+        self.file = file
+        self.index = index
+
+    def __repr__(self) -> str:
+        return '<Cheat %d %r>' % (self.index, self.desc)
+
+    def get(self, field: str, default=None) -> Optional[str]:
+        return self.file.get('cheat%d_%s' % (self.index, field), default)
+
+    def __getitem__(self, field: str) -> str:
+        return self.file['cheat%d_%s' % (self.index, field)]
+
+    def __setitem__(self, field: str, value: str) -> None:
+        self.file['cheat%d_%s' % (self.index, field)] = value
+
+    @property
+    def desc(self) -> Optional[str]:
+        return self.get('desc')
+
+    @property
+    def code(self) -> Optional[str]:
+        return self.get('code')
+
+    @property
+    def enable(self) -> bool:
+        return (self.get('enable') or '').lower() == 'true'
+
+    def fields(self) -> Dict[str, str]:
+        """Return every field of this cheat, without the `cheatN_` prefix"""
+        prefix = 'cheat%d_' % self.index
+        return {key[len(prefix):]: self.file[key] for key in self.file.keys() if key.startswith(prefix)}
+
+
+class ChtFile:
+    """The assignments of a .cht file as offsets into its original bytes
+
+    For every assignment the arrays hold the start of its line, the key span,
+    the value span and the end of its line (before the newline). `quoted`
+    tells whether the value was quoted. Changed values are kept aside in
+    `_changes` and new keys are appended on write.
+    """
+    __slots__ = ('raw', 'line_starts', 'key_starts', 'key_ends', 'value_starts', 'value_ends',
+                 'line_ends', 'quoted', '_index', '_changes', '_added')
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self.line_starts = array('I')
+        self.key_starts = array('I')
+        self.key_ends = array('I')
+        self.value_starts = array('I')
+        self.value_ends = array('I')
+        self.line_ends = array('I')
+        self.quoted = bytearray()
+        self._index: Optional[Dict[str, int]] = None
+        self._changes: Dict[int, str] = {}
+        self._added: Dict[str, str] = {}
+        self._scan()
+
+    @classmethod
+    def load(cls, path: str) -> 'ChtFile':
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    def _scan(self) -> None:
+        raw = self.raw
+        search = ENTRY.search
+        assignment = ASSIGNMENT.search
+        pos = 0
+        while True:
+            m = search(raw, pos)
+            if m is None:
+                break
+            line_end = m.end()
+            if m.start(2) >= 0:
+                value_start, value_end = m.span(2)
+                if m.start(3) < 0:
+                    # Unterminated quote: look for the closing quote on the
+                    # following lines, as long as no other assignment starts
+                    close = raw.find(b'"', line_end)
+                    if close >= 0 and assignment(raw, line_end, close) is None:
+                        value_end = close
+                        line_end = raw.find(b'\n', close)
+                        if line_end < 0:
+                            line_end = len(raw)
+                        elif raw[line_end - 1:line_end] == b'\r':
+                            line_end -= 1
+                self.quoted.append(1)
+            else:
+                value_start, value_end = m.span(4)
+                self.quoted.append(0)
+            self.line_starts.append(m.start())
+            self.key_starts.append(m.start(1))
+            self.key_ends.append(m.end(1))
+            self.value_starts.append(value_start)
+            self.value_ends.append(value_end)
+            self.line_ends.append(line_end)
+            pos = line_end + 1 if line_end < len(raw) else line_end
+            if pos >= len(raw):
+                break
+
+    def __len__(self) -> int:
+        """Number of assignments in the file"""
+        return len(self.key_starts)
+
+    def key(self, i: int) -> str:
+        return _decode(self.raw[self.key_starts[i]:self.key_ends[i]])
+
+    def value(self, i: int) -> str:
+        if i in self._changes:
+            return self._changes[i]
+        return _decode(self.raw[self.value_starts[i]:self.value_ends[i]])
+
+    @property
+    def index(self) -> Dict[str, int]:
+        """Map every key to its first assignment"""
+        if self._index is None:
+            index: Dict[str, int] = {}
+            for i in range(len(self) - 1, -1, -1):
+                index[self.key(i)] = i
+            self._index = index
+        return self._index
+
+    def keys(self) -> List[str]:
+        return list(self.index) + list(self._added)
+
+    def get(self, key: str, default=None) -> Optional[str]:
+        i = self.index.get(key)
+        if i is None:
+            return self._added.get(key, default)
+        return self.value(i)
+
+    def __getitem__(self, key: str) -> str:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index or key in self._added
+
+    def __setitem__(self, key: str, value: str) -> None:
+        i = self.index.get(key)
+        if i is None:
+            self._added[key] = value
+        else:
+            self._changes[i] = value
+
+    @property
+    def count(self) -> int:
+        """The declared number of cheats, 0 if missing or not a number"""
+        try:
+            return int(self.get('cheats', '0'))
+        except ValueError:
+            return 0
+
+    def cheat(self, index: int) -> Cheat:
+        return Cheat(self, index)
+
+    def cheats(self) -> Iterator[Cheat]:
+        """Yield a view of every declared cheat"""
+        for i in range(self.count):
+            yield Cheat(self, i)
+
+    def cheat_indices(self) -> List[int]:
+        """Return the sorted indices of every `cheatN_*` key present"""
+        found = set()
+        for key in self.keys():
+            m = CHEAT_KEY.match(key)
+            if m:
+                found.add(int(m.group(1)))
+        return sorted(found)
+
+    def chunks(self) -> Iterator[bytes]:
+        """Yield the pieces of the file, with changed values substituted"""
+        raw = self.raw
+        pos = 0
+        for i, value in sorted(self._changes.items()):
+            start, end = self.value_starts[i], self.value_ends[i]
+            yield raw[pos:start]
+            yield _encode(value)
+            pos = end
+        yield raw[pos:]
+        if self._added:
+            if raw and not raw.endswith(b'\n'):
+                yield b'\n'
+            for key, value in self._added.items():
+                yield format_entry(key, value)
+
+    def dumps(self) -> bytes:
+        return b''.join(self.chunks())
+
+    def write(self, f: BinaryIO) -> None:
+        for chunk in self.chunks():
+            f.write(chunk)
+
+
+def format_entry(key: str, value: str, quote: bool = True) -> bytes:
+    """Format one assignment line the way RetroArch writes it"""
+    if quote:
+        return _encode('%s = "%s"\n' % (key, value))
+    return _encode('%s = %s\n' % (key, value))
+
+
+class ChtWriter:
+    """Stream a new .cht file cheat by cheat
+
+    The header needs the number of cheats up front; every cheat is written
+    as soon as it is added, so large files are never held in memory.
+    """
+
+    def __init__(self, f: BinaryIO, count: int):
+        self.f = f
+        self.count = count
+        self.written = 0
+        f.write(format_entry('cheats', str(count), quote=False))
+        f.write(b'\n')
+
+    def add(self, desc: str, code: str, enable: bool = False, **fields: str) -> None:
+        """Write the next cheat; extra fields follow the enable line"""
+        if self.written >= self.count:
+            raise ValueError('more than %d cheats written' % self.count)
+        i = self.written
+        write = self.f.write
+        write(format_entry('cheat%d_desc' % i, desc))
+        write(format_entry('cheat%d_code' % i, code))
+        write(format_entry('cheat%d_enable' % i, 'true' if enable else 'false', quote=False))
+        for field, value in fields.items():
+            write(format_entry('cheat%d_%s' % (i, field), value))
+        write(b'\n')
+        self.written += 1
+
+
+def write_cheats(f: BinaryIO, cheats: List[Tuple[str, str]]) -> None:
+    """Write a whole .cht file from a list of (desc, code) pairs"""
+    writer = ChtWriter(f, len(cheats))
+    for desc, code in cheats:
+        writer.add(desc, code)
+
+
+def find_files(paths: List[str]) -> Iterator[str]:
+    """Yield the given files and every .cht file below the given directories"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith('.cht'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def _is_assignment(line: bytes) -> bool:
+    key, eq, _ = line.partition(b'=')
+    key = key.lstrip(b' \t').rstrip(b' \t')
+    return bool(eq) and bool(key) and b'"' not in key and not any(c in b' \t\n\r\f\v' for c in key)
+
+
+def read_lines(raw: bytes) -> List[Tuple[str, str]]:
+    """Return the (key, value) pairs of a .cht file, reading it line by line
+
+    A plain reader, independent of the offsets ChtFile scans for, that the
+    module checks ChtFile against.
+    """
+    entries = []
+    lines = raw.split(b'\n')
+    n = 0
+    while n < len(lines):
+        line = lines[n]
+        n += 1
+        if not _is_assignment(line):
+            continue
+        key, _, value = line.partition(b'=')
+        value = value.lstrip(b' \t')
+        if value.startswith(b'"'):
+            value = value[1:]
+            if b'"' in value:
+                value = value[:value.index(b'"')]
+            else:
+                value = value.rstrip(b'\r')
+                # An unterminated quote runs on to the line holding the
+                # closing quote, unless another assignment comes first
+                for m in range(n, len(lines)):
+                    quote = lines[m].find(b'"')
+                    if _is_assignment(lines[m] if quote < 0 else lines[m][:quote]):
+                        break
+                    if quote >= 0:
+                        value = b'\n'.join([line[line.index(b'"') + 1:]] + lines[n:m] + [lines[m][:quote]])
+                        n = m + 1
+                        break
+        else:
+            value = value.rstrip(b' \t\r')
+        entries.append((_decode(key.strip(b' \t')), _decode(value)))
+    return entries
+
+
+def main(argv=None) -> int:
+    files = 0
+    entries = 0
+    size = 0
+    failed = 0
+    began = time.perf_counter()
+    for path in find_files(sys.argv[1:] if argv is None else argv):
+        cht = ChtFile.load(path)
+        parsed = [(cht.key(i), cht.value(i)) for i in range(len(cht))]
+        if parsed != read_lines(cht.raw):
+            print('%s: parses differently line by line' % path, file=sys.stderr)
+            failed += 1
+        elif cht.dumps() != cht.raw:
+            print('%s: does not round-trip' % path, file=sys.stderr)
+            failed += 1
+        else:
+            # Change every value to exercise the writer, then read the result back
+            expected = dict(parsed)
+            for n, key in enumerate(cht.index):
+                cht[key] = expected[key] = 'v%d' % n
+            changed = ChtFile(cht.dumps())
+            if any(changed.get(key) != value for key, value in expected.items()):
+                print('%s: changed values do not read back' % path, file=sys.stderr)
+                failed += 1
+        files += 1
+        entries += len(cht)
+        size += len(cht.raw)
+    elapsed = time.perf_counter() - began
+    print('%d files, %d entries, %.1f MB in %.2fs, %d failed' % (
+        files, entries, size / 1e6, elapsed, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
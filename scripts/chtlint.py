@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+# Linter and normalizer for the .cht files below cht/.
+#
+#     chtlint.py [--fix] [--jobs N] [--state FILE] [PATH...]
+#
+# Every file is checked for
+#   mojibake            descriptions that were UTF-8 encoded twice (fixable)
+#   trailing-space      blanks after a value, e.g. `cheats = 7 ` (fixable)
+#   unterminated-quote  a quoted value without closing quote (fixable)
+#   count-mismatch      `cheats = N` not matching the cheats present (fixable
+#                       when the cheats are numbered without gaps)
+#   missing-count       no `cheats` line at all
+#   missing-desc        a cheat without description
+#   code-separators     empty `+` groups or blanks around a code (fixable)
+#   malformed-code      characters no cheat device uses, or a line break
+#   invalid-utf8        bytes that are not UTF-8
+#
+# Issues are printed as JSON lines on stdout, a summary goes to stderr. With
+# --fix, fixable issues are repaired in place (files are replaced atomically
+# and only when something changed) and reported with "fixed": true.
+#
+# The size, mtime and issues of every checked file are remembered in a small
+# SQLite database, so files that did not change since the previous run are not
+# parsed again; their issues are reported from the state file.
+
+import argparse
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import chtfile
+
+
+# Bumped whenever the checks change, which invalidates the state file
+VERSION = 1
+
+# Issues normalize() repairs by itself; the others need a replacement value
+REFORMAT = {'trailing-space', 'unterminated-quote'}
+
+# Digits, letters and the separators used by the various cheat formats:
+# `+` and `;` between codes, `-` and `:` in Game Genie and PCE codes, `?` and
+# `*` as wildcards, `$` and `.` in Game Boy codes and `\` in ZX Spectrum POKEs.
+CODE = re.compile(r'[0-9A-Za-z +\-:?;$.*\\]*')
+
+SEPARATORS = re.compile(r'^[ +]+|[ +]+$|\+(?:[ ]*\+)+')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    issues TEXT NOT NULL
+)
+'''
+
+Issue = Dict[str, object]
+
+
+def default_state() -> str:
+    """Return the default state file, next to the hash cache"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'libretro-database', 'chtlint.sqlite')
+
+
+def unmojibake(text: str) -> str:
+    """Undo UTF-8 text that was decoded as Windows-1252 and encoded again
+
+    Repeats while that keeps producing valid UTF-8, so text mangled several
+    times is repaired too. Returns <text> unchanged when it does not decode.
+    """
+    for _ in range(4):
+        data = bytearray()
+        for ch in text:
+            if ord(ch) < 256:
+                data.append(ord(ch))
+                continue
+            try:
+                data += ch.encode('cp1252')
+            except UnicodeEncodeError:
+                return text
+        try:
+            fixed = data.decode('utf-8')
+        except UnicodeDecodeError:
+            return text
+        if fixed == text:
+            break
+        text = fixed
+    return text
+
+
+def _fix_code(code: str) -> str:
+    return SEPARATORS.sub(lambda m: '+' if m.start() and m.end() < len(code) else '', code)
+
+
+def check(cht: chtfile.ChtFile) -> List[Tuple[int, str, str, Optional[str]]]:
+    """Return the issues of <cht> as (entry or -1, kind, message, fixed value)
+
+    Value fixes are only computed here; normalize() applies them.
+    """
+    raw = cht.raw
+    issues = []
+    try:
+        raw.decode('utf-8')
+    except UnicodeDecodeError as e:
+        issues.append((-1, 'invalid-utf8', 'invalid UTF-8 at offset %d' % e.start, None))
+
+    for i in range(len(cht)):
+        end = cht.value_ends[i]
+        if cht.quoted[i] and raw[end:end + 1] != b'"':
+            issues.append((i, 'unterminated-quote', 'quoted value is not closed', None))
+        elif raw[cht.line_ends[i] - 1:cht.line_ends[i]] in (b' ', b'\t') or \
+                raw[cht.line_ends[i] - 2:cht.line_ends[i]] in (b' \r', b'\t\r'):
+            issues.append((i, 'trailing-space', 'blanks after the value', None))
+
+    if 'cheats' not in cht:
+        issues.append((-1, 'missing-count', 'no cheats line', None))
+
+    indices = cht.cheat_indices()
+    if 'cheats' in cht and indices and cht.get('cheats').strip() != str(len(indices)):
+        present = len(indices)
+        contiguous = indices[-1] == present - 1
+        issues.append((cht.index['cheats'], 'count-mismatch',
+                       'cheats = %s but %d cheats present' % (cht.get('cheats').strip(), present),
+                       str(present) if contiguous else None))
+
+    for n in indices:
+        cheat = cht.cheat(n)
+        desc = cheat.get('desc')
+        if desc is None:
+            issues.append((-1, 'missing-desc', 'cheat%d has no description' % n, None))
+        else:
+            fixed = unmojibake(desc)
+            if fixed != desc:
+                issues.append((cht.index['cheat%d_desc' % n], 'mojibake', fixed, fixed))
+        code = cheat.get('code')
+        if code is None:
+            continue
+        if '\n' in code or not CODE.fullmatch(code):
+            issues.append((cht.index['cheat%d_code' % n], 'malformed-code', code, None))
+        elif SEPARATORS.search(code):
+            fixed = _fix_code(code)
+            issues.append((cht.index['cheat%d_code' % n], 'code-separators', fixed, fixed))
+    return issues
+
+
+def normalize(cht: chtfile.ChtFile) -> bytes:
+    """Return the file with trailing blanks stripped, single line quotes
+    closed and changed values substituted; everything else is copied"""
+    raw = cht.raw
+    out = []
+    pos = 0
+    for i in range(len(cht)):
+        start, end = cht.value_starts[i], cht.value_ends[i]
+        line_end = cht.line_ends[i]
+        cr = raw[line_end - 1:line_end] == b'\r'
+        value = cht.value(i).encode('utf-8', 'surrogateescape')
+        suffix = raw[end:line_end]
+        if cht.quoted[i] and not suffix.startswith(b'"'):
+            value = value.rstrip(b' \t\r')
+            suffix = b'"'
+        out.append(raw[pos:start])
+        out.append(value)
+        out.append(suffix.rstrip(b' \t\r') + (b'\r' if cr else b''))
+        pos = line_end
+    out.append(raw[pos:])
+    return b''.join(out)
+
+
+def _write(path: str, data: bytes) -> None:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.lint-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def lint_file(job: Tuple[str, bool]) -> Tuple[str, Optional[os.stat_result], List[Issue]]:
+    """Check (and with fix, repair) one file; never raises"""
+    path, fix = job
+    try:
+        cht = chtfile.ChtFile.load(path)
+        found = check(cht)
+        fixed = False
+        if fix and any(kind in REFORMAT or value is not None for _, kind, _, value in found):
+            for i, kind, _, value in found:
+                if value is not None:
+                    cht[cht.key(i)] = value
+            data = normalize(cht)
+            if data != cht.raw:
+                _write(path, data)
+                fixed = True
+        issues = []
+        for i, kind, message, value in found:
+            issue: Issue = {'path': path, 'issue': kind}
+            if i >= 0:
+                issue['line'] = cht.raw.count(b'\n', 0, cht.line_starts[i]) + 1
+                issue['key'] = cht.key(i)
+            issue['message'] = message
+            fixable = kind in REFORMAT or value is not None
+            issue['fixable'] = fixable
+            if fixed and fixable:
+                issue['fixed'] = True
+            issues.append(issue)
+        return path, os.stat(path), issues
+    except OSError as e:
+        return path, None, [{'path': path, 'issue': 'error', 'message': str(e), 'fixable': False}]
+
+
+class State:
+    """Size, mtime and issues of the files checked by previous runs"""
+
+    def __init__(self, path: Optional[str]):
+        self._db = None
+        self.files: Dict[str, Tuple[int, int, str]] = {}
+        if path is None:
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute(SCHEMA)
+        for row in self._db.execute('SELECT path, size, mtime_ns, issues FROM files WHERE version = ?', (VERSION,)):
+            self.files[row[0]] = row[1:]
+
+    def cached(self, path: str, fix: bool) -> Optional[List[Issue]]:
+        """Return the remembered issues of <path> if it did not change"""
+        entry = self.files.get(os.path.abspath(path))
+        if entry is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if (st.st_size, st.st_mtime_ns) != entry[:2]:
+            return None
+        issues = json.loads(entry[2])
+        if fix and any(issue['fixable'] for issue in issues):
+            return None
+        return [dict({'path': path}, **issue) for issue in issues]
+
+    def store(self, path: str, st: os.stat_result, issues: List[Issue]) -> None:
+        if self._db is None:
+            return
+        # Fixes are reported once; later runs only see what is left
+        kept = [{k: v for k, v in issue.items() if k != 'path'} for issue in issues if not issue.get('fixed')]
+        self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                         (os.path.abspath(path), VERSION, st.st_size, st.st_mtime_ns, json.dumps(kept)))
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Check and normalize .cht cheat files')
+    parser.add_argument('paths', nargs='*', default=['cht'], help='files or directories (default: cht)')
+    parser.add_argument('--fix', action='store_true', help='repair fixable issues in place')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--state', default=default_state(),
+                        help='file remembering unchanged files (default: %(default)s)')
+    parser.add_argument('--no-state', action='store_true', help='check every file')
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    state = State(None if args.no_state else args.state)
+    counts: Dict[str, int] = {}
+    scanned = skipped = unfixed = 0
+
+    def report(issues: List[Issue]) -> None:
+        nonlocal unfixed
+        for issue in issues:
+            unfixed += not issue.get('fixed')
+            counts[issue['issue']] = counts.get(issue['issue'], 0) + 1
+            print(json.dumps(issue, ensure_ascii=False))
+
+    jobs = []
+    for path in chtfile.find_files(args.paths):
+        issues = state.cached(path, args.fix)
+        if issues is None:
+            jobs.append((path, args.fix))
+        else:
+            skipped += 1
+            report(issues)
+
+    if args.jobs > 1 and len(jobs) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        results: Iterator = executor.map(lint_file, jobs, chunksize=max(1, len(jobs) // (args.jobs * 8)))
+    else:
+        executor = None
+        results = map(lint_file, jobs)
+    try:
+        for path, st, issues in results:
+            scanned += 1
+            report(issues)
+            if st is not None:
+                state.store(path, st, issues)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        state.close()
+
+    print('%d files checked, %d unchanged files skipped in %.2fs; %s' % (
+        scanned, skipped, time.perf_counter() - began,
+        ', '.join('%d %s' % (n, kind) for kind, n in sorted(counts.items())) or 'no issues'), file=sys.stderr)
+    return 1 if unfixed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
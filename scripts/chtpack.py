@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+# Indexed archives of the cheat files below cht/.
+#
+#     chtpack.py pack [--single FILE | --output DIR] [--compress [--level N]]
+#                     [--keep-times] [--jobs N] [CHT_DIR]
+#     chtpack.py get ARCHIVE TITLE
+#     chtpack.py list ARCHIVE
+#     chtpack.py extract ARCHIVE DIR
+#
+# `pack` writes one archive per system, DIR/<System>.chtpack (build/cht by
+# default), plus DIR/.chtpack of the files next to the system directories, or
+# with --single one archive of the whole tree. Every regular
+# file is stored, README.md and XML files included, so `extract` rebuilds the
+# tree byte for byte. An archive is only replaced when its content changed.
+#
+#     header    b'CHTPACK\0', version, flags, entry count, index offset,
+#               names offset, length of the base directory
+#     base      the directory the names are relative to ('' for --single)
+#     data      the content of every file, zlib compressed with --compress
+#               when that makes it smaller, in name order
+#     names     the UTF-8 names, back to back
+#     index     one fixed-width entry per file, sorted bytewise by name:
+#               data offset, mtime (0 unless --keep-times), name offset and
+#               length, stored size, size, crc32, mode, method
+#
+# Integers are big endian. ChtPack memory maps an archive and finds a title
+# with a binary search of the index, reading only the names it compares and
+# the data of the entry it returns:
+#
+#     with ChtPack('build/cht/Sony - PlayStation.chtpack') as pack:
+#         cht = pack.load('Chrono Cross (USA)')
+#         print(cht.count)
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import chtfile
+
+
+MAGIC = b'CHTPACK\0'
+VERSION = 1
+
+STORED, DEFLATED = 0, 1
+
+# Flags
+TIMES = 1
+
+# Archive of the files next to the system directories, written by `pack` without --single
+LOOSE = '.chtpack'
+
+_HEADER = struct.Struct('>8sHHIQQI')
+_ENTRY = struct.Struct('>QQIHIIIHBx')
+
+# (name, data, method, size, crc, mode, mtime_ns)
+Prepared = Tuple[str, bytes, int, int, int, int, int]
+
+
+class PackError(ValueError):
+    """Raised for files that are not archives of this version, or are damaged"""
+
+
+class Entry:
+    __slots__ = ('name', 'offset', 'mtime_ns', 'stored', 'size', 'crc', 'mode', 'method')
+
+    def __init__(self, name: str, offset: int, mtime_ns: int, stored: int, size: int, crc: int, mode: int, method: int):
+        self.name = name
+        self.offset = offset
+        self.mtime_ns = mtime_ns
+        self.stored = stored
+        self.size = size
+        self.crc = crc
+        self.mode = mode
+        self.method = method
+
+    def __repr__(self) -> str:
+        return 'Entry(%r, %d bytes)' % (self.name, self.size)
+
+
+def find_files(directory: str) -> List[str]:
+    """Return the relative paths of every regular file below <directory>, '/' separated"""
+    names = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                names.append(os.path.relpath(path, directory).replace(os.sep, '/'))
+    names.sort(key=lambda name: name.encode('utf-8', 'surrogateescape'))
+    return names
+
+
+def prepare(job: Tuple[str, str, Optional[int], bool]) -> Prepared:
+    """Read and maybe compress one file"""
+    directory, name, level, times = job
+    path = os.path.join(directory, name)
+    with open(path, 'rb') as f:
+        data = f.read()
+        st = os.fstat(f.fileno())
+    method = STORED
+    stored = data
+    if level is not None:
+        deflated = zlib.compress(data, level)
+        if len(deflated) < len(data):
+            method, stored = DEFLATED, deflated
+    return name, stored, method, len(data), zlib.crc32(data), st.st_mode & 0o7777, st.st_mtime_ns if times else 0
+
+
+def write(f, base: str, prepared: Iterator[Prepared], times: bool = False) -> int:
+    """Write an archive of the <prepared> files, in name order, to the seekable file <f>"""
+    base_raw = base.encode('utf-8', 'surrogateescape')
+    f.write(b'\0' * _HEADER.size)
+    f.write(base_raw)
+    offset = _HEADER.size + len(base_raw)
+    entries = []
+    names = bytearray()
+    for name, data, method, size, crc, mode, mtime_ns in prepared:
+        raw = name.encode('utf-8', 'surrogateescape')
+        if len(raw) > 0xffff:
+            raise PackError('name too long: %s' % name)
+        entries.append((raw, len(names), offset, mtime_ns, len(data), size, crc, mode, method))
+        names += raw
+        f.write(data)
+        offset += len(data)
+    entries.sort(key=lambda entry: entry[0])
+    names_offset = offset
+    f.write(names)
+    index_offset = names_offset + len(names)
+    for raw, name_offset, data_offset, mtime_ns, stored, size, crc, mode, method in entries:
+        f.write(_ENTRY.pack(data_offset, mtime_ns, name_offset, len(raw), stored, size, crc, mode, method))
+    f.seek(0)
+    f.write(_HEADER.pack(MAGIC, VERSION, TIMES if times else 0, len(entries), index_offset, names_offset, len(base_raw)))
+    f.seek(0, os.SEEK_END)
+    return len(entries)
+
+
+def _same_file(a: str, b: str) -> bool:
+    try:
+        if os.path.getsize(a) != os.path.getsize(b):
+            return False
+        with open(a, 'rb') as fa, open(b, 'rb') as fb:
+            while True:
+                chunk = fa.read(1 << 20)
+                if chunk != fb.read(1 << 20):
+                    return False
+                if not chunk:
+                    return True
+    except OSError:
+        return False
+
+
+def pack(directory: str, output: str, base: str = '', level: Optional[int] = None, times: bool = False,
+         executor=None, names: Optional[List[str]] = None) -> Tuple[int, bool]:
+    """Pack <names>, by default every file below <directory>, into <output>; returns (files, whether <output> changed)"""
+    if names is None:
+        names = find_files(directory)
+    jobs = [(directory, name, level, times) for name in names]
+    prepared = executor.map(prepare, jobs, chunksize=64) if executor is not None else map(prepare, jobs)
+    out_dir = os.path.dirname(output) or '.'
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w+b') as f:
+            count = write(f, base, prepared, times)
+        if _same_file(tmp, output):
+            os.unlink(tmp)
+            return count, False
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, output)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return count, True
+
+
+class ChtPack:
+    """A memory mapped archive written by pack()"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse()
+        except BaseException:
+            self._mm.close()
+            raise
+
+    def _parse(self) -> None:
+        mm = self._mm
+        if len(mm) < _HEADER.size:
+            raise PackError('%s: truncated header' % self.path)
+        magic, version, self.flags, self.count, self.index_offset, self.names_offset, base_len = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise PackError('%s: not a version %d cheat archive' % (self.path, VERSION))
+        if self.index_offset + self.count * _ENTRY.size > len(mm) or self.names_offset > self.index_offset:
+            raise PackError('%s: truncated index' % self.path)
+        self.base = mm[_HEADER.size:_HEADER.size + base_len].decode('utf-8', 'surrogateescape')
+
+    def __enter__(self) -> 'ChtPack':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _name(self, i: int) -> bytes:
+        pos = self.index_offset + i * _ENTRY.size + 16
+        name_offset, name_len = struct.unpack_from('>IH', self._mm, pos)
+        start = self.names_offset + name_offset
+        return self._mm[start:start + name_len]
+
+    def _entry(self, i: int) -> Entry:
+        data_offset, mtime_ns, name_offset, name_len, stored, size, crc, mode, method = _ENTRY.unpack_from(
+            self._mm, self.index_offset + i * _ENTRY.size)
+        start = self.names_offset + name_offset
+        name = self._mm[start:start + name_len].decode('utf-8', 'surrogateescape')
+        return Entry(name, data_offset, mtime_ns, stored, size, crc, mode, method)
+
+    def _find(self, name: str) -> Optional[int]:
+        key = name.encode('utf-8', 'surrogateescape')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._name(lo) == key:
+            return lo
+        return None
+
+    def entries(self) -> Iterator[Entry]:
+        for i in range(self.count):
+            yield self._entry(i)
+
+    def names(self) -> List[str]:
+        return [self._name(i).decode('utf-8', 'surrogateescape') for i in range(self.count)]
+
+    def entry(self, title: str) -> Optional[Entry]:
+        """Return the entry of <title>, given as its name with or without .cht"""
+        i = self._find(title)
+        if i is None and not title.endswith('.cht'):
+            i = self._find(title + '.cht')
+        return self._entry(i) if i is not None else None
+
+    def __contains__(self, title: str) -> bool:
+        return self.entry(title) is not None
+
+    def read(self, entry: Entry) -> bytes:
+        stored = self._mm[entry.offset:entry.offset + entry.stored]
+        if entry.method == DEFLATED:
+            data = zlib.decompress(stored)
+        elif entry.method == STORED:
+            data = stored
+        else:
+            raise PackError('%s: %s: unknown method %d' % (self.path, entry.name, entry.method))
+        if len(data) != entry.size or zlib.crc32(data) != entry.crc:
+            raise PackError('%s: %s: damaged' % (self.path, entry.name))
+        return data
+
+    def get(self, title: str) -> Optional[bytes]:
+        """Return the content of <title>, None if the archive has no such file"""
+        entry = self.entry(title)
+        return self.read(entry) if entry is not None else None
+
+    def load(self, title: str) -> Optional[chtfile.ChtFile]:
+        data = self.get(title)
+        return chtfile.ChtFile(data) if data is not None else None
+
+    def _parts(self, name: str) -> List[str]:
+        """Split a name of the archive into path components, refusing ones that leave the output"""
+        parts = name.split('/')
+        if '..' in parts or name.startswith('/'):
+            raise PackError('%s: unsafe name %r' % (self.path, name))
+        return parts
+
+    def extract(self, directory: str) -> int:
+        """Write every file to <directory>/<base>; returns the number of files"""
+        root = os.path.join(directory, *self._parts(self.base)) if self.base else directory
+        for entry in self.entries():
+            path = os.path.join(root, *self._parts(entry.name))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(self.read(entry))
+            os.chmod(path, entry.mode)
+            if self.flags & TIMES:
+                os.utime(path, ns=(entry.mtime_ns, entry.mtime_ns))
+        return self.count
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Pack cht/ into indexed archives and read them')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('pack', help='pack a cheat tree')
+    p.add_argument('source', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cht'),
+                   help='directory of system directories (default: cht/)')
+    p.add_argument('--output', default='build/cht', help='directory for the per-system archives (default: %(default)s)')
+    p.add_argument('--single', metavar='FILE', help='write one archive of the whole tree instead')
+    p.add_argument('--compress', action='store_true', help='zlib compress the entries that get smaller')
+    p.add_argument('--level', type=int, default=9, help='zlib compression level (default: %(default)s)')
+    p.add_argument('--keep-times', action='store_true', help='store modification times, restored on extract')
+    p.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                   help='number of worker processes (default: all cores)')
+    p = commands.add_parser('get', help='print the content of one file')
+    p.add_argument('archive')
+    p.add_argument('title', help='file name, with or without .cht')
+    p = commands.add_parser('list', help='list the files of an archive')
+    p.add_argument('archive')
+    p = commands.add_parser('extract', help='rebuild the tree of an archive')
+    p.add_argument('archive')
+    p.add_argument('directory')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'get':
+            with ChtPack(args.archive) as archive:
+                data = archive.get(args.title)
+            if data is None:
+                print('%s: no %s' % (args.archive, args.title), file=sys.stderr)
+                return 1
+            sys.stdout.buffer.write(data)
+            return 0
+        if args.command == 'list':
+            with ChtPack(args.archive) as archive:
+                for entry in archive.entries():
+                    print('%10d %10d %s' % (entry.size, entry.stored, entry.name))
+            return 0
+        if args.command == 'extract':
+            with ChtPack(args.archive) as archive:
+                count = archive.extract(args.directory)
+            print('%d files extracted' % count, file=sys.stderr)
+            return 0
+    except (PackError, OSError, zlib.error) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    level = args.level if args.compress else None
+    executor = ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    try:
+        if args.single:
+            count, changed = pack(args.source, args.single, '', level, args.keep_times, executor)
+            print('%s: %d files%s' % (args.single, count, '' if changed else ', unchanged'), file=sys.stderr)
+            return 0
+        entries = sorted(os.listdir(args.source))
+        systems = [name for name in entries if os.path.isdir(os.path.join(args.source, name))]
+        loose = [name for name in entries if os.path.isfile(os.path.join(args.source, name))]
+        archives = written = 0
+        for system in systems:
+            count, changed = pack(os.path.join(args.source, system), os.path.join(args.output, system + '.chtpack'),
+                                  system, level, args.keep_times, executor)
+            archives += 1
+            written += changed
+        if loose:
+            # Files outside of the system directories
+            count, changed = pack(args.source, os.path.join(args.output, LOOSE), '', level, args.keep_times, executor,
+                                  sorted(loose, key=lambda name: name.encode('utf-8', 'surrogateescape')))
+            archives += 1
+            written += changed
+        print('%d archives, %d changed' % (archives, written), file=sys.stderr)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,52 +1,76 @@
-from lxml import html
-import requests
 import re
 
+import chtfile
 
 
-def cheatwriter( baseurl, chttype, outdir ):
-	page = requests.get(baseurl + chttype)
-	tree = html.fromstring(page.text)
-#urls and game names to be used as file names	
-	gameurl = tree.xpath('//td[@class="codedescalt"]//a/@href')
-	chtfilenames = [re.sub('[^0-9a-zA-Z\s]+', '', nogo).replace('  ', ' ').rstrip().lstrip() for nogo in tree.xpath('//td[@class="codedescalt"]/a[@href]/text()')]
+#xpaths of the bsfree listings (systems, code types, games) and code pages
+LINK_HREFS = '//td[@class="codedescalt"]//a/@href'
+LINK_NAMES = '//td[@class="codedescalt"]/a[@href]/text()'
+CODE_DESCS = '//td[@class="codedesc"]/text()'
+CODE_CELLS = '//tr/td[@class="code"][last()]'
 
-	for number, codepage in enumerate(gameurl):
-		outfile = outdir + '/' + chtfilenames[number] + '.cht'
 
-		page = requests.get(baseurl + codepage)
-		tree = html.fromstring(page.text)
-	
+def parse_listing(text):
+	"""Return the (href, name) of every entry of a listing page"""
+	from lxml import html
 
-		code=[]
+	tree = html.fromstring(text)
+	return list(zip(tree.xpath(LINK_HREFS), [str(name) for name in tree.xpath(LINK_NAMES)]))
+
+
+def parse_codes(text):
+	"""Return the (description, code) of every cheat of a code page
+
+	Raises ValueError when the page does not have as many descriptions as codes.
+	"""
+	from lxml import html
+
+	tree = html.fromstring(text)
+	code=[]
 #This will create a list of code descriptions
-		codedesc = [x.encode('UTF8') for x in tree.xpath('//td[@class="codedesc"]/text()')]
+	codedesc = [str(x).strip() for x in tree.xpath(CODE_DESCS)]
 #This will create a list of codes and format them for the outfile
-		for td in tree.xpath('//tr/td[@class="code"][last()]'):
-			code.append('+'.join(
-    	    text.replace('\n', '').replace(' ', '+') for text in td.getprevious().itertext()))
-		
-		codesamount = len(codedesc)
-		codes = [dubplus.replace('++', '+') for dubplus in code]
-
-		
-		
+	for td in tree.xpath(CODE_CELLS):
+		code.append('+'.join(
+			text.replace('\n', '').replace(' ', '+') for text in td.getprevious().itertext()))
+	codes = [dubplus.replace('++', '+') for dubplus in code]
+#a description or code cell the xpaths missed would shift every later cheat
+	if len(codedesc) != len(codes):
+		raise ValueError('%d code descriptions for %d codes' % (len(codedesc), len(codes)))
+	return list(zip(codedesc, codes))
+
+
+def file_name(name):
+	"""Return the .cht file name of the game <name> as listed"""
+	return re.sub(r'[^0-9a-zA-Z\s]+', '', name).replace('  ', ' ').rstrip().lstrip() + '.cht'
+
+
+def write(outfile, cheats):
+	with open(outfile, 'wb') as target:
+		chtfile.write_cheats(target, cheats)
+
+
+def cheatwriter( baseurl, chttype, outdir, session=None ):
+	"""Write the cheats of every game of the code type page <chttype> to <outdir>, one page at a time"""
+	import requests
+
+	get = session.get if session is not None else requests.get
+#urls and game names to be used as file names
+	for codepage, name in parse_listing(get(baseurl + chttype).text):
+		outfile = outdir + '/' + file_name(name)
+		try:
+			cheats = parse_codes(get(baseurl + codepage).text)
+		except ValueError as e:
+			print("skipping %s: %s" % (baseurl + codepage, e))
+			continue
+
 #writes the codes
-		if codesamount == 0:
+		if not cheats:
 			continue
-		target = open(outfile, 'wb')
-		target.write("cheats = {0} \n\n".format(codesamount))
-		print "writing %s" % (outfile)
+		print("writing %s" % (outfile))
 		try:
-			for idx, val in enumerate(codes):
-				target.write("cheat%d_desc = \" %s\"\n" % (idx, codedesc[idx]))
-				target.write("cheat%d_code = \"%s\"\n" % (idx, val))
-				target.write("cheat%d_enable = false \n" % (idx))
-				target.write('\n')
-			
-			print "finished writing %s" % (outfile)
+			write(outfile, cheats)
+			print("finished writing %s" % (outfile))
 		except Exception:
-			print "error writing " + outfile
+			print("error writing " + outfile)
 	return;
-
-
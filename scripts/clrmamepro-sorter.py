@@ -1,42 +1,238 @@
 #!/usr/bin/env python3
 
-# This implements a very stupid ClrMamePro DAT file sorter. It expects a DAT
-# file to be "well formed", so everything except the first level should be
-# indented, since that is used to lump lines together into one "entry".
+# This implements a ClrMamePro DAT file sorter. Every `game ( ... )` stanza
+# is moved as a whole; `clrmamepro ( ... )` headers and the whitespace between
+# stanzas stay where they are, so the layout of the file is preserved.
+#
+# Stanzas are sorted by their full text by default, or by game name, first ROM
+# CRC or serial with --key. Only the key and the byte offsets of each stanza
+# are kept in memory; the output is copied straight from a memory map of the
+# input. When the keys of one file outgrow --memory, sorted runs are spilled
+# to temporary files and merged back.
+#
+#     clrmamepro-sorter.py [--key {text,name,crc,serial}] [--jobs N] FILE...
+#     clrmamepro-sorter.py --check metadat/*/*.dat dat/*.dat
+#
+# --check verifies the order in a single streaming pass without rewriting
+# anything and exits with status 1 if any file is not sorted.
 
-import re
+import argparse
+import heapq
+import mmap
+import os
+import pickle
+import shutil
 import sys
+import tempfile
 
-from typing import List
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import clrmamepro
 
 
-START_STANZA = re.compile(r'([a-z0-9]+)\s*\(', re.IGNORECASE)
 VALID_START = {'clrmamepro', 'game'}
 
+KEYS: Dict[str, Callable[[clrmamepro.Stanza], object]] = {
+    'text': lambda stanza: stanza.raw,
+    'name': lambda stanza: stanza.get('name') or stanza.get('comment') or '',
+    'crc': lambda stanza: (stanza.lookup('rom.crc') or '').upper(),
+    'serial': lambda stanza: stanza.get('serial') or stanza.lookup('rom.serial') or '',
+}
+
+# Rough per-entry cost of a (key, index) tuple in a run, on top of the key
+ENTRY_OVERHEAD = 120
+DEFAULT_MEMORY = 256 << 20
+RUN_BATCH = 4096
+# Runs are merged down to one before more than this many are open at once
+MAX_RUNS = 64
+
+
+def _spill(entries: Iterable[Tuple[object, int]], directory: str) -> str:
+    with tempfile.NamedTemporaryFile('wb', dir=directory, suffix='.run', delete=False) as run:
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) == RUN_BATCH:
+                pickle.dump(batch, run, pickle.HIGHEST_PROTOCOL)
+                batch = []
+        if batch:
+            pickle.dump(batch, run, pickle.HIGHEST_PROTOCOL)
+    return run.name
+
+
+def _read_run(path: str) -> Iterator[Tuple[object, int]]:
+    with open(path, 'rb') as run:
+        while True:
+            try:
+                batch = pickle.load(run)
+            except EOFError:
+                return
+            yield from batch
+
+
+def _sorted_chunks(buf, key: str, memory: int, spill_dir: Optional[str]) -> Iterator[Tuple[bytes, bool]]:
+    """Yield the pieces of the sorted version of <buf>
+
+    Each piece comes with a flag telling whether a stanza moved, so callers
+    can tell an already sorted input from a changed one.
+    """
+    starts = array('Q')
+    ends = array('Q')
+    games = bytearray()
+    batch: List[Tuple[object, int]] = []
+    runs: List[str] = []
+    used = 0
+    keyfunc = KEYS[key]
+    try:
+        for stanza in clrmamepro.parse_buffer(buf):
+            if stanza.tag not in VALID_START:
+                raise clrmamepro.DatError("File doesn't look like a valid DAT file!")
+            index = len(starts)
+            starts.append(stanza.start)
+            ends.append(stanza.end)
+            games.append(stanza.tag == 'game')
+            if stanza.tag != 'game':
+                continue
+            k = keyfunc(stanza)
+            batch.append((k, index))
+            used += sys.getsizeof(k) + ENTRY_OVERHEAD
+            if used > memory and len(batch) >= RUN_BATCH and spill_dir is not None:
+                batch.sort()
+                runs.append(_spill(batch, spill_dir))
+                batch = []
+                used = 0
+                if len(runs) == MAX_RUNS:
+                    merged = _spill(heapq.merge(*map(_read_run, runs)), spill_dir)
+                    for run in runs:
+                        os.unlink(run)
+                    runs = [merged]
+        batch.sort()
+        order: Iterable[Tuple[object, int]] = heapq.merge(batch, *map(_read_run, runs)) if runs else batch
+
+        count = len(starts)
+        if not count:
+            yield bytes(buf), False
+            return
+        yield bytes(buf[:starts[0]]), False
+        moved = iter(order)
+        for i in range(count):
+            src = next(moved)[1] if games[i] else i
+            gap_end = starts[i + 1] if i + 1 < count else len(buf)
+            yield bytes(buf[starts[src]:ends[src]]), src != i
+            yield bytes(buf[ends[i]:gap_end]), False
+    finally:
+        for run in runs:
+            os.unlink(run)
+
+
+def sortdat(lines: str, key: str = 'text') -> str:
+    """Return the DAT text <lines> with its games sorted by <key>"""
+    data = lines.encode('utf-8', 'surrogateescape')
+    chunks = [chunk for chunk, _ in _sorted_chunks(data, key, DEFAULT_MEMORY, None)]
+    return b''.join(chunks).decode('utf-8', 'surrogateescape')
+
+
+def sort_file(path: str, key: str = 'text', memory: int = DEFAULT_MEMORY) -> bool:
+    """Sort <path> in place and return whether anything moved
+
+    The result is written to a temporary file next to <path> and atomically
+    renamed over it, and only when the order actually changed.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                tempfile.NamedTemporaryFile('wb', dir=directory, prefix='.sort-', delete=False) as outfile:
+            changed = False
+            try:
+                for chunk, moved in _sorted_chunks(mm, key, memory, directory):
+                    outfile.write(chunk)
+                    changed = changed or moved
+            except BaseException:
+                os.unlink(outfile.name)
+                raise
+    if not changed:
+        os.unlink(outfile.name)
+        return False
+    shutil.copymode(path, outfile.name)
+    os.replace(outfile.name, path)
+    return True
+
+
+def check_file(path: str, key: str = 'text') -> Optional[str]:
+    """Return a description of the first out of order game in <path>, if any"""
+    keyfunc = KEYS[key]
+    previous = None
+    for stanza in clrmamepro.parse(path):
+        if stanza.tag not in VALID_START:
+            raise clrmamepro.DatError("File doesn't look like a valid DAT file!")
+        if stanza.tag != 'game':
+            continue
+        k = keyfunc(stanza)
+        if previous is not None and k < previous:
+            with open(path, 'rb') as f:
+                line = f.read(stanza.start).count(b'\n') + 1
+            return 'line %d: %r is out of order' % (line, stanza.get('name') or stanza.get('comment'))
+        previous = k
+    return None
+
+
+def _run(job: Tuple[str, str, bool, int]) -> Tuple[str, Optional[str], Optional[str]]:
+    """Process one file; returns (path, status, error) and never raises"""
+    path, key, check, memory = job
+    try:
+        if check:
+            return path, check_file(path, key), None
+        return path, 'sorted' if sort_file(path, key, memory) else None, None
+    except (clrmamepro.DatError, OSError) as e:
+        return path, None, str(e)
+
+
+def setup_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Sort the games of ClrMamePro DAT files')
+    parser.add_argument('files', nargs='+', help='DAT files to sort')
+    parser.add_argument('--key', choices=sorted(KEYS), default='text',
+                        help='sort by the whole stanza text (default), game name, first ROM CRC or serial')
+    parser.add_argument('--check', action='store_true', help='only report files that are not sorted')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--memory', type=int, default=DEFAULT_MEMORY >> 20,
+                        help='MiB of sort keys per file before spilling runs to disk (default: %(default)s)')
+    return parser
+
+
+def main(argv=None) -> int:
+    args = setup_argparse().parse_args(argv)
+    jobs = [(path, args.key, args.check, args.memory << 20) for path in args.files]
+    if args.jobs > 1 and len(jobs) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        results = executor.map(_run, jobs, chunksize=max(1, len(jobs) // (args.jobs * 4)))
+    else:
+        executor = None
+        results = map(_run, jobs)
 
-def sortdat(lines: str) -> str:
-    data: List[str] = []
-    curline: str = ''
-    for line in lines.split('\n'):
-        start = START_STANZA.match(line)
-        if start:
-            if start.group(1) not in VALID_START:
-                raise Exception("File doesn't look like a valid DAT file!")
-            if curline != '':
-                data.append(curline)
-            curline = line
-        else:
-            curline += '\n' + line
-    if curline != '':
-        data.append(curline)
+    failed = 0
+    try:
+        for path, status, error in results:
+            if error is not None:
+                print('%s: %s' % (path, error), file=sys.stderr)
+                failed += 1
+            elif args.check and status is not None:
+                print('%s: not sorted, %s' % (path, status))
+                failed += 1
+            elif status is not None:
+                print(f'Sorted {path}')
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-    return '\n'.join(sorted(data))
+    if args.check:
+        print('%d of %d files sorted' % (len(jobs) - failed, len(jobs)))
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':
-    for file in sys.argv[1:]:
-        print(f'Sorting {file}')
-        with open(file, 'r') as infile:
-            content = sortdat(infile.read())
-        with open(file, 'w') as outfile:
-            outfile.write(content)
+    sys.exit(main())
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+# Streaming ClrMamePro DAT parser shared by the scripts in this directory.
+#
+# A DAT is a sequence of top-level stanzas such as `clrmamepro ( ... )` and
+# `game ( ... )`. Each stanza holds `key value` pairs where a value is either
+# a bare word, a double quoted string (which may span several lines and may
+# contain backslash escaped quotes) or a nested group like `rom ( ... )`.
+#
+# parse() yields one Stanza per top-level entry without ever holding more
+# than one read chunk of the input in memory. Files are memory mapped, so the
+# page cache is shared and the resident size stays flat regardless of the
+# size of the DAT. Stanza boundaries are found with a single regular
+# expression that only matches well formed stanzas, so every stanza parse()
+# yields is known to tokenize; the key/value pairs of a stanza are only
+# tokenized when they are first accessed, so tools that just move stanzas
+# around or check the syntax never pay for it.
+#
+#     for game in parse('metadat/redump/Sony - PlayStation.dat'):
+#         print(game.get('name'), [rom.get('crc') for rom in game.roms])
+#
+# Running the module directly parses every file given on the command line and
+# prints stanza counts and throughput, which is handy to spot broken DATs.
+
+import mmap
+import os
+import re
+import sys
+import time
+
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
+
+
+# One token per match: an opening or closing parenthesis, a quoted string, a
+# bare word, or an unterminated quote (only valid when more data may follow).
+# Like libretro-db's c_converter, a bare word runs until the next whitespace,
+# so unquoted names such as `Farmyfarm(v1.0)` stay in one piece.
+TOKEN = re.compile(rb'[ \t\r\n]*(?:(\()|(\))|"([^"\\]*(?:\\.[^"\\]*)*)"|([^\s()"]\S*)|("))', re.DOTALL)
+
+OPEN, CLOSE, QUOTED, WORD, UNTERMINATED = 1, 2, 3, 4, 5
+
+# A closing parenthesis, or a key followed by a quoted value, a group or a
+# bare word. Anything else lands in the last group and means "not simple".
+PAIRS = re.compile(r'[ \t\r\n]*(?:(\))|([^\s()"]\S*)(?=[\s("])[ \t\r\n]*(?:"([^"\\]*(?:\\.[^"\\]*)*)"|(\()|([^\s()"]\S*))|(\S))')
+
+# Fast path: a whole well formed top-level stanza with at most one level of
+# nested groups, i.e. `key value` pairs where a value is a quoted string, a
+# bare word or a group of such pairs without groups. A bare word always ends
+# at whitespace (a word right before ")" would take the parenthesis, as in
+# TOKEN), so a failed match cannot backtrack into a shorter word. Anything
+# this does not match is handed to the tokenizer, which reports errors.
+_SPACE = rb'\s'
+_QUOTED = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+_WORD = rb'[^\s()"]\S*' + _SPACE
+_PAIR = _WORD + _SPACE + rb'*(?:' + _QUOTED + rb'|' + _WORD + rb')' + _SPACE + rb'*'
+_GROUP = rb'\(' + _SPACE + rb'*(?:' + _PAIR + rb')*\)'
+_GROUP_PAIR = _WORD + _SPACE + rb'*(?:' + _QUOTED + rb'|' + _WORD + rb'|' + _GROUP + rb')' + _SPACE + rb'*'
+STANZA = re.compile(rb'[ \t\r\n]*([^\s()"]+)[ \t\r\n]*\(' + _SPACE + rb'*(?:' + _GROUP_PAIR + rb')*\)')
+
+CHUNK_SIZE = 1 << 20
+
+Source = Union[str, 'os.PathLike[str]', bytes, bytearray, memoryview, mmap.mmap, BinaryIO]
+
+
+class DatError(ValueError):
+    """Raised when the input is not a well formed ClrMamePro DAT"""
+
+
+class Stanza:
+    """A top-level entry (or a nested group) of a DAT
+
+    `items` holds the `(key, value)` pairs in file order; nested groups such as
+    `rom ( ... )` are Stanza instances themselves. `start` and `end` are the
+    byte offsets of a top-level entry in the source and `raw` is its original
+    text, so callers can copy an entry verbatim without re-serializing it.
+    """
+    __slots__ = ('tag', 'start', 'end', 'raw', '_items')
+
+    def __init__(self, tag: str, start: int, end: int, raw: Optional[bytes] = None,
+                 items: Optional[List[Tuple[str, Union[str, 'Stanza']]]] = None):
+        self.tag = tag
+        self.start = start
+        self.end = end
+        self.raw = raw
+        self._items = items
+
+    def __repr__(self) -> str:
+        return '<Stanza %s %r>' % (self.tag, self.get('name'))
+
+    @property
+    def items(self) -> List[Tuple[str, Union[str, 'Stanza']]]:
+        if self._items is None:
+            self._items = _tokenize_stanza(self)
+        return self._items
+
+    def get(self, key: str, default=None):
+        """Return the first value stored under <key>, or <default>"""
+        for k, v in self.items:
+            if k == key:
+                return v
+        return default
+
+    def getall(self, key: str) -> list:
+        """Return every value stored under <key> in file order"""
+        return [v for k, v in self.items if k == key]
+
+    @property
+    def roms(self) -> List['Stanza']:
+        return self.getall('rom')
+
+    def lookup(self, path: str, default=None):
+        """Return the value of a dotted <path> such as 'rom.crc'"""
+        node = self
+        for part in path.split('.'):
+            node = node.get(part) if isinstance(node, Stanza) else None
+            if node is None:
+                return default
+        return node
+
+
+def _decode(raw: bytes) -> str:
+    return raw.decode('utf-8', 'surrogateescape')
+
+
+def _tokenize_stanza(stanza: Stanza) -> list:
+    """Build the items of a complete top-level stanza from its raw text
+
+    The stanza is decoded once and split into key/value pairs with a single
+    findall() call, which is a lot faster than matching token by token.
+    Anything unusual is retokenized by _scan_group() so errors carry a
+    precise offset.
+    """
+    text = _decode(stanza.raw)
+    stack: list = []
+    items: list = []
+    for close, key, quoted, group, word, bad in PAIRS.findall(text, text.index('(') + 1):
+        if close:
+            if not stack:
+                return items
+            tag, parent = stack.pop()
+            parent.append((tag, Stanza(tag, 0, 0, None, items)))
+            items = parent
+        elif group:
+            stack.append((key, items))
+            items = []
+        elif word:
+            items.append((key, word))
+        elif bad:
+            break
+        else:
+            items.append((key, quoted))
+    return _scan_stanza(stanza)
+
+
+def _scan_stanza(stanza: Stanza) -> list:
+    raw = stanza.raw
+    m = TOKEN.match(raw)
+    m = TOKEN.match(raw, m.end())
+    group, _ = _scan_group(raw, m.end(), len(raw), stanza.tag, 0, stanza.start, True)
+    return group.items
+
+
+def _scan_group(buf, pos: int, end: int, tag: str, start: int, base: int, final: bool):
+    """Tokenize the body of a group whose "(" ends right before <pos>
+
+    Returns the group and the position after its closing ")", or (None, pos)
+    when <final> is false and the group is not complete yet.
+    """
+    match = TOKEN.match
+    stack: List[Stanza] = []
+    current = Stanza(tag, base + start, 0, None, [])
+    key: Optional[str] = None
+    while True:
+        m = match(buf, pos, end)
+        if m is None:
+            if final:
+                raise DatError('Unterminated %s stanza at offset %d' % (tag, base + start))
+            return None, pos
+        kind = m.lastindex
+        pos = m.end()
+        if kind == CLOSE:
+            if key is not None:
+                raise DatError('Key %s without value at offset %d' % (key, base + m.start(kind)))
+            current.end = base + pos
+            if not stack:
+                return current, pos
+            parent = stack.pop()
+            parent._items.append((current.tag, current))
+            current = parent
+        elif kind == OPEN:
+            if key is None:
+                raise DatError('Unexpected "(" at offset %d' % (base + m.start(kind)))
+            stack.append(current)
+            current = Stanza(key, base + m.start(kind), 0, None, [])
+            key = None
+        elif kind == UNTERMINATED:
+            if final:
+                raise DatError('Unterminated string at offset %d' % (base + m.start(kind)))
+            return None, pos
+        elif key is None:
+            if kind == QUOTED:
+                raise DatError('Expected a key at offset %d' % (base + m.start(kind)))
+            key = _decode(m.group(kind))
+        else:
+            current._items.append((key, _decode(m.group(kind))))
+            key = None
+
+
+def _parse_buffer(buf, pos: int, end: int, base: int, final: bool) -> Tuple[List[Stanza], int]:
+    """Split <buf> between <pos> and <end> into complete top-level stanzas
+
+    Returns the stanzas and the position of the first byte that has not been
+    consumed. When <final> is false an incomplete trailing stanza is left
+    unconsumed so the caller can retry once more data is available.
+    """
+    out: List[Stanza] = []
+    fast = STANZA.match
+    match = TOKEN.match
+    while True:
+        m = fast(buf, pos, end)
+        if m is not None:
+            start = m.start(1)
+            pos = m.end()
+            out.append(Stanza(_decode(m.group(1)), base + start, base + pos, bytes(buf[start:pos])))
+            continue
+
+        # Slow path: deeply nested groups, a stanza cut by the end of the
+        # buffer, or a syntax error that needs a precise message.
+        m = match(buf, pos, end)
+        if m is None:
+            # Only whitespace (or nothing) is left
+            return out, end if final else pos
+        kind = m.lastindex
+        if kind != WORD:
+            if kind == UNTERMINATED and not final:
+                return out, pos
+            raise DatError('Expected a stanza name at offset %d' % (base + m.start(kind)))
+        tag = _decode(m.group(WORD))
+        start = m.start(WORD)
+        m = match(buf, m.end(), end)
+        if m is None or m.lastindex != OPEN:
+            if m is None and not final:
+                return out, pos
+            raise DatError('Expected "(" after %s at offset %d' % (tag, base + start))
+        group, next_pos = _scan_group(buf, m.end(), end, tag, start, base, final)
+        if group is None:
+            return out, pos
+        group.raw = bytes(buf[start:next_pos])
+        out.append(group)
+        pos = next_pos
+
+
+def parse(source: Source, chunk_size: int = CHUNK_SIZE) -> Iterator[Stanza]:
+    """Yield every top-level stanza of a DAT
+
+    <source> may be a path, a bytes-like object (including an mmap) or a
+    binary file object. Paths are memory mapped; file objects are read in
+    <chunk_size> pieces, so pipes such as `git show` output work too.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            yield from parse_file(f, chunk_size)
+    elif isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        yield from parse_buffer(source, chunk_size)
+    else:
+        yield from parse_file(source, chunk_size)
+
+
+def parse_buffer(buf, chunk_size: int = CHUNK_SIZE) -> Iterator[Stanza]:
+    """Yield every top-level stanza of a bytes-like object such as an mmap"""
+    size = len(buf)
+    pos = 0
+    # Split one window at a time to keep the stanza lists short
+    while pos < size:
+        window = min(size, pos + chunk_size)
+        stanzas, consumed = _parse_buffer(buf, pos, window, 0, window == size)
+        yield from stanzas
+        if consumed == pos and window < size:
+            chunk_size *= 2
+        pos = consumed
+
+
+def parse_file(f: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[Stanza]:
+    """Yield every top-level stanza of the open binary file <f>"""
+    try:
+        size = os.fstat(f.fileno()).st_size
+        mapped = size > 0 and f.seekable() and f.tell() == 0
+    except (AttributeError, OSError, ValueError):
+        mapped = False
+    if mapped:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from parse_buffer(mm, chunk_size)
+        return
+
+    buf = b''
+    base = 0
+    while True:
+        data = f.read(chunk_size)
+        final = not data
+        buf += data
+        stanzas, consumed = _parse_buffer(buf, 0, len(buf), base, final)
+        yield from stanzas
+        if final:
+            return
+        base += consumed
+        buf = buf[consumed:]
+
+
+def main(argv=None) -> int:
+    total = 0
+    errors = 0
+    began = time.perf_counter()
+    for path in (sys.argv[1:] if argv is None else argv):
+        try:
+            count = 0
+            # parse() raises on the first stanza that is not well formed
+            for stanza in parse(path):
+                count += 1
+        except DatError as e:
+            print('%s: %s' % (path, e), file=sys.stderr)
+            errors += 1
+            continue
+        total += os.path.getsize(path)
+        print('%s: %d stanzas' % (path, count))
+    elapsed = time.perf_counter() - began
+    print('Parsed %.1f MB in %.2fs (%.1f MB/s)' % (total / 1e6, elapsed, total / 1e6 / max(elapsed, 1e-9)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Consistency checker for dat/ and metadat/.
+#
+#     datcheck.py [--jobs N] [--root DIR] [SYSTEM...]
+#
+# For every system the game lists (dat/<System>.dat, metadat/no-intro,
+# redump, tosec, ... as listed in rdbbuild.GAME_LISTS) are indexed first, on
+# the key rdbbuild merges the games of the system on (rdbbuild.MATCH_KEYS,
+# usually the ROM crc). Every category DAT of the system (genre, publisher,
+# releaseyear, ...) is then streamed against that index, and
+#   orphan      a category entry without the key, or whose key is in none
+#               of the game lists, so it ends up in a record of its own
+#   duplicate   a crc shared by games of different names in the game lists,
+#               or a key listed twice in one category DAT
+#   conflict    two different values for the same field of one key, e.g.
+#               two releaseyears for one crc
+# are reported as JSON lines on stdout, with a summary on stderr.
+#
+# Every DAT is read with clrmamepro.parse(), the fields of a game are the
+# ones rdbbuild.game_fields() maps, and systems are checked in parallel.
+
+import argparse
+import json
+import mmap
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import clrmamepro
+import rdbbuild
+
+
+# Fields that identify a game rather than describe it
+KEY_FIELDS = {'name', 'comment', 'description', 'rom.name', 'rom.size', 'rom.crc', 'rom.md5', 'rom.sha1'}
+
+Key = Tuple[str, str]
+Issue = Dict[str, object]
+
+
+def games(path: str) -> Iterator[Tuple[int, Dict[str, str]]]:
+    """Yield (line, fields) for every game of a DAT
+
+    The fields are the ones rdbbuild.game_fields() maps. The DAT is memory
+    mapped and lines are counted over the map as the stanzas go by.
+    """
+    if rdbbuild.is_xml(path):
+        return
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            line = 1
+            last = 0
+            for stanza in clrmamepro.parse(mm):
+                line += mm[last:stanza.start].count(b'\n')
+                if stanza.tag in rdbbuild.GAME_TAGS:
+                    yield line, rdbbuild.game_fields(stanza)
+                line += stanza.raw.count(b'\n')
+                last = stanza.end
+
+
+def _key_text(key: Key) -> str:
+    return '%s:%s' % key
+
+
+def is_game_list(root: str, path: str) -> bool:
+    """Tell whether <path> lists games rather than metadata about them"""
+    parts = os.path.relpath(path, root).split(os.sep)
+    return parts[0] == 'dat' or (parts[0] == 'metadat' and len(parts) > 2 and parts[1] in rdbbuild.GAME_LISTS)
+
+
+def check_system(job: Tuple[str, str, List[str]]) -> Tuple[str, int, List[Issue]]:
+    """Check one system; returns (system, games read, issues)"""
+    root, system, inputs = job
+    issues: List[Issue] = []
+    read = 0
+
+    def report(kind: str, path: str, line: int, key: Optional[Key], message: str) -> None:
+        issue: Issue = {'system': system, 'issue': kind, 'path': os.path.relpath(path, root), 'line': line}
+        if key is not None:
+            issue['key'] = _key_text(key)
+        issue['message'] = message
+        issues.append(issue)
+
+    field = '/'.join(rdbbuild.MATCH_KEYS.get(system, rdbbuild.CRC_KEY))
+    known: Set[str] = set()
+    crc_names: Dict[str, Tuple[str, str, int]] = {}
+    lists = [path for path in inputs if is_game_list(root, path)]
+    categories = [path for path in inputs if not is_game_list(root, path)]
+
+    try:
+        for path in lists:
+            for line, fields in games(path):
+                read += 1
+                crc = fields.get('rom.crc')
+                name = fields.get('name') or fields.get('comment')
+                if crc:
+                    first = crc_names.setdefault(crc, (name, path, line))
+                    if name and first[0] and first[0] != name:
+                        report('duplicate', path, line, ('rom.crc', crc),
+                               '%s has the crc of %s (%s:%d)' % (name, first[0], os.path.relpath(first[1], root), first[2]))
+                key = rdbbuild.match_key(system, fields)
+                if key is not None:
+                    known.add(key)
+
+        if not lists:
+            # Usually a misspelled system; one report per file is enough
+            for path in categories:
+                report('orphan', path, 0, None, 'no game list for %s' % system)
+            return system, read, issues
+
+        values: Dict[Tuple[Key, str], Tuple[str, str, int]] = {}
+        for path in categories:
+            seen: Dict[Key, int] = {}
+            for line, fields in games(path):
+                read += 1
+                value = rdbbuild.match_key(system, fields)
+                if value is None:
+                    report('orphan', path, line, None, 'entry without %s' % field)
+                    continue
+                key = field, value
+                if value not in known:
+                    report('orphan', path, line, key, '%s is in no game list' % (fields.get('comment') or fields.get('name') or value))
+                if key in seen:
+                    report('duplicate', path, line, key, 'also listed on line %d' % seen[key])
+                else:
+                    seen[key] = line
+                for name, text in fields.items():
+                    if name in KEY_FIELDS:
+                        continue
+                    first = values.setdefault((key, name), (text, path, line))
+                    if first[0] != text:
+                        report('conflict', path, line, key, '%s %r, but %r in %s:%d' % (
+                            name, text, first[0], os.path.relpath(first[1], root), first[2]))
+    except (clrmamepro.DatError, OSError) as e:
+        report('error', path, 0, None, str(e))
+    return system, read, issues
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Check dat/ and metadat/ for orphans, duplicates and conflicts')
+    parser.add_argument('systems', nargs='*', help='systems to check (default: all)')
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                        help='repository root holding dat/ and metadat/')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    root = os.path.abspath(args.root)
+    all_inputs = rdbbuild.find_all_inputs(root)
+    systems = args.systems or sorted(all_inputs)
+    # The largest systems go first so they do not end up last in the pool
+    jobs = sorted(((root, system, all_inputs.get(system, [])) for system in systems),
+                  key=lambda job: -sum(os.path.getsize(path) for path in job[2]))
+    if args.jobs > 1 and len(jobs) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        results: Iterator = executor.map(check_system, jobs)
+    else:
+        executor = None
+        results = map(check_system, jobs)
+
+    counts: Dict[str, int] = {}
+    files = sum(len(job[2]) for job in jobs)
+    read = 0
+    try:
+        for system, n, issues in results:
+            read += n
+            for issue in issues:
+                counts[issue['issue']] = counts.get(issue['issue'], 0) + 1
+                print(json.dumps(issue, ensure_ascii=False))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print('%d systems, %d files, %d games checked in %.2fs; %s' % (
+        len(jobs), files, read, time.perf_counter() - began,
+        ', '.join('%d %s' % (n, kind) for kind, n in sorted(counts.items())) or 'no issues'), file=sys.stderr)
+    return 1 if counts else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
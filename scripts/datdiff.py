@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+
+# Changelog of two versions of ClrMamePro DATs.
+#
+#     datdiff.py [--key crc|sha1|serial] [--format jsonl|changelog] OLD.dat NEW.dat
+#     datdiff.py --from REV [--to REV] [--jobs N] [PATH...]
+#
+# Games are matched on a key, by default the crc of their first ROM, else
+# their serial, else their name. With
+# --key sha1 the sha1 of the first ROM comes first, with --key serial the
+# serial. Every game found in both versions under the same key and the same
+# name is `changed` if any of its fields differ, one found under the same key
+# with another name is `renamed`, and the rest are `added` or `removed`.
+#
+# Both versions are streamed: their games are reduced to (key, name, text)
+# records, sorted in runs of --run-size records that are spilled to temporary
+# files when there is more than one, and merge-joined on their keys. Memory
+# is bounded by the run size, not by the size of the DATs; runs that are
+# already in key order are read back one after the other rather than merged.
+# Games are only tokenized when their text differs between the versions.
+#
+# With --from, the DATs below PATH (default: dat and metadat) that git says
+# differ between the two revisions (or between REV and the working tree,
+# without --to) are diffed in parallel, reading old versions straight out of
+# git, so refreshing a few DATs of metadat/ diffs in seconds:
+#
+#     datdiff.py --from HEAD~1 --format changelog metadat/no-intro
+#
+# Changes are written as JSON lines, or with --format changelog as a list per
+# file; a summary goes to stderr.
+
+import argparse
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+import clrmamepro
+import datcheck
+import rdbbuild
+
+
+SHA1 = re.compile(rb'\bsha1[ \t\r\n]+"?([0-9A-Fa-f]+)')
+
+# Records sorted in memory at once
+RUN_SIZE = 100000
+
+# Records pickled together when a run is spilled
+SPILL_BATCH = 1024
+
+KEY_VALUES = {
+    'sha1': lambda fields: fields.get('rom.sha1', '').lower(),
+    'crc': lambda fields: fields.get('rom.crc', '').upper(),
+    'serial': lambda fields: fields.get('serial') or fields.get('rom.serial'),
+    'name': lambda fields: fields.get('name') or fields.get('comment'),
+}
+
+KEY_ORDERS = {
+    'crc': ('crc', 'serial', 'name'),
+    'sha1': ('sha1', 'crc', 'serial', 'name'),
+    'serial': ('serial', 'crc', 'name'),
+}
+
+KINDS = ('added', 'removed', 'renamed', 'changed')
+
+Key = Tuple[str, str]
+# (key, name, tag, text of the game)
+Record = Tuple[Key, str, str, bytes]
+Change = Dict[str, object]
+# A plain path, (root, revision, path) for a file in git, or None for a missing file
+Version = Union[None, str, Tuple[str, str, str]]
+
+
+def flatten(game: clrmamepro.Stanza) -> Dict[str, str]:
+    """Return the fields of a game as a flat dict
+
+    Nested groups are prefixed with their tag, `rom.crc`, and repeated keys
+    are numbered from the second one on, `rom[2].crc`.
+    """
+    fields: Dict[str, str] = {}
+    seen: Dict[str, int] = {}
+    for key, value in game.items:
+        n = seen[key] = seen.get(key, 0) + 1
+        name = key if n == 1 else '%s[%d]' % (key, n)
+        if isinstance(value, clrmamepro.Stanza):
+            inner: Dict[str, int] = {}
+            for sub, sub_value in value.items:
+                if isinstance(sub_value, str):
+                    m = inner[sub] = inner.get(sub, 0) + 1
+                    fields['%s.%s' % (name, sub if m == 1 else '%s[%d]' % (sub, m))] = sub_value
+        else:
+            fields[name] = value
+    return fields
+
+
+def game_key(fields: Dict[str, str], order: Tuple[str, ...]) -> Optional[Key]:
+    for kind in order:
+        value = KEY_VALUES[kind](fields)
+        if value:
+            return kind, value
+    return None
+
+
+def key_fields(raw: bytes) -> Dict[str, str]:
+    """Return the name (or comment), serial and first ROM crc and sha1 of a game, like datcheck.games()"""
+    fields = {}
+    m = datcheck.NAME.search(raw)
+    if m:
+        fields[m.group(1).decode('ascii')] = (m.group(2) or m.group(3) or b'').decode('utf-8', 'surrogateescape')
+    m = datcheck.CRC.search(raw)
+    if m:
+        fields['rom.crc'] = m.group(1).decode('ascii')
+    if b'serial' in raw:
+        m = datcheck.SERIAL.search(raw)
+        if m:
+            fields['serial'] = (m.group(1) or m.group(2)).decode('utf-8', 'surrogateescape')
+    if b'sha1' in raw:
+        m = SHA1.search(raw)
+        if m:
+            fields['rom.sha1'] = m.group(1).decode('ascii')
+    return fields
+
+
+def records(f: BinaryIO, order: Tuple[str, ...]) -> Iterator[Record]:
+    """Yield the record of every game of the DAT <f>; XML files have none"""
+    if f.peek(64)[:64].lstrip().startswith(b'<'):
+        return
+    for stanza in clrmamepro.parse(f):
+        if stanza.tag not in rdbbuild.GAME_TAGS:
+            continue
+        fields = key_fields(stanza.raw)
+        key = game_key(fields, order)
+        if key is not None:
+            yield key, fields.get('name') or fields.get('comment') or '', stanza.tag, stanza.raw
+
+
+def _spill(run: List[Record]) -> BinaryIO:
+    f = tempfile.TemporaryFile()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    for start in range(0, len(run), SPILL_BATCH):
+        pickler.dump(run[start:start + SPILL_BATCH])
+    f.seek(0)
+    return f
+
+
+def _read_run(f: BinaryIO) -> Iterator[Record]:
+    with f:
+        unpickler = pickle.Unpickler(f)
+        while True:
+            try:
+                batch = unpickler.load()
+            except EOFError:
+                return
+            yield from batch
+
+
+def sort_records(source: Iterator[Record], run_size: int = RUN_SIZE) -> Iterator[Record]:
+    """Yield the records of <source> sorted, holding at most <run_size> of them in memory"""
+    runs: List[Tuple[BinaryIO, Record, Record]] = []
+    run: List[Record] = []
+    try:
+        for record in source:
+            run.append(record)
+            if len(run) >= run_size:
+                run.sort()
+                runs.append((_spill(run), run[0], run[-1]))
+                run = []
+        run.sort()
+        if not runs:
+            yield from run
+            return
+        if run:
+            runs.append((_spill(run), run[0], run[-1]))
+            run = []
+        readers = [_read_run(f) for f, _, _ in runs]
+        if all(runs[i][2] <= runs[i + 1][1] for i in range(len(runs) - 1)):
+            yield from itertools.chain.from_iterable(readers)
+        else:
+            yield from heapq.merge(*readers)
+    finally:
+        for f, _, _ in runs:
+            f.close()
+
+
+def _groups(sorted_records: Iterator[Record]) -> Iterator[Tuple[Key, List[Record]]]:
+    for key, group in itertools.groupby(sorted_records, key=lambda record: record[0]):
+        yield key, list(group)
+
+
+def _key_text(key: Key) -> str:
+    return '%s:%s' % key
+
+
+def _changes(old: Record, new: Record) -> Dict[str, List[Optional[str]]]:
+    """Return {field: [old value, new value]} of the fields that differ, name aside"""
+    before = flatten(clrmamepro.Stanza(old[2], 0, len(old[3]), old[3]))
+    after = flatten(clrmamepro.Stanza(new[2], 0, len(new[3]), new[3]))
+    return {field: [before.get(field), after.get(field)]
+            for field in sorted(before.keys() | after.keys())
+            if field != 'name' and before.get(field) != after.get(field)}
+
+
+def _pair(key: Key, old: List[Record], new: List[Record]) -> Iterator[Change]:
+    """Match the games sharing a key: same names first, then in order"""
+    text = _key_text(key)
+    unmatched = []
+    matched = set()
+    names: Dict[str, List[int]] = {}
+    for i, record in enumerate(old):
+        names.setdefault(record[1], []).append(i)
+    for record in new:
+        same = names.get(record[1])
+        if same:
+            i = same.pop(0)
+            matched.add(i)
+            # Only games whose text differs are tokenized, and changed only if a field differs
+            if old[i][3] != record[3]:
+                changes = _changes(old[i], record)
+                if changes:
+                    yield {'kind': 'changed', 'key': text, 'name': record[1], 'changes': changes}
+        else:
+            unmatched.append(record)
+    left = [record for i, record in enumerate(old) if i not in matched]
+    for before, after in zip(left, unmatched):
+        yield {'kind': 'renamed', 'key': text, 'name': after[1], 'old_name': before[1],
+               'changes': _changes(before, after)}
+    for record in left[len(unmatched):]:
+        yield {'kind': 'removed', 'key': text, 'name': record[1]}
+    for record in unmatched[len(left):]:
+        yield {'kind': 'added', 'key': text, 'name': record[1]}
+
+
+def diff_records(old: Iterator[Record], new: Iterator[Record]) -> Iterator[Change]:
+    """Merge-join two sorted record streams into the changes from <old> to <new>"""
+    old_groups, new_groups = _groups(old), _groups(new)
+    a, b = next(old_groups, None), next(new_groups, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            for record in a[1]:
+                yield {'kind': 'removed', 'key': _key_text(a[0]), 'name': record[1]}
+            a = next(old_groups, None)
+        elif a is None or b[0] < a[0]:
+            for record in b[1]:
+                yield {'kind': 'added', 'key': _key_text(b[0]), 'name': record[1]}
+            b = next(new_groups, None)
+        else:
+            if a[1] != b[1]:
+                yield from _pair(a[0], a[1], b[1])
+            a, b = next(old_groups, None), next(new_groups, None)
+
+
+@contextlib.contextmanager
+def open_version(version: Version) -> Iterator[Optional[BinaryIO]]:
+    """Open a version of a DAT for reading; None for a missing one"""
+    if version is None:
+        yield None
+        return
+    if isinstance(version, str):
+        with open(version, 'rb') as f:
+            yield f
+        return
+    root, rev, path = version
+    proc = subprocess.Popen(['git', '-C', root, 'cat-file', 'blob', '%s:%s' % (rev, path)], stdout=subprocess.PIPE)
+    try:
+        yield proc.stdout
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode:
+        raise OSError('git cat-file %s:%s failed' % (rev, path))
+
+
+def diff(old: Version, new: Version, key: str = 'crc', run_size: int = RUN_SIZE) -> Iterator[Change]:
+    """Yield the changes between two versions of a DAT"""
+    order = KEY_ORDERS[key]
+    with open_version(old) as fold, open_version(new) as fnew:
+        old_records = sort_records(records(fold, order), run_size) if fold is not None else iter(())
+        new_records = sort_records(records(fnew, order), run_size) if fnew is not None else iter(())
+        yield from diff_records(old_records, new_records)
+
+
+def diff_file(job: Tuple[str, Version, Version, str, int]) -> Tuple[str, List[Change], Optional[str]]:
+    """Diff one DAT; returns (label, changes, error)"""
+    label, old, new, key, run_size = job
+    try:
+        return label, list(diff(old, new, key, run_size)), None
+    except (OSError, clrmamepro.DatError) as e:
+        return label, [], str(e)
+
+
+def changed_files(root: str, old: str, new: Optional[str], paths: List[str]) -> List[Tuple[str, Version, Version]]:
+    """Return (path, old version, new version) of the DATs below <paths> that differ between two revisions
+
+    Without <new>, the working tree is compared to <old>.
+    """
+    command = ['git', '-C', root, 'diff', '--name-status', '-z', '--no-renames', old]
+    if new is not None:
+        command.append(new)
+    output = subprocess.run(command + ['--'] + paths, stdout=subprocess.PIPE, check=True).stdout
+    fields = output.split(b'\0')
+    files = []
+    for status, path in zip(fields[0::2], fields[1::2]):
+        path = path.decode('utf-8', 'surrogateescape')
+        if not path.endswith('.dat'):
+            continue
+        before = (root, old, path) if status != b'A' else None
+        if status == b'D':
+            after = None
+        elif new is not None:
+            after = (root, new, path)
+        else:
+            after = os.path.join(root, path)
+        files.append((path, before, after))
+    return files
+
+
+def changelog(label: str, changes: List[Change]) -> Iterator[str]:
+    yield label
+    for change in changes:
+        kind = change['kind']
+        if kind == 'added':
+            yield '  + %s [%s]' % (change['name'], change['key'])
+        elif kind == 'removed':
+            yield '  - %s [%s]' % (change['name'], change['key'])
+        else:
+            if kind == 'renamed':
+                yield '  ~ %s -> %s [%s]' % (change['old_name'], change['name'], change['key'])
+            else:
+                yield '  * %s [%s]' % (change['name'], change['key'])
+            for field, (before, after) in change['changes'].items():
+                yield '      %s: %s -> %s' % (field, before, after)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='List the games added, removed, renamed and changed between two DATs')
+    parser.add_argument('paths', nargs='*',
+                        help='OLD and NEW DAT, or with --from the paths to compare (default: dat metadat)')
+    parser.add_argument('--from', dest='rev_from', metavar='REV', help='compare the DATs of this git revision')
+    parser.add_argument('--to', dest='rev_to', metavar='REV', help='to this one (default: the working tree)')
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                        help='repository root for --from')
+    parser.add_argument('--key', choices=sorted(KEY_ORDERS), default='crc',
+                        help='what games are matched on first (default: %(default)s)')
+    parser.add_argument('--format', choices=('jsonl', 'changelog'), default='jsonl',
+                        help='output format (default: %(default)s)')
+    parser.add_argument('--run-size', type=int, default=RUN_SIZE,
+                        help='records sorted in memory at once (default: %(default)s)')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    if args.rev_from is not None:
+        try:
+            files = changed_files(args.root, args.rev_from, args.rev_to, args.paths or ['dat', 'metadat'])
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(e, file=sys.stderr)
+            return 1
+    elif args.rev_to is not None or len(args.paths) != 2:
+        parser.error('give OLD and NEW, or --from REV')
+    else:
+        files = [('%s -> %s' % tuple(args.paths), args.paths[0], args.paths[1])]
+    jobs = [(label, old, new, args.key, args.run_size) for label, old, new in files]
+
+    if args.jobs > 1 and len(jobs) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        results: Iterator = executor.map(diff_file, jobs)
+    else:
+        executor = None
+        results = map(diff_file, jobs)
+
+    counts = dict.fromkeys(KINDS, 0)
+    failed = 0
+    try:
+        for label, changes, error in results:
+            if error is not None:
+                print('%s: %s' % (label, error), file=sys.stderr)
+                failed += 1
+                continue
+            for change in changes:
+                counts[change['kind']] += 1
+            if args.format == 'changelog':
+                if changes:
+                    print('\n'.join(changelog(label, changes)))
+            else:
+                for change in changes:
+                    change['file'] = label
+                    print(json.dumps(change, ensure_ascii=False))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print('%d files, %s, %d failed in %.2fs' % (
+        len(jobs), ', '.join('%d %s' % (counts[kind], kind) for kind in KINDS), failed,
+        time.perf_counter() - began), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,11 +2,19 @@
 
 # Copyright (C) 2021 David Guillen Fandos
 
-# Parses a CHT file and attempts to decrypt any cheats that might be encrypted
-# Will just copy the contents should the cheats be unencrypted.
+# Parses CHT files and attempts to decrypt any cheats that might be encrypted
+# Files without encrypted cheats are left alone.
 # This will effectively remove any master cheat if it's only used to encrypt
+#
+# Accepts any number of files, directories and glob patterns, for instance
+#   gba-cht-decrypt.py "cht/Nintendo - Game Boy Advance"
+# Files are processed in parallel and only rewritten (atomically) when their
+# content changes; a summary is printed at the end.
 
-import sys, re, struct
+import sys, os, io, re, glob, shutil, tempfile, argparse, collections, functools
+from concurrent.futures import ProcessPoolExecutor
+
+import chtfile
 
 def ror(v, a):
   return ((v >> a) | (v << (32 - a))) & 0xffffffff
@@ -75,129 +83,242 @@ def next_tblidx(lfsr_state):
 
   return roll, lfsr_state
 
-def decrypt(addr, val, encdata):
-  buf = list(struct.pack(">IH", addr, val))
-  deckey, tbldata, seeds = encdata
-
-  for i in range(47, -1, -1):
-    off1 = i >> 3
-    off2 = tbldata[i] >> 3
-    bit1 = i & 7
-    bit2 = tbldata[i] & 7
-
-    # Extract the indicated bits
-    p1 = (buf[off1] >> bit1) & 1
-    p2 = (buf[off2] >> bit2) & 1
-    # Swap bits, first clear then set if necessary
-    buf[off1] &= ~(1 << bit1)
-    buf[off2] &= ~(1 << bit2)
-    buf[off1] |= (p2 << bit1)
-    buf[off2] |= (p1 << bit2)
-
-  # Xor decrypt with the calculated values
-  s1 = struct.pack(">IH", seeds[0], seeds[1] & 0xffff)
-  buf = [a ^ b for (a, b) in zip(buf, s1)]
-
-  for i in range(5):
-    buf[i] ^= (((deckey >> 8) ^ buf[i+1]) & 0xff)
-  buf[5] ^= ((deckey >> 8) & 0xff)
-
-  for i in range(5, 0, -1):
-    buf[i] ^= ((deckey ^ buf[i-1]) & 0xff)
-  buf[0] ^= (deckey & 0xff)
-
-  s2 = struct.pack(">IH", seeds[2], seeds[3] & 0xffff)
-  buf = bytes(a ^ b for (a, b) in zip(buf, s2))
-
-  return struct.unpack(">IH", buf)
-
-def calculateSeeds(addr, val):
+# Generates the 48 entry swap table for the low byte of a master code
+@functools.lru_cache(maxsize=256)
+def swap_table(seed):
   tbl = list(range(48))
-  rngstate = (val & 0xff) ^ 0x1111
-  
+  rngstate = seed ^ 0x1111
+
   # Performs some table swaps based on the code
   for i in range(80):
     p1, rngstate = next_tblidx(rngstate)
     p2, rngstate = next_tblidx(rngstate)
     tbl[p1], tbl[p2] = tbl[p2], tbl[p1]
-
+  return tuple(tbl)
+
+# Byte lookup tables applying the bit swaps of <tbl> to a 48 bit integer.
+# The code is packed big endian, so byte 0 holds the top 8 bits.
+@functools.lru_cache(maxsize=256)
+def permutation_tables(tbl):
+  # Replay the swaps on bit positions to find where every bit ends up
+  src = list(range(48))
+  for i in range(47, -1, -1):
+    src[i], src[tbl[i]] = src[tbl[i]], src[i]
+
+  tables = [[0] * 256 for _ in range(6)]
+  for dst in range(48):
+    s = src[dst]
+    tables[s >> 3][1 << (s & 7)] |= 1 << ((5 - (dst >> 3)) * 8 + (dst & 7))
+  for table in tables:
+    for v in range(3, 256):
+      low = v & -v
+      if v != low:
+        table[v] = table[low] | table[v ^ low]
+  return tuple(tuple(t) for t in tables)
+
+# The LFSR is advanced a number of times that only depends on a byte (or a
+# nibble) of the master code, so the resulting seeds are computed once.
+@functools.lru_cache(maxsize=16)
+def address_seeds(count):
   # Reinitialize the RNG now to a fixed value and draw a variable number
   rngstate = 0x4EFAD1C3
-  for i in range((addr >> 24) & 15):
+  for i in range(count):
     # Yeah this is on purpose, the output wired to the state
     rngstate, _ = lfsr_advance(rngstate)
 
   seed2, rngstate = lfsr_advance(rngstate)
   seed3, rngstate = lfsr_advance(rngstate)
+  return seed2, seed3
 
+@functools.lru_cache(maxsize=256)
+def value_seeds(count):
   # Do it again, super secure stuff :P
-  rngstate = (val >> 8) ^ 0xF254
-  for i in range(val >> 8):
+  rngstate = count ^ 0xF254
+  for i in range(count):
     # Yeah this is on purpose, the output wired to the state
     rngstate, _ = lfsr_advance(rngstate)
 
   seed0, rngstate = lfsr_advance(rngstate)
   seed1, rngstate = lfsr_advance(rngstate)
+  return seed0, seed1
 
-  return (addr, tbl, [seed0, seed1, seed2, seed3])
+def decrypt(addr, val, encdata):
+  tables, xor1, key1, key0, xor2 = encdata
+  t0, t1, t2, t3, t4, t5 = tables
+
+  # Swap the bits around, one table lookup per byte
+  x = (t0[addr >> 24] | t1[(addr >> 16) & 0xff] | t2[(addr >> 8) & 0xff] |
+       t3[addr & 0xff] | t4[val >> 8] | t5[val & 0xff])
+
+  # Xor decrypt with the calculated values. Every byte is mixed with its
+  # (still unmodified) neighbour, so each pass works on all bytes at once.
+  x ^= xor1
+  x ^= ((x << 8) & 0xFFFFFFFFFFFF) ^ key1
+  x ^= (x >> 8) ^ key0
+  x ^= xor2
 
+  return x >> 16, x & 0xffff
 
-with open(sys.argv[1]) as ifd:
-  vrs = {}
-  for line in ifd.read().split("\n"):
-    m = re.match("^([^\s=]+)\s*=\s*\"([^\"]+)\"$", line.strip())
-    if m:
-      vrs[m.group(1)] = m.group(2)
+# Returns the decryption state for a master code, memoized on the code
+@functools.lru_cache(maxsize=None)
+def calculateSeeds(addr, val):
+  tables = permutation_tables(swap_table(val & 0xff))
+  seed2, seed3 = address_seeds((addr >> 24) & 15)
+  seed0, seed1 = value_seeds(val >> 8)
+
+  deckey = addr
+  xor1 = (seed0 << 16) | (seed1 & 0xffff)
+  xor2 = (seed2 << 16) | (seed3 & 0xffff)
+  # Key bytes replicated over the 6 byte code
+  key1 = ((deckey >> 8) & 0xff) * 0x010101010101
+  key0 = (deckey & 0xff) * 0x010101010101
+  return (tables, xor1, key1, key0, xor2)
+
+
+# Splits a code into (address, value) pairs of 8+4 hex digits, written
+# either as AAAAAAAAVVVV or as AAAAAAAA+VVVV (or with a space). Returns None
+# for anything else, such as raw 8+8 codes, so that no piece of a longer
+# code is ever taken for a master code.
+def split_code(ccode):
+  tokens = [t for t in re.split(r"[+\s]+", ccode) if t]
+  pairs = []
+  i = 0
+  while i < len(tokens):
+    t = tokens[i]
+    if len(t) == 12 and ishex(t):
+      pairs.append((t[:8], t[8:]))
+      i += 1
+    elif (len(t) == 8 and ishex(t) and i + 1 < len(tokens) and
+          len(tokens[i + 1]) == 4 and ishex(tokens[i + 1])):
+      pairs.append((t, tokens[i + 1]))
+      i += 2
     else:
-      m = re.match("^([^\s=]+)\s*=\s*([^\s=]+)$", line.strip())
-      if m:
-        vrs[m.group(1)] = m.group(2)
-
-assert "cheats" in vrs
-
-outtext = "cheats = %s\n\n" % vrs["cheats"]
-encdata = None
-for i in range(int(vrs["cheats"])):
-  cdesc = vrs["cheat%d_desc" % i]
-  ccode = vrs["cheat%d_code" % i].upper()
-  cenab = vrs["cheat%d_enable" % i]
-
-  m = ccode.split("+")
-  if not all(len(x) == 12 and ishex(x) for x in m):
-    m = ccode.split(" ")
-    if not all(len(x) == 12 and ishex(x) for x in m):
-      m = re.findall("[0-9a-fA-F]{8}[\+ ][0-9a-fA-F]{4}", ccode)
-      if not m:
-        print("Bad code", ccode)
-        sys.exit(1)
-
-  ocodes = []
-  for c in m:
-    if "+" in c:
-      adrs, val = c.split("+")
-    elif " " in c:
-      adrs, val = c.split(" ")
+      return None
+  return pairs or None
+
+# Decrypts the cheats of a parsed CHT file. Returns the new file contents
+# (None if the file has no master code or some code could not be parsed),
+# whether any master code was found and the bad codes. Codes that are not
+# 8+4 codes are only bad in files with a master code; other files are left
+# alone whatever their codes look like.
+def decrypt_cht(cht):
+  if "cheats" not in cht:
+    raise ValueError("no cheats count")
+
+  out = io.BytesIO()
+  writer = chtfile.ChtWriter(out, cht.count)
+  encdata = None
+  encrypted = False
+  bad = []
+  for cheat in cht.cheats():
+    ccode = cheat["code"].upper()
+
+    m = split_code(ccode)
+    if m is None:
+      bad.append(ccode)
+      continue
+
+    ocodes = []
+    for adrs, val in m:
+      addr, val = int(adrs, 16), int(val, 16)
+      if encdata:
+        # Decode the data first!
+        addr, val = decrypt(addr, val, encdata)
+      elif adrs[0] == '9':
+        # Update encryption data, next codes must be encrypted
+        encdata = calculateSeeds(addr, val)
+        encrypted = True
+        continue  # Skip this code since it's now useless
+
+      finalcode = "%08x+%04x" % (addr, val)
+      ocodes.append(finalcode)
+
+    writer.add(cheat["desc"], "+".join(ocodes).upper())
+
+  if not encrypted:
+    return None, False, []
+  return (None if bad else out.getvalue()), encrypted, bad
+
+# Decrypts one file in place. Files without encrypted codes, with bad codes
+# or whose content would not change are left untouched.
+def process_file(path):
+  try:
+    cht = chtfile.ChtFile.load(path)
+    output, encrypted, bad = decrypt_cht(cht)
+  except KeyError as e:
+    return path, "error", ["missing %s" % e.args[0]]
+  except (OSError, ValueError) as e:
+    return path, "error", [str(e)]
+  if bad:
+    return path, "bad", bad
+  if not encrypted:
+    return path, "skipped", []
+  if output == cht.raw:
+    return path, "unchanged", []
+
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".decrypt-")
+  try:
+    with os.fdopen(fd, "wb") as ofd:
+      ofd.write(output)
+    shutil.copymode(path, tmp)
+    os.replace(tmp, path)
+  except BaseException:
+    os.unlink(tmp)
+    raise
+  return path, "changed", []
+
+# Expands files, directories (searched for *.cht) and glob patterns
+def find_files(args):
+  for arg in args:
+    if os.path.isdir(arg):
+      for root, dirs, files in os.walk(arg):
+        dirs.sort()
+        for name in sorted(files):
+          if name.lower().endswith(".cht"):
+            yield os.path.join(root, name)
+    elif os.path.exists(arg):
+      yield arg
     else:
-      adrs, val = c[:8], c[8:]
-    addr, val = int(adrs, 16), int(val, 16)
-    if encdata:
-      # Decode the data first!
-      addr, val = decrypt(addr, val, encdata)
-    elif adrs[0] == '9':
-      # Update encryption data, next codes must be encrypted
-      encdata = calculateSeeds(addr, val)
-      #print("Change code", c, encdata)
-      continue  # Skip this code since it's now useless
-
-    finalcode = "%08x+%04x" % (addr, val)
-    ocodes.append(finalcode)
-  # Update code!
-  vrs["cheat%d_code" % i] = "+".join(ocodes).upper()
-
-  outtext += 'cheat%d_desc = "%s"\n' % (i, vrs["cheat%d_desc" % i])
-  outtext += 'cheat%d_code = "%s"\n' % (i, vrs["cheat%d_code" % i])
-  outtext += 'cheat%d_enable = false\n\n' % i
-
-with open(sys.argv[1], "w") as ofd:
-  ofd.write(outtext)
-
+      yield from sorted(glob.glob(arg, recursive=True))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Decrypt encrypted GBA cheat codes in CHT files")
+  parser.add_argument("paths", nargs="+", help="CHT files, directories or glob patterns")
+  parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                      help="number of worker processes (default: all cores)")
+  parser.add_argument("-v", "--verbose", action="store_true", help="print the status of every file")
+  args = parser.parse_args(argv)
+
+  files = list(find_files(args.paths))
+  if args.jobs > 1 and len(files) > 1:
+    executor = ProcessPoolExecutor(max_workers=args.jobs)
+    results = executor.map(process_file, files, chunksize=max(1, len(files) // (args.jobs * 8)))
+  else:
+    executor = None
+    results = map(process_file, files)
+
+  counts = collections.Counter()
+  badcodes = 0
+  try:
+    for path, status, details in results:
+      counts[status] += 1
+      if status == "bad":
+        badcodes += len(details)
+        for code in details:
+          print("%s: bad code %s" % (path, code))
+      elif status == "error":
+        print("%s: error %s" % (path, details[0]))
+      elif status == "changed" or args.verbose:
+        print("%s: %s" % (path, status))
+  finally:
+    if executor is not None:
+      executor.shutdown()
+
+  print("%d files scanned, %d changed, %d unchanged, %d without encrypted codes, "
+        "%d with bad codes (%d bad codes), %d errors" % (
+        len(files), counts["changed"], counts["unchanged"], counts["skipped"],
+        counts["bad"], badcodes, counts["error"]))
+  return 1 if counts["bad"] or counts["error"] else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
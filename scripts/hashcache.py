@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# Persistent cache of file hashes, shared by the scripts that hash ROM sets.
+#
+# Entries live in a small SQLite database and are keyed on the absolute path
+# of a file. A cached entry is only used while the size, modification time
+# and inode of the file are unchanged; anything else counts as a miss and the
+# file is hashed again. Every lookup stamps the entry with the current run,
+# so prune() can drop entries for files that disappeared from a directory.
+#
+#     with HashCache(default_path()) as cache:
+#         size, crc, md5, sha1 = cache.get(path, hash_file)
+#         cache.prune(rom_dir)
+#     print(cache.summary())
+#
+# Running the module directly prints the number of entries in a cache file,
+# or prunes entries whose files no longer exist with --vacuum.
+
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+from typing import Callable, Optional, Tuple
+
+
+Hashes = Tuple[int, str, str, str]
+
+# Read size used when hashing; large reads keep the per-call overhead of the
+# digest updates negligible next to the disk.
+HASH_BUFFER_SIZE = 1 << 20
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    crc TEXT NOT NULL,
+    md5 TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    seen INTEGER NOT NULL
+)
+'''
+
+
+def hash_file(path: str) -> Hashes:
+    """Return the size, CRC32, MD5 and SHA1 of <path>, reading it only once"""
+    crc = 0
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    size = 0
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            chunk = view[:n]
+            crc = zlib.crc32(chunk, crc)
+            md5.update(chunk)
+            sha1.update(chunk)
+            size += n
+    return size, '%08X' % (crc & 0xFFFFFFFF), md5.hexdigest(), sha1.hexdigest()
+
+
+def default_path() -> str:
+    """Return the default cache location below the user's cache directory"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'libretro-database', 'hashes.sqlite')
+
+
+class HashCache:
+    """SQLite backed (path, size, mtime, inode) -> hashes cache
+
+    The cache is safe to share between threads; hashing itself happens
+    outside of the lock so worker threads only serialize on the database.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.run = time.time_ns()
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(SCHEMA)
+
+    def __enter__(self) -> 'HashCache':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+    def lookup(self, path: str, st: Optional[os.stat_result] = None) -> Optional[Hashes]:
+        """Return the cached hashes of <path>, or None if missing or stale"""
+        path = os.path.abspath(path)
+        if st is None:
+            st = os.stat(path)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT crc, md5, sha1 FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?',
+                (path, st.st_size, st.st_mtime_ns, st.st_ino)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute('UPDATE hashes SET seen = ? WHERE path = ?', (self.run, path))
+        return (st.st_size,) + row
+
+    def store(self, path: str, st: os.stat_result, hashes: Hashes) -> None:
+        """Remember <hashes> for <path> as it was when <st> was taken"""
+        size, crc, md5, sha1 = hashes
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (os.path.abspath(path), size, st.st_mtime_ns, st.st_ino, crc, md5, sha1, self.run))
+
+    def get(self, path: str, compute: Callable[[str], Hashes]) -> Hashes:
+        """Return the hashes of <path>, calling <compute> on a cache miss"""
+        st = os.stat(path)
+        hashes = self.lookup(path, st)
+        if hashes is None:
+            hashes = compute(path)
+            # Only trust the result if the file did not change while hashing
+            after = os.stat(path)
+            if (after.st_size, after.st_mtime_ns, after.st_ino) == (st.st_size, st.st_mtime_ns, st.st_ino):
+                self.store(path, st, hashes)
+        return hashes
+
+    def prune(self, directory: Optional[str] = None) -> int:
+        """Drop entries below <directory> that were not used during this run
+
+        Without a directory, drop every entry whose file no longer exists.
+        """
+        with self._lock:
+            if directory is not None:
+                prefix = os.path.join(os.path.abspath(directory), '')
+                cur = self._db.execute("DELETE FROM hashes WHERE seen < ? AND substr(path, 1, ?) = ?",
+                                       (self.run, len(prefix), prefix))
+                count = cur.rowcount
+            else:
+                gone = [(path,) for path, in self._db.execute('SELECT path FROM hashes')
+                        if not os.path.exists(path)]
+                self._db.executemany('DELETE FROM hashes WHERE path = ?', gone)
+                count = len(gone)
+            self.pruned += count
+        return count
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return 'Hash cache: %d hits, %d misses (%.1f%% hit rate), %d stale entries pruned' % (
+            self.hits, self.misses, rate, self.pruned)
+
+
+def main(argv=None) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(description='Inspect or clean the persistent hash cache')
+    parser.add_argument('cache', nargs='?', default=default_path(), help='cache file (default: %(default)s)')
+    parser.add_argument('--vacuum', action='store_true', help='drop entries whose files no longer exist')
+    args = parser.parse_args(argv)
+    with HashCache(args.cache) as cache:
+        if args.vacuum:
+            print('Pruned %d entries' % cache.prune())
+        print('%s: %d entries' % (args.cache, len(cache)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+
+# Reader for the RetroArch database (.rdb) files below rdb/.
+#
+# An .rdb file is the header `RARCHDB\0`, the big endian 64-bit offset of
+# a metadata map, then one msgpack map per game, a nil marking the end of
+# the records and finally the metadata itself (`{'count': N}`):
+#
+#     {'name': 'Doom (USA)', 'crc': b'\x1a\x2b\x3c\x4d', 'releaseyear': 1995, ...}
+#
+# RDB memory maps a file and walks the records lazily. A Record only notes
+# where each of its values starts; values are decoded when they are looked
+# up, and binary values such as crc, md5 and sha1 are returned as memoryview
+# slices of the map instead of copies.
+#
+#     with RDB('rdb/Nintendo - Game Boy.rdb') as db:
+#         for record in db:
+#             print(record['name'], record['crc'].hex())
+#
+# RDBWriter writes records back in exactly the encoding libretro-db uses, so
+# decoding and re-encoding a database reproduces it byte for byte.
+#
+# Running the module directly prints every record of a database as JSON
+# lines, with binary values in hex, or just counts and timing with --stats.
+
+import json
+import mmap
+import struct
+import sys
+import time
+
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+
+MAGIC = b'RARCHDB\0'
+HEADER_SIZE = 16
+
+Value = Union[None, bool, int, str, memoryview, list, dict]
+
+
+class RDBError(ValueError):
+    """Raised when a file is not a well formed RetroArch database"""
+
+
+_uint8 = struct.Struct('>B').unpack_from
+_uint16 = struct.Struct('>H').unpack_from
+_uint32 = struct.Struct('>I').unpack_from
+_uint64 = struct.Struct('>Q').unpack_from
+_int8 = struct.Struct('>b').unpack_from
+_int16 = struct.Struct('>h').unpack_from
+_int32 = struct.Struct('>i').unpack_from
+_int64 = struct.Struct('>q').unpack_from
+
+# Fixed size scalars: type byte -> (size of the payload, unpacker)
+_SCALARS = {
+    0xcc: (1, _uint8), 0xcd: (2, _uint16), 0xce: (4, _uint32), 0xcf: (8, _uint64),
+    0xd0: (1, _int8), 0xd1: (2, _int16), 0xd2: (4, _int32), 0xd3: (8, _int64),
+}
+
+# Strings and binaries with an explicit length: type byte -> (length size, unpacker)
+_STRINGS = {0xd9: (1, _uint8), 0xda: (2, _uint16), 0xdb: (4, _uint32)}
+_BINARIES = {0xc4: (1, _uint8), 0xc5: (2, _uint16), 0xc6: (4, _uint32)}
+_ARRAYS = {0xdc: (2, _uint16), 0xdd: (4, _uint32)}
+_MAPS = {0xde: (2, _uint16), 0xdf: (4, _uint32)}
+
+
+def _header(buf, pos: int) -> Tuple[int, int, int]:
+    """Return (kind, payload start, length) for the value at <pos>
+
+    kind is the msgpack type byte with fix* types normalized: 0x00 for a
+    positive fixint, 0xe0 for a negative one, 0xa0, 0x90 and 0x80 for
+    fixstr, fixarray and fixmap. length is the size in bytes of the payload
+    of scalars, strings and binaries and the number of entries of arrays
+    and maps.
+    """
+    t = buf[pos]
+    if t < 0x80:
+        return 0x00, pos + 1, 0
+    if t >= 0xe0:
+        return 0xe0, pos + 1, 0
+    if t >= 0xa0 and t <= 0xbf:
+        return 0xa0, pos + 1, t & 0x1f
+    if t < 0x90:
+        return 0x80, pos + 1, t & 0x0f
+    if t < 0xa0:
+        return 0x90, pos + 1, t & 0x0f
+    if t in _SCALARS:
+        return t, pos + 1, _SCALARS[t][0]
+    for table in (_STRINGS, _BINARIES, _ARRAYS, _MAPS):
+        if t in table:
+            size, unpack = table[t]
+            return t, pos + 1 + size, unpack(buf, pos + 1)[0]
+    if t in (0xc0, 0xc2, 0xc3):
+        return t, pos + 1, 0
+    raise RDBError('Unsupported msgpack type 0x%02x at offset %d' % (t, pos))
+
+
+def skip(buf, pos: int) -> int:
+    """Return the offset right after the value at <pos>"""
+    pending = 1
+    while pending:
+        pending -= 1
+        kind, start, length = _header(buf, pos)
+        if kind == 0x80 or kind in _MAPS:
+            pending += 2 * length
+            pos = start
+        elif kind == 0x90 or kind in _ARRAYS:
+            pending += length
+            pos = start
+        else:
+            pos = start + length
+    return pos
+
+
+def decode(buf, pos: int, pairs: bool = False) -> Tuple[Value, int]:
+    """Decode the value at <pos>; returns it and the offset after it
+
+    Binary values come back as memoryview slices when <buf> is a memoryview.
+    With <pairs>, a map at <pos> is returned as a list of (key, value) pairs.
+    """
+    t = buf[pos]
+    if t < 0x80:
+        return t, pos + 1
+    if t >= 0xe0:
+        return t - 0x100, pos + 1
+    kind, start, length = _header(buf, pos)
+    if kind == 0xa0 or kind in _STRINGS:
+        end = start + length
+        return str(buf[start:end], 'utf-8', 'surrogateescape'), end
+    if kind in _BINARIES:
+        end = start + length
+        return buf[start:end], end
+    if kind in _SCALARS:
+        return _SCALARS[kind][1](buf, start)[0], start + length
+    if kind == 0xc0:
+        return None, start
+    if kind in (0xc2, 0xc3):
+        return kind == 0xc3, start
+    if kind == 0x90 or kind in _ARRAYS:
+        items = []
+        pos = start
+        for _ in range(length):
+            value, pos = decode(buf, pos)
+            items.append(value)
+        return items, pos
+    entries = []
+    pos = start
+    for _ in range(length):
+        key, pos = decode(buf, pos)
+        value, pos = decode(buf, pos)
+        entries.append((key, value))
+    return (entries if pairs else dict(entries)), pos
+
+
+_pack16 = struct.Struct('>H').pack
+_pack32 = struct.Struct('>I').pack
+_pack64 = struct.Struct('>Q').pack
+
+
+def encode(value, out: bytearray) -> None:
+    """Append <value> to <out> encoded the way libretro-db writes it
+
+    Non-negative integers always use the sized uint types (never fixints),
+    strings the smallest str type and bytes the bin types. Maps may be
+    given as dicts or as lists of (key, value) pairs, which allows the
+    repeated keys c_converter produces.
+    """
+    if type(value) is str:
+        data = value.encode('utf-8', 'surrogateescape')
+        size = len(data)
+        if size < 32:
+            out.append(0xa0 | size)
+        elif size <= 0xff:
+            out.append(0xd9)
+            out.append(size)
+        elif size <= 0xffff:
+            out += b'\xda' + _pack16(size)
+        else:
+            out += b'\xdb' + _pack32(size)
+        out += data
+    elif value is None:
+        out.append(0xc0)
+    elif value is True or value is False:
+        out.append(0xc3 if value else 0xc2)
+    elif isinstance(value, int):
+        if value < 0:
+            if value >= -0x80:
+                out += b'\xd0' + struct.pack('>b', value)
+            elif value >= -0x8000:
+                out += b'\xd1' + struct.pack('>h', value)
+            elif value >= -0x80000000:
+                out += b'\xd2' + struct.pack('>i', value)
+            else:
+                out += b'\xd3' + struct.pack('>q', value)
+        elif value <= 0xff:
+            out.append(0xcc)
+            out.append(value)
+        elif value <= 0xffff:
+            out += b'\xcd' + _pack16(value)
+        elif value <= 0xffffffff:
+            out += b'\xce' + _pack32(value)
+        else:
+            out += b'\xcf' + _pack64(value)
+    elif isinstance(value, str):
+        encode(str(value), out)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        size = len(value)
+        if size <= 0xff:
+            out.append(0xc4)
+            out.append(size)
+        elif size <= 0xffff:
+            out += b'\xc5' + _pack16(size)
+        else:
+            out += b'\xc6' + _pack32(size)
+        out += value
+    elif isinstance(value, (dict, list)) and (isinstance(value, dict) or all(isinstance(p, tuple) for p in value)):
+        pairs = value.items() if isinstance(value, dict) else value
+        size = len(value)
+        if size < 16:
+            out.append(0x80 | size)
+        elif size <= 0xffff:
+            out += b'\xde' + _pack16(size)
+        else:
+            out += b'\xdf' + _pack32(size)
+        for k, v in pairs:
+            encode(k, out)
+            encode(v, out)
+    elif isinstance(value, (list, tuple)):
+        size = len(value)
+        if size < 16:
+            out.append(0x90 | size)
+        elif size <= 0xffff:
+            out += b'\xdc' + _pack16(size)
+        else:
+            out += b'\xdd' + _pack32(size)
+        for v in value:
+            encode(v, out)
+    else:
+        raise TypeError('cannot encode %r' % (value,))
+
+
+class Record:
+    """One game of a database, decoded on demand
+
+    `fields` maps every key to the offset of its value in the memory map.
+    """
+    __slots__ = ('db', 'offset', 'end', 'fields')
+
+    def __init__(self, db: 'RDB', offset: int, end: int, fields: Dict[str, int]):
+        self.db = db
+        self.offset = offset
+        self.end = end
+        self.fields = fields
+
+    def __repr__(self) -> str:
+        return '<Record %r at %d>' % (self.get('name'), self.offset)
+
+    def __getitem__(self, key: str) -> Value:
+        return decode(self.db.view, self.fields[key])[0]
+
+    def get(self, key: str, default=None) -> Value:
+        pos = self.fields.get(key)
+        if pos is None:
+            return default
+        return decode(self.db.view, pos)[0]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.fields
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.fields)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def keys(self) -> List[str]:
+        return list(self.fields)
+
+    def items(self) -> Iterator[Tuple[str, Value]]:
+        view = self.db.view
+        for key, pos in self.fields.items():
+            yield key, decode(view, pos)[0]
+
+    def pairs(self) -> List[Tuple[str, Value]]:
+        """Decode every (key, value) pair in file order, repeated keys included"""
+        value, _ = decode(self.db.view, self.offset, pairs=True)
+        return value
+
+    @property
+    def raw(self) -> memoryview:
+        """The encoded record, as a slice of the map"""
+        return self.db.view[self.offset:self.end]
+
+    def to_dict(self) -> Dict[str, Value]:
+        """Decode every field; binary values are copied to bytes"""
+        return {key: bytes(value) if isinstance(value, memoryview) else value
+                for key, value in self.items()}
+
+
+class RDB:
+    """A memory mapped .rdb file
+
+    Iterating yields Records in file order. Slices handed out by records
+    keep the map alive; close() releases it once none are left.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self._mmap)
+        if len(self.view) < HEADER_SIZE or self.view[:8] != MAGIC:
+            self.close()
+            raise RDBError('%s is not a RetroArch database' % path)
+        self.metadata_offset = _uint64(self.view, 8)[0]
+        if self.metadata_offset > len(self.view):
+            self.close()
+            raise RDBError('%s: metadata offset beyond the end of the file' % path)
+        self._keys: Dict[bytes, str] = {}
+
+    def __enter__(self) -> 'RDB':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.view is None:
+            return
+        self.view.release()
+        self.view = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Record values still reference the map; it is unmapped when
+            # the last of them goes away
+            pass
+
+    @property
+    def metadata(self) -> Dict[str, Value]:
+        if self.metadata_offset >= len(self.view):
+            return {}
+        value, _ = decode(self.view, self.metadata_offset)
+        return value if isinstance(value, dict) else {}
+
+    def __len__(self) -> int:
+        """The record count stored in the metadata"""
+        return self.metadata.get('count', 0)
+
+    def _record(self, pos: int) -> Optional[Record]:
+        view = self.view
+        t = view[pos]
+        if t == 0xc0:
+            return None
+        kind, start, length = _header(view, pos)
+        if kind != 0x80 and kind not in _MAPS:
+            raise RDBError('%s: expected a record at offset %d' % (self.path, pos))
+        keys = self._keys
+        mm = self._mmap
+        fields = {}
+        p = start
+        for _ in range(length):
+            t = view[p]
+            if 0xa0 <= t <= 0xbf:
+                end = p + 1 + (t & 0x1f)
+                raw = mm[p + 1:end]
+                key = keys.get(raw)
+                if key is None:
+                    key = keys[raw] = raw.decode('utf-8', 'surrogateescape')
+            else:
+                key, end = decode(view, p)
+                key = str(key)
+            fields[key] = end
+            # Inline the common value types; anything else goes to skip()
+            t = view[end]
+            if t < 0x80:
+                p = end + 1
+            elif 0xa0 <= t <= 0xbf:
+                p = end + 1 + (t & 0x1f)
+            elif t == 0xd9 or t == 0xc4:
+                p = end + 2 + view[end + 1]
+            elif t == 0xcc:
+                p = end + 2
+            elif t == 0xcd:
+                p = end + 3
+            elif t == 0xce:
+                p = end + 5
+            else:
+                p = skip(view, end)
+        return Record(self, pos, p, fields)
+
+    def __iter__(self) -> Iterator[Record]:
+        return self.records()
+
+    def records(self, start: int = HEADER_SIZE) -> Iterator[Record]:
+        """Yield the records from the byte offset <start> on"""
+        pos = start
+        while pos < self.metadata_offset:
+            record = self._record(pos)
+            if record is None:
+                return
+            yield record
+            pos = record.end
+
+    def record_at(self, offset: int) -> Record:
+        """Return the record starting at byte <offset>"""
+        record = self._record(offset)
+        if record is None:
+            raise RDBError('%s: no record at offset %d' % (self.path, offset))
+        return record
+
+
+class RDBWriter:
+    """Write an .rdb file record by record
+
+    <f> must be a seekable binary file; the metadata offset in the header is
+    filled in by close().
+    """
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.count = 0
+        self._start = f.tell()
+        f.write(MAGIC + bytes(8))
+
+    def add(self, record) -> None:
+        """Append one record, a dict or a list of (key, value) pairs"""
+        out = bytearray()
+        encode(record, out)
+        self.f.write(out)
+        self.count += 1
+
+    def close(self) -> None:
+        f = self.f
+        out = bytearray([0xc0])
+        f.write(out)
+        metadata = f.tell() - self._start
+        out = bytearray()
+        encode({'count': self.count}, out)
+        f.write(out)
+        end = f.tell()
+        f.seek(self._start + 8)
+        f.write(_pack64(metadata))
+        f.seek(end)
+
+
+def _json_value(value: Value):
+    if isinstance(value, memoryview):
+        return value.hex().upper()
+    return value
+
+
+def main(argv=None) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(description='Print the records of RetroArch databases')
+    parser.add_argument('files', nargs='+', help='.rdb files')
+    parser.add_argument('--stats', action='store_true', help='only print record counts and timing')
+    args = parser.parse_args(argv)
+
+    for path in args.files:
+        began = time.perf_counter()
+        count = 0
+        with RDB(path) as db:
+            for record in db:
+                count += 1
+                if args.stats:
+                    # Decode every field to measure a full walk
+                    for _ in record.items():
+                        pass
+                else:
+                    print(json.dumps({k: _json_value(v) for k, v in record.items()}, ensure_ascii=False))
+            declared = len(db)
+        if args.stats:
+            elapsed = time.perf_counter() - began
+            print('%s: %d records (metadata: %d) in %.3fs, %.0f records/s' % (
+                path, count, declared, elapsed, count / max(elapsed, 1e-9)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
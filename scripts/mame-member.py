@@ -1,6 +1,32 @@
+# Builds the metadat/mame-member DAT from MAME's -listxml output: one entry
+# per arcade machine, identified by a ROM whose CRC no other machine uses.
+#
+#     mame-member.py [--dom] mame.xml "MAME.dat"
+#
+# The listxml output is hundreds of MB, so by default it is read with
+# iterparse() and every machine element is dropped as soon as its compact
+# record has been extracted. --dom loads the whole tree like before.
+# --stats prints how long each phase took.
+
+import argparse
 import sys
 import codecs
-from xml.etree.cElementTree import parse as xmlparse
+import time
+from collections import Counter
+
+# Index of each field in the ROM tuples stored on Machine records
+ROM_NAME, ROM_SIZE, ROM_CRC, ROM_SHA1 = range(4)
+
+class Machine:
+    """Compact record of one machine; roms are (name, size, crc, sha1) tuples"""
+    __slots__ = ('name', 'description', 'year', 'manufacturer', 'roms')
+
+    def __init__(self, name, description, year=None, manufacturer=None, roms=()):
+        self.name = name
+        self.description = description
+        self.year = year
+        self.manufacturer = manufacturer
+        self.roms = roms
 
 def header(data):
     if data.tag == 'mame':
@@ -31,30 +57,18 @@ def machine(data):
     year = data.find('year')
     manu = data.find('manufacturer')
 
-    info = {}
-    info['name'] = name
-    info['description'] = desc
-    if year:
-        info['year'] = year.text
-    if manu:
-        info['manufacturer'] = manu.text
-
     roms = []
     for r in data.findall('rom'):
         ra = r.attrib
         if 'crc' not in ra or 'size' not in ra:
             continue
-        rinfo = {
-            'name': ra['name'],
-            'size': ra['size'],
-            'crc': ra['crc']
-        }
-        if 'sha1' in ra:
-            rinfo['sha1'] = ra['sha1']
-        roms.append(rinfo)
-    info['roms'] = roms
+        # Sizes repeat a lot, share one string object per distinct value
+        roms.append((ra['name'], sys.intern(ra['size']), ra['crc'], ra.get('sha1')))
 
-    return info
+    return Machine(name, desc,
+                   year.text if year else None,
+                   manu.text if manu else None,
+                   tuple(roms))
 
 def machines(data):
     info = {}
@@ -63,64 +77,139 @@ def machines(data):
             sys.stderr.write("Skipping non-arcade machine {}\n".format(repr(m.find('description').text)))
             continue
         minfo = machine(m)
-        info[minfo['name']] = minfo
+        info[minfo.name] = minfo
     for g in data.findall('game'):
         minfo = machine(g)
-        info[minfo['name']] = minfo
+        info[minfo.name] = minfo
     return info
 
-def crcmap(data):
-    seen = {}
-    info = {}
+def stream(source):
+    """Return the header and machines of a listxml file without building its tree
 
-    # Look for CRC collisions
-    for machine in data.items():
-        for rom in machine[1]["roms"]:
-            crc = rom['crc']
-            if crc in seen:
-                seen[crc] += 1
-            else:
-                seen[crc] = 1
+    This yields exactly what header() and machines() return for the parsed
+    document, but each top-level element is cleared once it has been turned
+    into a record, so memory use does not grow with the size of the input.
+    """
+    from xml.etree.ElementTree import iterparse
 
-    for machine in data.items():
+    info = {}
+    head = None
+    root = None
+    depth = 0
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+                if elem.tag == 'mame':
+                    head = header(elem)
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if elem.tag == 'header' and head is None:
+            head = header(root)
+        elif elem.tag == 'machine':
+            if is_arcade(elem):
+                minfo = machine(elem)
+                info[minfo.name] = minfo
+            else:
+                sys.stderr.write("Skipping non-arcade machine {}\n".format(repr(elem.find('description').text)))
+        elif elem.tag == 'game':
+            minfo = machine(elem)
+            info[minfo.name] = minfo
+        else:
+            continue
+        # Drop the element and everything below it
+        del root[:]
+    if head is None:
+        head = header(root)
+    return head, info
+
+def count_crcs(data):
+    """Return how many ROMs of all machines in <data> use each CRC"""
+    return Counter(rom[ROM_CRC] for m in data.values() for rom in m.roms)
+
+def unique_roms(data, seen):
+    """Map each machine to its last ROM whose CRC no other ROM uses
+
+    Returns a dict of crc -> (machine, rom), built in machine order. ROMs with
+    a space in their name are never picked.
+    """
+    info = {}
+    for m in data.values():
         unique = None
-        for rom in machine[1]["roms"]:
-            name = rom['name']
-            if ' ' in name:
+        for rom in m.roms:
+            if ' ' in rom[ROM_NAME]:
                 continue
-            crc = rom['crc']
-            if seen[crc] > 1:
+            if seen[rom[ROM_CRC]] > 1:
                 continue
-            unique = crc
-            continue
-        sys.stderr.write("{}: {}\n".format(unique, repr(machine[1]["description"])))
+            unique = rom
+        sys.stderr.write("{}: {}\n".format(unique[ROM_CRC] if unique else None, repr(m.description)))
         if unique is not None:
-            info[unique] = machine
-
+            info[unique[ROM_CRC]] = (m, unique)
     return info
 
+def crcmap(data):
+    return unique_roms(data, count_crcs(data))
+
 def emit(header, data, out):
     out.write('clrmamepro (\n')
     out.write('        name "{}"\n'.format(header['name']))
     out.write('        version {}\n'.format(header['version']))
     out.write(')\n\n')
 
-    for crc, game in data.items():
+    for m, rom in data.values():
         out.write('game (\n')
-        out.write(u'        name "{}"\n'.format(game[1]["description"]))
-        if 'year' in game:
-            out.write('        year "{}"\n'.format(game[1]["year"]))
-        if 'manufacturer' in game:
-            out.write(u'        developer "{}"\n'.format(game[1]["manufacturer"]))
-
-        for rom in filter(lambda r: r['crc'] == crc, game[1]["roms"]):
-            if 'sha1' in rom:
-                out.write('        rom ( name {name} size {size} crc {crc} sha1 {sha1} )\n'.format(**rom))
-            else:
-                out.write('        rom ( name {name} size {size} crc {crc} )\n'.format(**rom))
+        out.write(u'        name "{}"\n'.format(m.description))
+        if m.year is not None:
+            out.write('        year "{}"\n'.format(m.year))
+        if m.manufacturer is not None:
+            out.write(u'        developer "{}"\n'.format(m.manufacturer))
+
+        if rom[ROM_SHA1] is not None:
+            out.write('        rom ( name {} size {} crc {} sha1 {} )\n'.format(*rom))
+        else:
+            out.write('        rom ( name {} size {} crc {} )\n'.format(*rom[:ROM_SHA1]))
         out.write(')\n\n')
 
-data = xmlparse(sys.argv[1]).getroot()
-
-with codecs.open(sys.argv[2], 'w', 'utf-8') as out:
-    emit(header(data), crcmap(machines(data)), out)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate the MAME member DAT from MAME -listxml output')
+    parser.add_argument('listxml', help='output of `mame -listxml`')
+    parser.add_argument('output', help='DAT file to write')
+    parser.add_argument('--dom', action='store_true', help='load the whole XML tree instead of streaming it')
+    parser.add_argument('--stats', action='store_true', help='print the time spent in each phase')
+    args = parser.parse_args(argv)
+
+    timings = []
+    began = time.perf_counter()
+    def phase(name):
+        nonlocal began
+        now = time.perf_counter()
+        timings.append((name, now - began))
+        began = now
+
+    if args.dom:
+        from xml.etree.ElementTree import parse as xmlparse
+        data = xmlparse(args.listxml).getroot()
+        head, info = header(data), machines(data)
+    else:
+        head, info = stream(args.listxml)
+    phase('parse')
+    seen = count_crcs(info)
+    phase('collision count')
+    unique = unique_roms(info, seen)
+    phase('unique selection')
+    with codecs.open(args.output, 'w', 'utf-8') as out:
+        emit(head, unique, out)
+    phase('emit')
+
+    if args.stats:
+        for name, seconds in timings:
+            sys.stderr.write('{:<17} {:8.3f}s\n'.format(name, seconds))
+        sys.stderr.write('{:<17} {:8.3f}s  ({} machines, {} distinct CRCs, {} emitted)\n'.format(
+            'total', sum(t for _, t in timings), len(info), len(seen), len(unique)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+# Joins dat/ and every metadat/ category of a system into one merged table.
+#
+#     metadatjoin.py [--format jsonl|columns] [--output DIR] [--jobs N] [SYSTEM...]
+#
+# The rows are the games of the database rdbbuild.py builds, in the order
+# rdbbuild.merge() returns them, before they are mapped to rdb fields: every
+# metadat/**/<System>.dat (game lists, genre, publisher, releaseyear, ...) and
+# dat/<System>.dat merged on the key of the system (rdbbuild.match_key(), the
+# ROM serial falling back to the game serial for the serial systems), with
+# the names of the no-intro, redump, tosec and libretro-dats games as their
+# descriptions.
+#
+# The table is columnar: each DAT field (genre, rom.crc, serial, ...) is an
+# array of ids into a single pool of interned strings, so the thousands of
+# repeated genres, publishers and years are stored once, and the ROM crcs
+# are kept as integers in an array of their own. Games are streamed from the
+# DATs straight into the columns, a later game overwriting the fields of the
+# row its key matched, so no merged record is ever held as a dict.
+#
+# The merged records are written as JSON lines (<System>.jsonl), or with
+# --format columns as a directory of flat column files per system:
+#
+#     columns.json   row count and column names
+#     strings.bin    the interned strings, UTF-8, back to back
+#     strings.off    little endian u32 offsets of every string (count + 1)
+#     crc.i64        little endian i64 ROM crc of every row, -1 if none
+#     <field>.i32    little endian i32 string id of every row, -1 if missing
+#
+# Table.load() reads such a directory back. Without --output, the JSON
+# lines of the given systems go to stdout.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import clrmamepro
+import rdbbuild
+
+
+MISSING = -1
+
+# Columns in the order rdbbuild maps them; anything else comes after
+ORDER = {field: i for i, field in enumerate(dict.fromkeys(field for _, field, _ in rdbbuild.MAPPINGS))}
+ORDER['comment'] = len(ORDER)
+
+
+class Strings:
+    """A pool of interned strings, addressed by id"""
+
+    def __init__(self):
+        self.values: List[str] = []
+        self.ids: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, i: int) -> str:
+        return self.values[i]
+
+    def intern(self, value: str) -> int:
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+
+def _crc(value: str) -> int:
+    """Return a ROM crc as an integer, MISSING if it is not one"""
+    if len(value) == 8:
+        try:
+            return int(value, 16)
+        except ValueError:
+            pass
+    return MISSING
+
+
+def _write_array(path: str, values: array) -> None:
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    with open(path, 'wb') as f:
+        values.tofile(f)
+
+
+def _read_array(path: str, typecode: str) -> array:
+    values = array(typecode)
+    with open(path, 'rb') as f:
+        values.frombytes(f.read())
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class Table:
+    """The merged games of one system, one array of string ids per field"""
+
+    def __init__(self):
+        self.strings = Strings()
+        self.columns: Dict[str, array] = {}
+        self.crcs = array('q')
+
+    def __len__(self) -> int:
+        return len(self.crcs)
+
+    def _column(self, field: str) -> array:
+        column = self.columns.get(field)
+        if column is None:
+            column = self.columns[field] = array('i')
+        if len(column) < len(self.crcs):
+            column.extend([MISSING] * (len(self.crcs) - len(column)))
+        return column
+
+    def value(self, row: int, field: str) -> Optional[str]:
+        column = self.columns.get(field)
+        if column is None or row >= len(column) or column[row] == MISSING:
+            return None
+        return self.strings[column[row]]
+
+    def add(self, fields: Dict[str, str]) -> int:
+        """Append the fields of one game as a new row; returns the row"""
+        row = len(self.crcs)
+        self.crcs.append(MISSING)
+        self.update(row, fields)
+        return row
+
+    def update(self, row: int, fields: Dict[str, str]) -> None:
+        """Store the fields of one game in <row>, replacing the values it had"""
+        crc = fields.get('rom.crc')
+        if crc is not None:
+            self.crcs[row] = _crc(crc)
+        intern = self.strings.intern
+        for field, value in fields.items():
+            self._column(field)[row] = intern(value)
+
+    def fields(self) -> List[str]:
+        return sorted(self.columns, key=lambda field: (ORDER.get(field, len(ORDER)), field))
+
+    def records(self) -> Iterator[Dict[str, str]]:
+        """Yield every row as a dict of the fields it has"""
+        strings = self.strings.values
+        columns = [(field, self._column(field)) for field in self.fields()]
+        for row in range(len(self.crcs)):
+            record = {}
+            for field, column in columns:
+                i = column[row]
+                if i != MISSING:
+                    record[field] = strings[i]
+            yield record
+
+    def write_jsonl(self, f) -> None:
+        for record in self.records():
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write('\n')
+
+    def write_columns(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        offsets = array('I', [0])
+        with open(os.path.join(directory, 'strings.bin'), 'wb') as f:
+            for value in self.strings.values:
+                data = value.encode('utf-8', 'surrogateescape')
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+        _write_array(os.path.join(directory, 'strings.off'), offsets)
+        _write_array(os.path.join(directory, 'crc.i64'), self.crcs)
+        fields = self.fields()
+        for field in fields:
+            _write_array(os.path.join(directory, field + '.i32'), self._column(field))
+        with open(os.path.join(directory, 'columns.json'), 'w') as f:
+            json.dump({'rows': len(self), 'strings': len(self.strings), 'columns': fields}, f, indent=2)
+            f.write('\n')
+
+    @classmethod
+    def load(cls, directory: str) -> 'Table':
+        """Read a table written by write_columns()"""
+        with open(os.path.join(directory, 'columns.json')) as f:
+            info = json.load(f)
+        table = cls()
+        with open(os.path.join(directory, 'strings.bin'), 'rb') as f:
+            data = f.read()
+        offsets = _read_array(os.path.join(directory, 'strings.off'), 'I')
+        for i in range(len(offsets) - 1):
+            table.strings.intern(data[offsets[i]:offsets[i + 1]].decode('utf-8', 'surrogateescape'))
+        table.crcs = _read_array(os.path.join(directory, 'crc.i64'), 'q')
+        for field in info['columns']:
+            table.columns[field] = _read_array(os.path.join(directory, field + '.i32'), 'i')
+        return table
+
+
+def join(system: str, inputs: List[str]) -> Table:
+    """Return the table of the games rdbbuild.merge() merges from <inputs>"""
+    table = Table()
+    rows: Dict[str, int] = {}
+    for path in inputs:
+        for fields in rdbbuild.read_games(path):
+            key = rdbbuild.match_key(system, fields)
+            if key is None:
+                continue
+            row = rows.get(key)
+            if row is None:
+                rows[key] = table.add(fields)
+            else:
+                table.update(row, fields)
+    return table
+
+
+def join_system(job: Tuple[str, List[str], Optional[str], str]) -> Tuple[str, int, int, Optional[str]]:
+    """Join and export one system; returns (system, rows, strings, error)"""
+    system, inputs, output, fmt = job
+    try:
+        table = join(system, inputs)
+        if fmt == 'columns':
+            table.write_columns(os.path.join(output, system))
+        else:
+            with open(os.path.join(output, system + '.jsonl'), 'w', encoding='utf-8', errors='surrogateescape') as f:
+                table.write_jsonl(f)
+        return system, len(table), len(table.strings), None
+    except (clrmamepro.DatError, OSError) as e:
+        return system, 0, 0, str(e)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Join dat/ and metadat/ into merged per-system tables')
+    parser.add_argument('systems', nargs='*', help='systems to join (default: every system with a DAT)')
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                        help='repository root holding dat/ and metadat/')
+    parser.add_argument('--format', choices=('jsonl', 'columns'), default='jsonl', help='output format')
+    parser.add_argument('--output', help='output directory (default: JSON lines on stdout)')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    all_inputs = rdbbuild.find_all_inputs(args.root)
+    systems = args.systems or sorted(all_inputs)
+    failed = 0
+    unknown = [system for system in systems if system not in all_inputs]
+    for system in unknown:
+        print('%s: no DAT files found' % system, file=sys.stderr)
+        failed += 1
+    systems = [system for system in systems if system in all_inputs]
+
+    if args.output is None:
+        if args.format != 'jsonl':
+            parser.error('--format columns needs --output')
+        for system in systems:
+            try:
+                join(system, all_inputs[system]).write_jsonl(sys.stdout)
+            except (clrmamepro.DatError, OSError) as e:
+                print('%s: %s' % (system, e), file=sys.stderr)
+                failed += 1
+        return 1 if failed else 0
+
+    os.makedirs(args.output, exist_ok=True)
+    jobs = [(system, all_inputs[system], args.output, args.format) for system in systems]
+    if args.jobs > 1 and len(jobs) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        results: Iterator = executor.map(join_system, jobs)
+    else:
+        executor = None
+        results = map(join_system, jobs)
+    joined = rows = 0
+    try:
+        for system, count, strings, error in results:
+            if error is not None:
+                print('%s: %s' % (system, error), file=sys.stderr)
+                failed += 1
+                continue
+            joined += 1
+            rows += count
+            print('%s: %d records, %d distinct strings' % (system, count, strings))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print('%d systems joined, %d records in %.2fs, %d failed' % (
+        joined, rows, time.perf_counter() - began, failed), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
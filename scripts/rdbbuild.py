@@ -0,0 +1,639 @@
+#!/usr/bin/env python3
+
+# Builds the RetroArch databases in rdb/ straight from dat/ and metadat/,
+# without the libretro-super round trip.
+#
+#     rdbbuild.py [--jobs N] [--output DIR] [--force] [--index] [SYSTEM...]
+#
+# For every system (by default every database already in rdb/) the inputs are
+# every metadat/**/<System>.dat (game lists, genre, publisher, ...) in order
+# of their path, metadat/no-intro last, then dat/<System>.dat: the order that
+# reproduces the committed databases. Games are merged the way the libretro-db
+# c_converter merges them:
+#   - every system has a match key (MATCH_KEYS), the ROM crc unless listed,
+#     compared as the exact string of the DAT; the serial systems fall back
+#     from the ROM serial to the game serial, which the metadat/ categories
+#     use. Games without a key are left out, later inputs override the
+#     fields of the game they match;
+#   - within a game, a key given twice keeps its last value and the fields of
+#     all its ROMs are merged, later ROMs overriding earlier ones;
+#   - games of the no-intro, redump, tosec and libretro-dats lists without a
+#     description are described by their name;
+#   - hashes are converted two digits at a time: an odd last digit is dropped
+#     and a character that is not a hex digit counts as 0;
+#   - records are written newest first, except for the databases built by a
+#     later c_converter (LATER_LAYOUT), see MAPPINGS_LATER.
+#
+# Fields are mapped and ordered as in c_converter and the records are
+# encoded by libretrodb.RDBWriter, which reproduces libretro-db's encoding
+# byte for byte, so a database built from the DATs it was built from is
+# identical to the committed one. Where they differ, the DATs have been
+# updated since rdb/ was last built, except for the few values with escaped
+# quotes (LowRes NX) or quotes left open across lines (HBMAME), which
+# clrmamepro.py reads in full where c_converter cut them short. Systems are
+# built in parallel, and a database is only rewritten when its content
+# changed.
+#
+# Builds are incremental: a manifest (a small SQLite database, by default
+# next to the hash cache) records the inputs of every database with their
+# SHA-1, and the size and mtime of the database written from them. A system
+# is only rebuilt when its list of inputs, the content of one of them or the
+# database itself changed since; --force rebuilds everything. Inputs are only
+# hashed again when their size or mtime changed. The games read from every
+# input are kept too, as a pickle per content in <manifest>-games/, so a
+# system whose genre DAT changed only parses that DAT again before merging
+# and writing the database (about 0.5s for Sega - Mega Drive - Genesis,
+# against 1s without).
+#
+# With --index, the sorted sidecar index of rdbindex.py (<System>.idx) is
+# written next to every database and kept up to date with it.
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import clrmamepro
+import libretrodb
+import rdbindex
+
+
+# Bumped whenever the output of a build changes, which invalidates the manifest
+VERSION = 3
+
+STRING, INT, HEX, BINARY = range(4)
+
+# (rdb key, DAT field, type) in the order c_converter writes them. serial is
+# taken from both the game and its ROM, so it may appear twice in a record.
+MAPPINGS = [
+    ('name', 'name', STRING),
+    ('description', 'description', STRING),
+    ('genre', 'genre', STRING),
+    ('achievements', 'achievements', INT),
+    ('category', 'category', STRING),
+    ('language', 'language', STRING),
+    ('region', 'region', STRING),
+    ('score', 'score', STRING),
+    ('media', 'media', STRING),
+    ('controls', 'controls', STRING),
+    ('artstyle', 'artstyle', STRING),
+    ('gameplay', 'gameplay', STRING),
+    ('narrative', 'narrative', STRING),
+    ('pacing', 'pacing', STRING),
+    ('perspective', 'perspective', STRING),
+    ('setting', 'setting', STRING),
+    ('visual', 'visual', STRING),
+    ('vehicular', 'vehicular', STRING),
+    ('rom_name', 'rom.name', STRING),
+    ('size', 'rom.size', INT),
+    ('users', 'users', INT),
+    ('releasemonth', 'releasemonth', INT),
+    ('releaseyear', 'releaseyear', INT),
+    ('rumble', 'rumble', INT),
+    ('analog', 'analog', INT),
+    ('famitsu_rating', 'famitsu_rating', INT),
+    ('edge_rating', 'edge_rating', INT),
+    ('edge_issue', 'edge_issue', INT),
+    ('edge_review', 'edge_review', STRING),
+    ('enhancement_hw', 'enhancement_hw', STRING),
+    ('barcode', 'barcode', STRING),
+    ('esrb_rating', 'esrb_rating', STRING),
+    ('elspa_rating', 'elspa_rating', STRING),
+    ('pegi_rating', 'pegi_rating', STRING),
+    ('cero_rating', 'cero_rating', STRING),
+    ('franchise', 'franchise', STRING),
+    ('developer', 'developer', STRING),
+    ('publisher', 'publisher', STRING),
+    ('origin', 'origin', STRING),
+    ('coop', 'coop', INT),
+    ('tgdb_rating', 'tgdb_rating', INT),
+    ('crc', 'rom.crc', HEX),
+    ('md5', 'rom.md5', HEX),
+    ('sha1', 'rom.sha1', HEX),
+    ('serial', 'serial', BINARY),
+    ('serial', 'rom.serial', BINARY),
+]
+
+# The databases built by a later c_converter (LATER_LAYOUT) also map
+# releaseday and tags and write a single serial, the game's or else its
+# ROM's. Games with a releaseyear but no releaseday or releasemonth get 1 for
+# them, and the records are written in the order the games were first seen.
+MAPPINGS_LATER = [
+    ('name', 'name', STRING),
+    ('description', 'description', STRING),
+    ('genre', 'genre', STRING),
+    ('achievements', 'achievements', INT),
+    ('category', 'category', STRING),
+    ('language', 'language', STRING),
+    ('score', 'score', STRING),
+    ('media', 'media', STRING),
+    ('controls', 'controls', STRING),
+    ('artstyle', 'artstyle', STRING),
+    ('gameplay', 'gameplay', STRING),
+    ('narrative', 'narrative', STRING),
+    ('pacing', 'pacing', STRING),
+    ('perspective', 'perspective', STRING),
+    ('setting', 'setting', STRING),
+    ('visual', 'visual', STRING),
+    ('vehicular', 'vehicular', STRING),
+    ('rom_name', 'rom.name', STRING),
+    ('size', 'rom.size', INT),
+    ('users', 'users', INT),
+    ('releaseday', 'releaseday', INT),
+    ('releasemonth', 'releasemonth', INT),
+    ('releaseyear', 'releaseyear', INT),
+    ('rumble', 'rumble', INT),
+    ('analog', 'analog', INT),
+    ('famitsu_rating', 'famitsu_rating', INT),
+    ('edge_rating', 'edge_rating', INT),
+    ('edge_issue', 'edge_issue', INT),
+    ('edge_review', 'edge_review', STRING),
+    ('enhancement_hw', 'enhancement_hw', STRING),
+    ('barcode', 'barcode', STRING),
+    ('esrb_rating', 'esrb_rating', STRING),
+    ('elspa_rating', 'elspa_rating', STRING),
+    ('pegi_rating', 'pegi_rating', STRING),
+    ('cero_rating', 'cero_rating', STRING),
+    ('franchise', 'franchise', STRING),
+    ('developer', 'developer', STRING),
+    ('publisher', 'publisher', STRING),
+    ('region', 'region', STRING),
+    ('tags', 'tags', STRING),
+    ('origin', 'origin', STRING),
+    ('coop', 'coop', INT),
+    ('tgdb_rating', 'tgdb_rating', INT),
+    ('crc', 'rom.crc', HEX),
+    ('md5', 'rom.md5', HEX),
+    ('sha1', 'rom.sha1', HEX),
+    ('serial', 'serial', BINARY),
+]
+
+LATER_LAYOUT = {'Commodore - CD32'}
+
+HEX_DIGITS = set('0123456789abcdefABCDEF')
+
+ROM_FIELDS = {field for _, field, _ in MAPPINGS + MAPPINGS_LATER if field.startswith('rom.')}
+GAME_FIELDS = {field for _, field, _ in MAPPINGS + MAPPINGS_LATER if '.' not in field} | {'comment'}
+
+# The fields every system merges its games on, the first one a game has,
+# when it is not the ROM crc
+SERIAL_KEY = ('rom.serial', 'serial')
+MATCH_KEYS = {
+    'Lutro': ('name',),
+    'Nintendo - GameCube': SERIAL_KEY,
+    'Nintendo - Wii': SERIAL_KEY,
+    'Philips - CD-i': SERIAL_KEY,
+    'Sega - Dreamcast': SERIAL_KEY,
+    'Sega - Mega-CD - Sega CD': SERIAL_KEY,
+    'Sega - Saturn': SERIAL_KEY,
+    'Sony - PlayStation 3': SERIAL_KEY,
+    'Sony - PlayStation Portable': SERIAL_KEY,
+    'Sony - PlayStation Vita': SERIAL_KEY,
+}
+CRC_KEY = ('rom.crc',)
+
+# Directories holding the game lists themselves, as opposed to the metadata
+# (genre, publisher, ...) that refers to their games
+GAME_LISTS = ('no-intro', 'redump', 'tosec', 'libretro-dats', 'homebrew', 'hacks', 'headered',
+              'fbneo-split', 'mame-split', 'mame-nonmerged', 'mame-member', 'mame')
+
+GAME_TAGS = {'game', 'machine'}
+
+# Game lists whose games are described by their name when they have no
+# description, as they are in the databases c_converter built
+NAMED_LISTS = ('no-intro', 'redump', 'tosec', 'libretro-dats')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS inputs (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS databases (
+    path TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    inputs TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+'''
+
+Fields = Dict[str, str]
+
+
+def default_manifest() -> str:
+    """Return the default manifest file, next to the hash cache"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'libretro-database', 'rdbbuild.sqlite')
+
+
+def find_all_inputs(root: str) -> Dict[str, List[str]]:
+    """Return the DAT files of every system found below <root>, in merge order"""
+    by_name: Dict[str, List[str]] = {}
+    metadat = os.path.join(root, 'metadat')
+    found: List[Tuple[str, str]] = []
+    for directory, dirs, files in os.walk(metadat):
+        for name in files:
+            if name.endswith('.dat'):
+                path = os.path.join(directory, name)
+                found.append((os.path.relpath(path, metadat), path))
+    # no-intro is read last, so its names and ROMs win over those of the other
+    # lists for the games they share, as they do in the committed databases
+    for _, path in sorted(found, key=lambda item: (item[0].split(os.sep)[0] == 'no-intro', item[0])):
+        by_name.setdefault(os.path.basename(path), []).append(path)
+    dat = os.path.join(root, 'dat')
+    if os.path.isdir(dat):
+        for name in sorted(os.listdir(dat)):
+            if name.endswith('.dat'):
+                by_name.setdefault(name, []).append(os.path.join(dat, name))
+    return {name[:-4]: paths for name, paths in by_name.items()}
+
+
+def find_inputs(root: str, system: str) -> List[str]:
+    """Return the DAT files for <system>, in merge order"""
+    return find_all_inputs(root).get(system, [])
+
+
+def is_xml(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(64).lstrip().startswith(b'<')
+
+
+def game_fields(game: clrmamepro.Stanza) -> Fields:
+    """Return the mapped fields of a game as c_converter reads them
+
+    A key given twice keeps its last value, and the fields of all the ROMs
+    are merged, those of later ROMs overriding earlier ones.
+    """
+    fields = {}
+    for key, value in game.items:
+        if key == 'rom':
+            if isinstance(value, clrmamepro.Stanza):
+                for rom_key, rom_value in value.items:
+                    field = 'rom.' + rom_key
+                    if field in ROM_FIELDS and isinstance(rom_value, str):
+                        fields[field] = rom_value
+        elif key in GAME_FIELDS and isinstance(value, str):
+            fields[key] = value
+    return fields
+
+
+def match_key(system: str, fields: Fields) -> Optional[str]:
+    """Return the value the games of <system> are merged on, None if missing"""
+    for field in MATCH_KEYS.get(system, CRC_KEY):
+        value = fields.get(field)
+        if value is not None:
+            return value
+    return None
+
+
+def is_named_list(path: str) -> bool:
+    """Tell whether <path> is one of the NAMED_LISTS game lists"""
+    parts = os.path.normpath(os.path.abspath(path)).split(os.sep)
+    return len(parts) >= 3 and parts[-3] == 'metadat' and parts[-2] in NAMED_LISTS
+
+
+def read_games(path: str) -> Iterator[Fields]:
+    """Yield the fields of every game of <path> that is a ClrMamePro DAT"""
+    if is_xml(path):
+        return
+    named = is_named_list(path)
+    for stanza in clrmamepro.parse(path):
+        if stanza.tag not in GAME_TAGS:
+            continue
+        fields = game_fields(stanza)
+        if named and 'description' not in fields and 'name' in fields:
+            fields['description'] = fields['name']
+        yield fields
+
+
+class GameCache:
+    """The games read from every input, kept by the SHA-1 of its content
+
+    Each input has a pickle of its games in <directory>, so a rebuild only
+    parses the inputs that changed. <hashes> maps the absolute path of the
+    inputs to their SHA-1; inputs without one are always parsed.
+    """
+
+    def __init__(self, directory: str, hashes: Dict[str, str]):
+        self.directory = directory
+        self.hashes = hashes
+
+    def _path(self, path: str) -> Optional[str]:
+        sha1 = self.hashes.get(os.path.abspath(path))
+        if sha1 is None:
+            return None
+        # The description rule of read_games() depends on where the file is
+        named = '-named' if is_named_list(path) else ''
+        return os.path.join(self.directory, '%s-%d%s.pickle' % (sha1, VERSION, named))
+
+    def games(self, path: str) -> List[Fields]:
+        cached = self._path(path)
+        if cached is not None:
+            try:
+                with open(cached, 'rb') as f:
+                    return pickle.load(f)
+            except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+                pass
+        games = list(read_games(path))
+        if cached is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(games, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, cached)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        return games
+
+    def prune(self, keep: Set[str]) -> None:
+        """Remove the games of every content whose SHA-1 is not in <keep>"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.split('-', 1)[0] not in keep:
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+
+def merge(system: str, inputs: List[str], cache: Optional[GameCache] = None) -> List[Fields]:
+    """Merge the games of every input; returns the records in insertion order"""
+    records: List[Fields] = []
+    index: Dict[str, int] = {}
+    for path in inputs:
+        for fields in (cache.games(path) if cache is not None else read_games(path)):
+            key = match_key(system, fields)
+            if key is None:
+                continue
+            i = index.get(key)
+            if i is None:
+                index[key] = len(records)
+                records.append(fields)
+            else:
+                records[i].update(fields)
+    return records
+
+
+def _int(value: str) -> int:
+    """Parse leading decimal digits like strtoul(), 0 if there are none"""
+    digits = len(value) - len(value.lstrip('0123456789'))
+    return int(value[:digits]) if digits else 0
+
+
+def _hex(value: str) -> bytes:
+    """Convert a hash like c_converter: two digits per byte, others count as 0"""
+    value = value[:len(value) & ~1]
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return bytes.fromhex(''.join(c if c in HEX_DIGITS else '0' for c in value))
+
+
+def to_pairs(fields: Fields, mappings=MAPPINGS) -> List[Tuple[str, object]]:
+    """Convert merged DAT fields to the (key, value) pairs of an rdb record"""
+    pairs = []
+    for key, field, kind in mappings:
+        value = fields.get(field)
+        if value is None:
+            continue
+        if kind == INT:
+            pairs.append((key, _int(value)))
+        elif kind == HEX:
+            pairs.append((key, _hex(value)))
+        elif kind == BINARY:
+            pairs.append((key, value.encode('utf-8', 'surrogateescape')))
+        else:
+            pairs.append((key, value))
+    return pairs
+
+
+def build(system: str, inputs: List[str], cache: Optional[GameCache] = None) -> Tuple[bytes, int]:
+    """Return the database of <system> built from <inputs> and its number of records
+
+    Like c_converter, the last inserted record is written first, except in
+    the LATER_LAYOUT databases.
+    """
+    records = merge(system, inputs, cache)
+    if system in LATER_LAYOUT:
+        mappings = MAPPINGS_LATER
+        for fields in records:
+            if 'serial' not in fields and 'rom.serial' in fields:
+                fields['serial'] = fields['rom.serial']
+            if 'releaseyear' in fields:
+                fields.setdefault('releasemonth', '1')
+                fields.setdefault('releaseday', '1')
+    else:
+        mappings = MAPPINGS
+        records.reverse()
+    out = io.BytesIO()
+    writer = libretrodb.RDBWriter(out)
+    for fields in records:
+        writer.add(to_pairs(fields, mappings))
+    writer.close()
+    return out.getvalue(), writer.count
+
+
+def write_if_changed(path: str, data: bytes) -> bool:
+    """Atomically replace <path> with <data> unless it already holds it"""
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.rdb-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        else:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+def build_system(job: Tuple[str, List[str], str, bool, Optional[GameCache]]) -> Tuple[str, int, Optional[bool], Optional[str]]:
+    """Build one database (and its index); returns (system, records, changed, error)"""
+    system, inputs, output, index, cache = job
+    try:
+        if not inputs:
+            return system, 0, None, 'no DAT files found'
+        data, count = build(system, inputs, cache)
+        path = os.path.join(output, system + '.rdb')
+        changed = write_if_changed(path, data)
+        if index and (changed or not rdbindex.index_current(path)):
+            rdbindex.write_index(path)
+        return system, count, changed, None
+    except (clrmamepro.DatError, libretrodb.RDBError, OSError) as e:
+        return system, 0, None, str(e)
+
+
+def sha1_file(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """The inputs and outputs of previous builds
+
+    Without a path nothing is remembered and every database is out of date.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self._db = None
+        self.hashes: Dict[str, Tuple[int, int, str]] = {}
+        self.databases: Dict[str, Tuple[str, int, int]] = {}
+        if path is None:
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+        for path, size, mtime_ns, sha1 in self._db.execute('SELECT path, size, mtime_ns, sha1 FROM inputs'):
+            self.hashes[path] = (size, mtime_ns, sha1)
+        for path, inputs, size, mtime_ns in self._db.execute(
+                'SELECT path, inputs, size, mtime_ns FROM databases WHERE version = ?', (VERSION,)):
+            self.databases[path] = (inputs, size, mtime_ns)
+
+    def hash(self, path: str) -> str:
+        """Return the SHA-1 of <path>, hashing it only if it changed"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        entry = self.hashes.get(path)
+        if entry is not None and entry[:2] == (st.st_size, st.st_mtime_ns):
+            return entry[2]
+        sha1 = sha1_file(path)
+        self.hashes[path] = (st.st_size, st.st_mtime_ns, sha1)
+        if self._db is not None:
+            self._db.execute('INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?)',
+                             (path, st.st_size, st.st_mtime_ns, sha1))
+        return sha1
+
+    def up_to_date(self, output: str, inputs: List[Tuple[str, str]]) -> bool:
+        """Tell whether <output> was built from exactly <inputs> and not touched since"""
+        output = os.path.abspath(output)
+        entry = self.databases.get(output)
+        if entry is None or entry[0] != json.dumps(inputs):
+            return False
+        try:
+            st = os.stat(output)
+        except OSError:
+            return False
+        return (st.st_size, st.st_mtime_ns) == entry[1:]
+
+    def store(self, output: str, inputs: List[Tuple[str, str]]) -> None:
+        if self._db is None:
+            return
+        output = os.path.abspath(output)
+        st = os.stat(output)
+        self._db.execute('INSERT OR REPLACE INTO databases VALUES (?, ?, ?, ?, ?)',
+                         (output, VERSION, json.dumps(inputs), st.st_size, st.st_mtime_ns))
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+
+
+def systems_in(directory: str) -> List[str]:
+    return sorted(name[:-4] for name in os.listdir(directory) if name.endswith('.rdb'))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Build the RetroArch databases from dat/ and metadat/')
+    parser.add_argument('systems', nargs='*', help='systems to build (default: every database in the output directory)')
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                        help='repository root holding dat/ and metadat/')
+    parser.add_argument('--output', help='output directory (default: ROOT/rdb)')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--force', action='store_true', help='rebuild databases that are up to date')
+    parser.add_argument('--manifest', default=default_manifest(),
+                        help='file remembering the inputs of every database (default: %(default)s)')
+    parser.add_argument('--no-manifest', action='store_true', help='do not read or update the manifest')
+    parser.add_argument('--index', action='store_true', help='also write the sorted index of every database')
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    output = args.output or os.path.join(args.root, 'rdb')
+    os.makedirs(output, exist_ok=True)
+    systems = args.systems or systems_in(output)
+    all_inputs = find_all_inputs(args.root)
+    manifest = Manifest(None if args.no_manifest else args.manifest)
+
+    games = None if args.no_manifest else os.path.splitext(args.manifest)[0] + '-games'
+
+    jobs = []
+    hashes: Dict[str, List[Tuple[str, str]]] = {}
+    current = 0
+    for system in systems:
+        inputs = all_inputs.get(system, [])
+        cache = None
+        if inputs:
+            rdb = os.path.join(output, system + '.rdb')
+            hashes[system] = [(os.path.abspath(path), manifest.hash(path)) for path in inputs]
+            if not args.force and manifest.up_to_date(rdb, hashes[system]) and \
+                    not (args.index and not rdbindex.index_current(rdb)):
+                current += 1
+                continue
+            if games is not None:
+                cache = GameCache(games, dict(hashes[system]))
+        jobs.append((system, inputs, output, args.index, cache))
+
+    if args.jobs > 1 and len(jobs) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        results: Iterator = executor.map(build_system, jobs)
+    else:
+        executor = None
+        results = map(build_system, jobs)
+
+    failed = changed = 0
+    try:
+        for system, count, updated, error in results:
+            if error is not None:
+                print('%s: %s' % (system, error), file=sys.stderr)
+                failed += 1
+                continue
+            manifest.store(os.path.join(output, system + '.rdb'), hashes[system])
+            if updated:
+                changed += 1
+                print('Built %s.rdb (%d records)' % (system, count))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        manifest.close()
+    if games is not None:
+        GameCache(games, {}).prune({sha1 for _, _, sha1 in manifest.hashes.values()})
+    print('%d databases built, %d changed, %d up to date, %d failed in %.2fs' % (
+        len(jobs) - failed, changed, current, failed, time.perf_counter() - began))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+# Sorted secondary indexes for the RetroArch databases below rdb/.
+#
+#     rdbindex.py build [--fields crc,serial,...] [--jobs N] RDB...
+#     rdbindex.py find RDB FIELD VALUE
+#
+# The index of `rdb/<System>.rdb` is the sidecar file `rdb/<System>.idx`,
+# which holds one section per indexed field (crc, sha1, md5, serial and name
+# by default). A section is an array of fixed-width entries, each the key
+# padded with NULs to the width of the section followed by the big endian
+# 64-bit offset of its record, sorted bytewise:
+#
+#     header    b'RDBINDEX', version, section count, size and mtime of the .rdb
+#     sections  (field, key width, flags, entry count, offset) for each field
+#     entries   key | record offset, key | record offset, ...
+#
+# Integers are stored as 8 byte big endian keys. String keys longer than
+# MAX_KEY bytes are truncated, which the section flags note; matches on such
+# a prefix are checked against the record itself.
+#
+# IndexedRDB memory maps both files and answers find() with a binary search
+# of the section, decoding nothing but the matching records. An index that is
+# older than its database is ignored, and fields without an index fall back
+# to a scan of every record.
+#
+#     with IndexedRDB('rdb/Nintendo - Game Boy.rdb') as db:
+#         for record in db.find('crc', bytes.fromhex('1A2B3C4D')):
+#             print(record['name'])
+
+import argparse
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import libretrodb
+
+
+MAGIC = b'RDBINDEX'
+VERSION = 1
+
+DEFAULT_FIELDS = ('crc', 'sha1', 'md5', 'serial', 'name')
+
+# Fields whose values are binary; the command line takes them in hex
+HEX_FIELDS = {'crc', 'md5', 'sha1'}
+
+# Fields whose values are integers, as rdbbuild maps them; every other field
+# is compared as a string on the command line
+INT_FIELDS = {'achievements', 'size', 'users', 'releaseday', 'releasemonth', 'releaseyear', 'rumble', 'analog',
+              'famitsu_rating', 'edge_rating', 'edge_issue', 'coop', 'tgdb_rating'}
+
+# Longest key stored in full; longer keys are cut to this many bytes
+MAX_KEY = 64
+
+TRUNCATED = 1
+
+_HEADER = struct.Struct('>8sIIQQ')
+_SECTION = struct.Struct('>16sHHIQ')
+_OFFSET = struct.Struct('>Q')
+_INT_KEY = struct.Struct('>Q')
+
+
+def index_path(rdb_path: str) -> str:
+    """Return the sidecar index of the database <rdb_path>"""
+    return os.path.splitext(rdb_path)[0] + '.idx'
+
+
+def key_bytes(value) -> Optional[bytes]:
+    """Return the index key of a value, None for values that are not indexed"""
+    if isinstance(value, str):
+        return value.encode('utf-8', 'surrogateescape')
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 1 << 64:
+        return _INT_KEY.pack(value)
+    return None
+
+
+def build_index(rdb_path: str, fields=DEFAULT_FIELDS) -> bytes:
+    """Return the index of the database <rdb_path> for <fields>
+
+    Fields that no record has are left out.
+    """
+    st = os.stat(rdb_path)
+    keys: Dict[str, List[Tuple[bytes, int]]] = {field: [] for field in fields}
+    with libretrodb.RDB(rdb_path) as db:
+        for record in db:
+            for field in fields:
+                if field in record:
+                    key = key_bytes(record[field])
+                    if key is not None:
+                        keys[field].append((key, record.offset))
+
+    sections = []
+    for field in fields:
+        entries = keys[field]
+        if not entries:
+            continue
+        width = min(max(len(key) for key, _ in entries), MAX_KEY)
+        flags = TRUNCATED if any(len(key) > width for key, _ in entries) else 0
+        packed = sorted({key[:width].ljust(width, b'\0') + _OFFSET.pack(offset) for key, offset in entries})
+        sections.append((field, width, flags, packed))
+
+    out = bytearray(_HEADER.pack(MAGIC, VERSION, len(sections), st.st_size, st.st_mtime_ns))
+    offset = _HEADER.size + _SECTION.size * len(sections)
+    for field, width, flags, packed in sections:
+        out += _SECTION.pack(field.encode('ascii'), width, flags, len(packed), offset)
+        offset += len(packed) * (width + _OFFSET.size)
+    for _, _, _, packed in sections:
+        out += b''.join(packed)
+    return bytes(out)
+
+
+def write_index(rdb_path: str, fields=DEFAULT_FIELDS, path: Optional[str] = None) -> str:
+    """Build the index of <rdb_path> and atomically write it; returns its path"""
+    path = path or index_path(rdb_path)
+    data = build_index(rdb_path, fields)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.idx-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        else:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return path
+
+
+def index_current(rdb_path: str, path: Optional[str] = None) -> bool:
+    """Tell whether <rdb_path> has an index built from its current content"""
+    try:
+        with Index(path or index_path(rdb_path)) as index:
+            return index.current(rdb_path)
+    except (libretrodb.RDBError, OSError, ValueError):
+        return False
+
+
+class Section:
+    """The sorted entries of one indexed field"""
+    __slots__ = ('field', 'width', 'flags', 'count', 'offset', 'size')
+
+    def __init__(self, field: str, width: int, flags: int, count: int, offset: int):
+        self.field = field
+        self.width = width
+        self.flags = flags
+        self.count = count
+        self.offset = offset
+        self.size = width + _OFFSET.size
+
+    def __repr__(self) -> str:
+        return '<Section %s: %d entries of %d bytes>' % (self.field, self.count, self.width)
+
+
+class Index:
+    """A memory mapped index file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse()
+        except (libretrodb.RDBError, struct.error):
+            self.close()
+            raise
+
+    def _parse(self) -> None:
+        mm = self._mmap
+        if len(mm) < _HEADER.size:
+            raise libretrodb.RDBError('%s is not a database index' % self.path)
+        magic, version, count, self.rdb_size, self.rdb_mtime_ns = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise libretrodb.RDBError('%s is not a version %d database index' % (self.path, VERSION))
+        self.sections: Dict[str, Section] = {}
+        for i in range(count):
+            name, width, flags, entries, offset = _SECTION.unpack_from(mm, _HEADER.size + i * _SECTION.size)
+            section = Section(name.rstrip(b'\0').decode('ascii'), width, flags, entries, offset)
+            if offset + entries * section.size > len(mm):
+                raise libretrodb.RDBError('%s: section %s beyond the end of the file' % (self.path, section.field))
+            self.sections[section.field] = section
+
+    def __enter__(self) -> 'Index':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def current(self, rdb_path: str) -> bool:
+        """Tell whether the index was built from <rdb_path> as it is now"""
+        st = os.stat(rdb_path)
+        return (st.st_size, st.st_mtime_ns) == (self.rdb_size, self.rdb_mtime_ns)
+
+    def _bisect(self, section: Section, key: bytes) -> int:
+        """Return the first entry whose key is not less than <key>"""
+        mm = self._mmap
+        width = section.width
+        base = section.offset
+        size = section.size
+        lo, hi = 0, section.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = base + mid * size
+            if mm[pos:pos + width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, field: str, value) -> Tuple[List[int], bool]:
+        """Return the record offsets stored under <value> in the <field> section
+
+        The second item tells whether the offsets are only candidates that
+        share a truncated prefix with <value> and must be checked.
+        """
+        section = self.sections[field]
+        key = key_bytes(value)
+        if key is None:
+            return [], False
+        prefix = len(key) >= section.width and section.flags & TRUNCATED
+        if len(key) > section.width:
+            if not prefix:
+                return [], False
+            key = key[:section.width]
+        return self._collect(section, key.ljust(section.width, b'\0')), bool(prefix)
+
+    def lookup_prefix(self, field: str, prefix: bytes) -> List[int]:
+        """Return the record offsets of every key starting with <prefix>
+
+        Keys of truncated sections only match up to the section width, so
+        the records may have to be checked.
+        """
+        section = self.sections[field]
+        return self._collect(section, prefix[:section.width])
+
+    def _collect(self, section: Section, key: bytes) -> List[int]:
+        """Return the offsets of the entries whose key starts with <key>"""
+        mm = self._mmap
+        width = section.width
+        length = len(key)
+        offsets = []
+        i = self._bisect(section, key)
+        pos = section.offset + i * section.size
+        while i < section.count and mm[pos:pos + length] == key:
+            offsets.append(_OFFSET.unpack_from(mm, pos + width)[0])
+            i += 1
+            pos += section.size
+        return offsets
+
+
+class IndexedRDB(libretrodb.RDB):
+    """A database with its sidecar index, if there is a current one"""
+
+    def __init__(self, path: str, index: Optional[str] = None):
+        super().__init__(path)
+        self.index: Optional[Index] = None
+        index = index or index_path(path)
+        if os.path.exists(index):
+            try:
+                self.index = Index(index)
+            except (libretrodb.RDBError, ValueError):
+                return
+            if not self.index.current(path):
+                self.index.close()
+                self.index = None
+
+    def close(self) -> None:
+        if getattr(self, 'index', None) is not None:
+            self.index.close()
+            self.index = None
+        super().close()
+
+    def indexed(self, field: str) -> bool:
+        return self.index is not None and field in self.index.sections
+
+    def find(self, field: str, value) -> Iterator[libretrodb.Record]:
+        """Yield the records whose <field> equals <value>
+
+        Uses the index when it has <field>, otherwise scans every record.
+        """
+        if isinstance(value, (bytearray, memoryview)):
+            value = bytes(value)
+        if self.indexed(field):
+            offsets, check = self.index.lookup(field, value)
+            for offset in offsets:
+                record = self.record_at(offset)
+                if not check or record.get(field) == value:
+                    yield record
+            return
+        for record in self:
+            if field in record and record[field] == value:
+                yield record
+
+
+def _build(job: Tuple[str, Tuple[str, ...]]) -> Tuple[str, Optional[str]]:
+    path, fields = job
+    try:
+        write_index(path, fields)
+        return path, None
+    except (libretrodb.RDBError, OSError) as e:
+        return path, str(e)
+
+
+def _json_value(value):
+    if isinstance(value, memoryview):
+        return value.hex().upper()
+    return value
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Build and query sidecar indexes of RetroArch databases')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='write the index of every given database')
+    build.add_argument('files', nargs='+', help='.rdb files')
+    build.add_argument('--fields', default=','.join(DEFAULT_FIELDS),
+                       help='comma separated fields to index (default: %(default)s)')
+    build.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                       help='number of worker processes (default: all cores)')
+    find = commands.add_parser('find', help='print the records whose FIELD equals VALUE')
+    find.add_argument('file', help='.rdb file')
+    find.add_argument('field')
+    find.add_argument('value', help='hex for crc, md5 and sha1, an integer for size, releaseyear, ...')
+    args = parser.parse_args(argv)
+
+    if args.command == 'find':
+        if args.field in HEX_FIELDS:
+            value = bytes.fromhex(args.value)
+        elif args.field == 'serial':
+            value = args.value.encode('utf-8', 'surrogateescape')
+        elif args.field in INT_FIELDS:
+            try:
+                value = int(args.value)
+            except ValueError:
+                parser.error('%s takes an integer' % args.field)
+        else:
+            value = args.value
+        with IndexedRDB(args.file) as db:
+            if not db.indexed(args.field):
+                print('%s: no current index for %s, scanning' % (args.file, args.field), file=sys.stderr)
+            for record in db.find(args.field, value):
+                print(json.dumps({k: _json_value(v) for k, v in record.items()}, ensure_ascii=False))
+        return 0
+
+    fields = tuple(field for field in args.fields.split(',') if field)
+    jobs = [(path, fields) for path in args.files]
+    if args.jobs > 1 and len(jobs) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        results: Iterator = executor.map(_build, jobs)
+    else:
+        executor = None
+        results = map(_build, jobs)
+    failed = 0
+    try:
+        for path, error in results:
+            if error is not None:
+                print('%s: %s' % (path, error), file=sys.stderr)
+                failed += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print('%d indexes written, %d failed' % (len(jobs) - failed, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+# Runs the database cursors in cursors/ (or ad-hoc queries) against rdb/.
+#
+#     rdbquery.py [--rdb-dir DIR] [--json] [--record FILE | --expect FILE] [CURSOR|DIR...]
+#     rdbquery.py --query "{'name':glob('Street Fighter*')}" RDB
+#
+# A .dbc cursor names a database and holds a query in libretro-db syntax:
+#
+#     name = "Search SNES games starting with 'Street Fighter'"
+#     query = "{'name':glob('Street Fighter*')}"
+#     rdb = "Nintendo - Super Nintendo Entertainment System.rdb"
+#
+# A query is a map of fields to the values they must hold, where a value may
+# itself be a map (matched against a map value) or a function call:
+# equals(v), is_true(), between(low, high), glob(pattern), and(...) and
+# or(...). Literals are integers, 'strings' or "strings", b'hex' binaries,
+# true, false and nil. A query is compiled into a predicate once.
+#
+# Cursors are grouped by database, and every database is opened once (as
+# an rdbindex.IndexedRDB). A query that requires a field to equal a value,
+# or to match a glob with a literal prefix, only checks the records the
+# sidecar index yields for it, if there is one; all other queries of the
+# batch share a single pass over the records.
+#
+# By default the number of records found by every cursor is printed, with
+# --json every record. --record writes the names of the records found by
+# every cursor to a JSON file and --expect compares a run against such a
+# file, which makes the cursors usable as a regression test.
+
+import argparse
+import fnmatch
+import json
+import os
+import re
+import sys
+import time
+
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import chtfile
+import libretrodb
+import rdbindex
+
+
+Matcher = Callable[[object], bool]
+
+TOKEN = re.compile(r'''\s*(?:([{}:,()])|b'([0-9A-Fa-f]*)'|b"([0-9A-Fa-f]*)"|'([^']*)'|"([^"]*)"|(-?\d+)|([A-Za-z_]\w*))''')
+
+PUNCT, BIN_SQ, BIN_DQ, STR_SQ, STR_DQ, NUMBER, NAME = range(1, 8)
+
+CONSTANTS = {'true': True, 'false': False, 'nil': None}
+
+_MISSING = object()
+
+
+class QueryError(ValueError):
+    """Raised for a query that does not parse"""
+
+
+def _equal(a, b) -> bool:
+    """Compare like libretro-db: values of different types never match"""
+    if isinstance(a, memoryview):
+        a = bytes(a)
+    if isinstance(a, bool) or isinstance(b, bool):
+        return a is b
+    if isinstance(a, (bytes, str)) or isinstance(b, (bytes, str)):
+        return type(a) is type(b) and a == b
+    return a == b
+
+
+class _Parser:
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+
+    def error(self, message: str) -> QueryError:
+        return QueryError('%s at offset %d in %r' % (message, self.pos, self.text))
+
+    def next(self) -> Tuple[int, str]:
+        m = TOKEN.match(self.text, self.pos)
+        if m is None:
+            raise self.error('unexpected input')
+        self.pos = m.end()
+        return m.lastindex, m.group(m.lastindex)
+
+    def peek(self) -> Optional[Tuple[int, str]]:
+        if not self.text[self.pos:].strip():
+            return None
+        pos = self.pos
+        try:
+            return self.next()
+        finally:
+            self.pos = pos
+
+    def expect(self, punct: str) -> None:
+        kind, text = self.next()
+        if kind != PUNCT or text != punct:
+            raise self.error('expected %r' % punct)
+
+    def expression(self):
+        """Parse a literal, map or function call into a node"""
+        kind, text = self.next()
+        if kind == PUNCT and text == '{':
+            entries = []
+            if self.peek() == (PUNCT, '}'):
+                self.next()
+                return 'map', entries
+            while True:
+                key = self.expression()
+                if key[0] != 'value':
+                    raise self.error('map keys must be literals')
+                self.expect(':')
+                entries.append((key[1], self.expression()))
+                kind, text = self.next()
+                if kind == PUNCT and text == '}':
+                    return 'map', entries
+                if kind != PUNCT or text != ',':
+                    raise self.error("expected ',' or '}'")
+        if kind in (BIN_SQ, BIN_DQ):
+            if len(text) % 2:
+                raise self.error('odd number of hex digits')
+            return 'value', bytes.fromhex(text)
+        if kind in (STR_SQ, STR_DQ):
+            return 'value', text
+        if kind == NUMBER:
+            return 'value', int(text)
+        if kind == NAME:
+            if self.peek() == (PUNCT, '('):
+                self.next()
+                args = []
+                if self.peek() == (PUNCT, ')'):
+                    self.next()
+                    return 'call', text, args
+                while True:
+                    args.append(self.expression())
+                    kind, punct = self.next()
+                    if kind == PUNCT and punct == ')':
+                        return 'call', text, args
+                    if kind != PUNCT or punct != ',':
+                        raise self.error("expected ',' or ')'")
+            if text in CONSTANTS:
+                return 'value', CONSTANTS[text]
+            raise self.error('unknown name %r' % text)
+        raise self.error('unexpected %r' % text)
+
+
+def _literal(node, name: str):
+    if node[0] != 'value':
+        raise QueryError('%s() takes literal arguments' % name)
+    return node[1]
+
+
+def _compile(node) -> Matcher:
+    if node[0] == 'value':
+        expected = node[1]
+        return lambda value: _equal(value, expected)
+    if node[0] == 'map':
+        entries = [(key, _compile(sub)) for key, sub in node[1]]
+
+        def match_map(value) -> bool:
+            if not isinstance(value, (dict, libretrodb.Record)):
+                return False
+            for key, matcher in entries:
+                field = value.get(key, _MISSING)
+                if field is _MISSING or not matcher(field):
+                    return False
+            return True
+        return match_map
+
+    _, name, args = node
+    if name == 'equals':
+        if len(args) != 1:
+            raise QueryError('equals() takes one argument')
+        return _compile(('value', _literal(args[0], name)))
+    if name == 'is_true':
+        if args:
+            raise QueryError('is_true() takes no arguments')
+        return lambda value: value is True
+    if name == 'between':
+        if len(args) != 2:
+            raise QueryError('between() takes two arguments')
+        low, high = _literal(args[0], name), _literal(args[1], name)
+        return lambda value: isinstance(value, int) and not isinstance(value, bool) and low <= value <= high
+    if name == 'glob':
+        if len(args) != 1 or not isinstance(_literal(args[0], name), str):
+            raise QueryError('glob() takes one string')
+        pattern = re.compile(fnmatch.translate(args[0][1]))
+        return lambda value: isinstance(value, str) and pattern.match(value) is not None
+    if name in ('and', 'or'):
+        if not args:
+            raise QueryError('%s() takes at least one argument' % name)
+        matchers = [_compile(arg) for arg in args]
+        if name == 'and':
+            return lambda value: all(matcher(value) for matcher in matchers)
+        return lambda value: any(matcher(value) for matcher in matchers)
+    raise QueryError('unknown function %s()' % name)
+
+
+class Query:
+    """A compiled query; match() tells whether a record satisfies it"""
+
+    def __init__(self, text: str):
+        parser = _Parser(text)
+        node = parser.expression()
+        if parser.peek() is not None:
+            raise parser.error('trailing input')
+        self.text = text
+        self.match: Matcher = _compile(node)
+        # Fields the index can narrow down: (field, exact key or None, prefix)
+        self.keys: List[Tuple[str, object, Optional[bytes]]] = []
+        if node[0] == 'map':
+            for field, sub in node[1]:
+                if not isinstance(field, str):
+                    continue
+                if sub[0] == 'call' and sub[1] == 'equals' and len(sub[2]) == 1:
+                    sub = sub[2][0]
+                if sub[0] == 'value' and sub[1] is not None and not isinstance(sub[1], bool):
+                    self.keys.append((field, sub[1], None))
+                elif sub[0] == 'call' and sub[1] == 'glob' and sub[2][0][0] == 'value':
+                    prefix = re.match(r'[^*?\[]*', sub[2][0][1]).group()
+                    if prefix:
+                        self.keys.append((field, None, prefix.encode('utf-8', 'surrogateescape')))
+
+    def __repr__(self) -> str:
+        return '<Query %s>' % self.text
+
+    def candidates(self, db: rdbindex.IndexedRDB) -> Optional[List[int]]:
+        """Return the offsets of the only records that can match, or None
+        when no index covers the query"""
+        best = None
+        for field, value, prefix in self.keys:
+            if not db.indexed(field):
+                continue
+            if prefix is None:
+                offsets, _ = db.index.lookup(field, value)
+            else:
+                offsets = db.index.lookup_prefix(field, prefix)
+            if best is None or len(offsets) < len(best):
+                best = offsets
+        return None if best is None else sorted(set(best))
+
+
+def run(db: rdbindex.IndexedRDB, queries: List[Query]) -> Tuple[List[List[libretrodb.Record]], int]:
+    """Run every query against <db>; returns the matches of each in file order
+    and how many of the queries were answered from the index"""
+    results: List[List[libretrodb.Record]] = [[] for _ in queries]
+    scan = []
+    indexed = 0
+    for i, query in enumerate(queries):
+        offsets = query.candidates(db)
+        if offsets is None:
+            scan.append(i)
+            continue
+        indexed += 1
+        for offset in offsets:
+            record = db.record_at(offset)
+            if query.match(record):
+                results[i].append(record)
+    if scan:
+        for record in db:
+            for i in scan:
+                if queries[i].match(record):
+                    results[i].append(record)
+    return results, indexed
+
+
+class Cursor:
+    """A .dbc file: a query and the database it runs against"""
+
+    def __init__(self, path: str):
+        cht = chtfile.ChtFile.load(path)
+        self.path = path
+        self.name = cht.get('name', os.path.basename(path))
+        self.rdb = cht.get('rdb')
+        if self.rdb is None or cht.get('query') is None:
+            raise QueryError('%s: a cursor needs a query and an rdb' % path)
+        self.query = Query(cht['query'])
+
+    @property
+    def id(self) -> str:
+        return os.path.basename(self.path)
+
+
+def find_cursors(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.dbc'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def _json_value(value):
+    if isinstance(value, memoryview):
+        return value.hex().upper()
+    return value
+
+
+def _label(record: libretrodb.Record) -> str:
+    name = record.get('name')
+    if isinstance(name, str):
+        return name
+    crc = record.get('crc')
+    return crc.hex().upper() if isinstance(crc, memoryview) else '@%d' % record.offset
+
+
+def main(argv=None) -> int:
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    parser = argparse.ArgumentParser(description='Run database cursors against the RetroArch databases')
+    parser.add_argument('paths', nargs='*', help='cursor files or directories (default: cursors), or one .rdb with --query')
+    parser.add_argument('--query', help='run this query against the given database instead of cursors')
+    parser.add_argument('--rdb-dir', default=os.path.join(root, 'rdb'), help='directory of the databases (default: rdb)')
+    parser.add_argument('--json', action='store_true', help='print every record found as JSON')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--record', metavar='FILE', help='write the records found by every cursor to FILE')
+    group.add_argument('--expect', metavar='FILE', help='compare the records found with FILE')
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    if args.query is not None:
+        if len(args.paths) != 1:
+            parser.error('--query takes exactly one database')
+        try:
+            query = Query(args.query)
+        except QueryError as e:
+            print(e, file=sys.stderr)
+            return 1
+        with rdbindex.IndexedRDB(args.paths[0]) as db:
+            (records,), _ = run(db, [query])
+            for record in records:
+                print(json.dumps({k: _json_value(v) for k, v in record.items()}, ensure_ascii=False))
+        return 0
+
+    failed = 0
+    batches: Dict[str, List[Cursor]] = {}
+    for path in find_cursors(args.paths or [os.path.join(root, 'cursors')]):
+        try:
+            cursor = Cursor(path)
+        except (QueryError, OSError) as e:
+            print('%s: %s' % (path, e), file=sys.stderr)
+            failed += 1
+            continue
+        batches.setdefault(cursor.rdb, []).append(cursor)
+
+    found: Dict[str, List[str]] = {}
+    indexed = 0
+    for rdb, cursors in sorted(batches.items()):
+        try:
+            db = rdbindex.IndexedRDB(os.path.join(args.rdb_dir, rdb))
+        except (libretrodb.RDBError, OSError) as e:
+            for cursor in cursors:
+                print('%s: %s' % (cursor.path, e), file=sys.stderr)
+            failed += len(cursors)
+            continue
+        with db:
+            results, n = run(db, [cursor.query for cursor in cursors])
+            indexed += n
+            for cursor, records in zip(cursors, results):
+                found[cursor.id] = sorted(_label(record) for record in records)
+                if args.json:
+                    for record in records:
+                        print(json.dumps(dict(cursor=cursor.id, **{k: _json_value(v) for k, v in record.items()}),
+                                         ensure_ascii=False))
+                else:
+                    print('%s: %d records (%s)' % (cursor.id, len(records), cursor.name))
+
+    mismatched = 0
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as f:
+            json.dump(found, f, indent=2, sort_keys=True, ensure_ascii=False)
+            f.write('\n')
+    elif args.expect:
+        with open(args.expect, encoding='utf-8') as f:
+            expected = json.load(f)
+        for cursor in sorted(set(expected) | set(found)):
+            if expected.get(cursor) != found.get(cursor):
+                missing = set(expected.get(cursor, [])) - set(found.get(cursor, []))
+                extra = set(found.get(cursor, [])) - set(expected.get(cursor, []))
+                print('%s: %d records missing, %d unexpected' % (cursor, len(missing), len(extra)), file=sys.stderr)
+                mismatched += 1
+
+    cursors = sum(len(cursors) for cursors in batches.values())
+    print('%d cursors run on %d databases (%d from the index) in %.2fs, %d failed%s' % (
+        cursors, len(batches), indexed, time.perf_counter() - began, failed,
+        ', %d differ from %s' % (mismatched, args.expect) if args.expect else ''), file=sys.stderr)
+    return 1 if failed or mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
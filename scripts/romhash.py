@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Header-aware ROM hashing.
+#
+#     romhash.py [--jobs N] [--batch N] PATH...
+#
+# NES, Famicom Disk System, Lynx and Atari 7800 dumps are usually stored with
+# a header in front of the ROM data. metadat/headered lists them with their
+# headers, the No-Intro DATs without. hash_file() computes both sets of CRC32,
+# MD5 and SHA1 while reading a file once, through an mmap for large files:
+#
+#     header     magic                  size
+#     iNES       NES<EOF> at 0            16   Nintendo - Nintendo Entertainment System
+#     fwNES      FDS<EOF> at 0            16   Nintendo - Family Computer Disk System
+#     LNX        LYNX at 0                64   Atari - Lynx
+#     A78        ATARI7800 at 1          128   Atari - 7800
+#
+# Thousands of small files are best hashed with hash_files(), which hands
+# them to worker processes in batches instead of one by one:
+#
+#     with ProcessPoolExecutor() as executor:
+#         for result in hash_files(paths, executor):
+#             print(result.path, result.raw.crc, result.headerless and result.headerless.crc)
+#
+# Running the module prints the hashes of the given files and of the files
+# below the given directories as JSON lines.
+
+import argparse
+import collections
+import hashlib
+import json
+import mmap
+import os
+import sys
+import time
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+class Header(NamedTuple):
+    name: str
+    system: str
+    magic: bytes
+    offset: int
+    size: int
+
+
+HEADERS = (
+    Header('iNES', 'Nintendo - Nintendo Entertainment System', b'NES\x1a', 0, 16),
+    Header('fwNES', 'Nintendo - Family Computer Disk System', b'FDS\x1a', 0, 16),
+    Header('LNX', 'Atari - Lynx', b'LYNX', 0, 64),
+    Header('A78', 'Atari - 7800', b'ATARI7800', 1, 128),
+)
+
+# Files up to this size are read, larger ones mapped
+MMAP_THRESHOLD = 1 << 20
+
+# Large files are fed to the digests in slices of this size, so every byte is
+# still in the CPU cache when the second set of digests sees it
+SLICE_SIZE = 1 << 20
+
+# Files handed to a worker at once by hash_files()
+BATCH_SIZE = 64
+
+
+class Digests(NamedTuple):
+    size: int
+    crc: str
+    md5: str
+    sha1: str
+
+
+class FileHashes(NamedTuple):
+    path: str
+    raw: Optional[Digests]
+    header: Optional[str]
+    headerless: Optional[Digests]
+    error: Optional[str] = None
+
+
+def detect_header(data) -> Optional[Header]:
+    """Return the header <data> starts with, None if it has none"""
+    for header in HEADERS:
+        end = header.offset + len(header.magic)
+        if data[header.offset:end] == header.magic and len(data) > header.size:
+            return header
+    return None
+
+
+def hash_data(data) -> Tuple[Digests, Optional[Header], Optional[Digests]]:
+    """Return the hashes of <data>, its header and its hashes without it"""
+    header = detect_header(data)
+    skip = header.size if header is not None else len(data)
+    view = memoryview(data)
+    crc = body_crc = 0
+    md5, sha1 = hashlib.md5(), hashlib.sha1()
+    body_md5, body_sha1 = hashlib.md5(), hashlib.sha1()
+    for start in range(0, len(view), SLICE_SIZE):
+        chunk = view[start:start + SLICE_SIZE]
+        crc = zlib.crc32(chunk, crc)
+        md5.update(chunk)
+        sha1.update(chunk)
+        if start + len(chunk) > skip:
+            body = chunk[max(0, skip - start):]
+            body_crc = zlib.crc32(body, body_crc)
+            body_md5.update(body)
+            body_sha1.update(body)
+    raw = Digests(len(view), '%08X' % crc, md5.hexdigest(), sha1.hexdigest())
+    if header is None:
+        return raw, None, None
+    headerless = Digests(len(view) - skip, '%08X' % body_crc, body_md5.hexdigest(), body_sha1.hexdigest())
+    return raw, header, headerless
+
+
+def hash_file(path: str) -> FileHashes:
+    """Hash one file with and, if it has a header, without its header"""
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= MMAP_THRESHOLD:
+                raw, header, headerless = hash_data(f.read())
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if hasattr(m, 'madvise'):
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    raw, header, headerless = hash_data(m)
+    except (OSError, ValueError) as e:
+        return FileHashes(path, None, None, None, str(e))
+    return FileHashes(path, raw, header.name if header is not None else None, headerless)
+
+
+def hash_batch(paths: List[str]) -> List[FileHashes]:
+    return [hash_file(path) for path in paths]
+
+
+def _batches(paths: Iterable[str], size: int) -> Iterator[List[str]]:
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def hash_files(paths: Iterable[str], executor=None, batch_size: int = BATCH_SIZE) -> Iterator[FileHashes]:
+    """Yield the FileHashes of every path, in order, hashing batches of them on <executor>"""
+    if executor is None:
+        yield from map(hash_file, paths)
+        return
+    # Submit a bounded number of batches ahead so huge libraries stream through
+    ahead = 2 * (os.cpu_count() or 1)
+    pending = collections.deque()
+    for batch in _batches(paths, batch_size):
+        pending.append(executor.submit(hash_batch, batch))
+        if len(pending) > ahead:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def find_files(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Hash ROM files with and without their headers')
+    parser.add_argument('paths', nargs='+', help='files and directories to hash')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='files per worker batch (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    files = headered = errors = read = 0
+    try:
+        for result in hash_files(find_files(args.paths), executor, args.batch):
+            files += 1
+            if result.error is not None:
+                print('%s: %s' % (result.path, result.error), file=sys.stderr)
+                errors += 1
+                continue
+            read += result.raw.size
+            record = {'path': result.path}
+            record.update(result.raw._asdict())
+            if result.header is not None:
+                headered += 1
+                record['header'] = result.header
+                record['headerless'] = result.headerless._asdict()
+            print(json.dumps(record, ensure_ascii=False))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    seconds = time.perf_counter() - began
+    print('%d files, %d with headers, %d errors, %.1f MB in %.2fs (%.1f MB/s)' % (
+        files, headered, errors, read / 1e6, seconds, read / 1e6 / max(seconds, 1e-9)), file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
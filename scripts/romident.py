@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+# Identifies a ROM library against the DATs of this repository.
+#
+#     romident.py [--jobs N] [--root DIR] [--cache FILE | --no-cache] PATH...
+#
+# The ROMs of dat/*.dat, metadat/no-intro and metadat/redump are indexed in
+# memory by crc, sha1 and serial. Every file below the given paths is then
+# looked up:
+#   zip archives are not decompressed; the crc and size of every member are
+#     read from the central directory and matched on crc and size,
+#   other files are hashed in a pool of worker processes and matched on
+#     sha1, else on crc and size; the hashes of files without a header are
+#     kept in the hash cache, so a library is only read once,
+#   NES, FDS, Lynx and Atari 7800 dumps with a header are matched with it
+#     (metadat/headered), else without it (No-Intro), see romhash.py,
+#   files that match no ROM are matched on a serial in their name, such as
+#     SLUS-00594 or SLUS_005.94.
+# Empty files never match on their hashes. The index is kept in a pickle
+# next to the hash cache and only rebuilt when one of the DATs changed.
+#
+# Every file (or zip member) is written to stdout as a JSON line:
+#     {"path": ..., "member": ..., "size": ..., "crc": ..., "sha1": ...,
+#      "header": "iNES", "status": "matched", "by": "sha1", "headerless": true,
+#      "matches": [{"system": ..., "game": ..., "rom": ...}]}
+# with "status": "unmatched" and no matches when nothing was found; header
+# and headerless only appear for files with a header. A summary goes to
+# stderr.
+
+import argparse
+import json
+import os
+import pickle
+import re
+import sys
+import tempfile
+import time
+import zipfile
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import clrmamepro
+import hashcache
+import rdbbuild
+import romhash
+
+
+# Serials as they show up in file names: SLUS-00594, SLUS_005.94, SCES 12345
+NAME_SERIAL = re.compile(r'(?<![A-Za-z0-9])([A-Za-z]{4})[-_ ]?(\d{3})\.?(\d{2})(?![0-9])')
+
+# The lists of games, as opposed to the metadat/ categories
+SOURCES = ('dat', os.path.join('metadat', 'no-intro'), os.path.join('metadat', 'redump'),
+           os.path.join('metadat', 'headered'))
+
+# Bump when the pickled Index or SOURCES change
+INDEX_VERSION = 4
+
+# Bytes read to tell whether a file found in the hash cache has a header
+HEADER_PROBE = max(header.size for header in romhash.HEADERS) + 1
+
+# (system, game, rom name, size)
+Entry = Tuple[str, str, str, int]
+# (member or None, size, crc, sha1 or None)
+Hashed = Tuple[Optional[str], int, str, Optional[str]]
+# (path, zip members, file hashes, error)
+Result = Tuple[str, Optional[List[Hashed]], Optional[romhash.FileHashes], Optional[str]]
+
+
+def normalize_serial(serial: str) -> str:
+    return re.sub(r'[^0-9A-Z]', '', serial.upper())
+
+
+def index_file(path: str) -> Tuple[str, List[Tuple[Entry, str, str, Tuple[str, ...]]]]:
+    """Return the system of a DAT and an (entry, crc, sha1, serials) for each of its ROMs"""
+    system = os.path.splitext(os.path.basename(path))[0]
+    roms = []
+    for stanza in clrmamepro.parse(path):
+        if stanza.tag not in rdbbuild.GAME_TAGS:
+            continue
+        fields = rdbbuild.game_fields(stanza)
+        game = fields.get('name', '')
+        serials = [fields['serial']] if 'serial' in fields else []
+        for rom in stanza.roms:
+            if not isinstance(rom, clrmamepro.Stanza):
+                continue
+            try:
+                size = int(rom.get('size', '-1'))
+            except ValueError:
+                size = -1
+            rom_serial = rom.get('serial')
+            rom_serials = serials + [rom_serial] if isinstance(rom_serial, str) else serials
+            entry = (system, game, rom.get('name', ''), size)
+            keys = tuple(normalize_serial(part) for serial in rom_serials for part in serial.split(','))
+            roms.append((entry, rom.get('crc', '').upper(), rom.get('sha1', '').lower(), keys))
+    return system, roms
+
+
+class Index:
+    """ROMs by crc, sha1 and serial"""
+
+    def __init__(self):
+        self.crcs: Dict[int, List[Entry]] = {}
+        self.sha1s: Dict[str, List[Entry]] = {}
+        self.serials: Dict[str, List[Entry]] = {}
+        self.roms = 0
+        self.files = 0
+
+    def add(self, roms) -> None:
+        self.files += 1
+        for entry, crc, sha1, serials in roms:
+            self.roms += 1
+            if len(crc) == 8:
+                try:
+                    self.crcs.setdefault(int(crc, 16), []).append(entry)
+                except ValueError:
+                    pass
+            if len(sha1) == 40:
+                self.sha1s.setdefault(sha1, []).append(entry)
+            for serial in serials:
+                if serial:
+                    entries = self.serials.setdefault(serial, [])
+                    if entry[:2] not in [e[:2] for e in entries]:
+                        entries.append(entry)
+
+    def match(self, size: int, crc: str, sha1: Optional[str]) -> Tuple[Optional[str], List[Entry]]:
+        """Return how a file matched and the ROMs it matched"""
+        if size == 0:
+            return None, []
+        if sha1 is not None and sha1 in self.sha1s:
+            return 'sha1', self.sha1s[sha1]
+        entries = [entry for entry in self.crcs.get(int(crc, 16), ()) if entry[3] in (size, -1)]
+        if entries:
+            return 'crc', entries
+        return None, []
+
+    def match_name(self, name: str) -> Tuple[Optional[str], List[Entry]]:
+        """Match a serial in the file name <name>"""
+        for m in NAME_SERIAL.finditer(name):
+            entries = self.serials.get(normalize_serial(''.join(m.groups())))
+            if entries:
+                return 'serial', entries
+        return None, []
+
+
+def find_sources(root: str) -> List[str]:
+    paths = []
+    for source in SOURCES:
+        directory = os.path.join(root, source)
+        if os.path.isdir(directory):
+            paths.extend(os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                         if name.endswith('.dat') and os.path.isfile(os.path.join(directory, name)))
+    return paths
+
+
+def find_files(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def zip_members(path: str) -> Optional[List[Hashed]]:
+    """Return the crc and size of every member of a zip, from its central directory only"""
+    try:
+        with zipfile.ZipFile(path) as z:
+            return [(info.filename, info.file_size, '%08X' % info.CRC, None)
+                    for info in z.infolist() if not info.is_dir()]
+    except (zipfile.BadZipFile, OSError):
+        return None
+
+
+def hash_path(path: str) -> Result:
+    """Hash one file, or list the members of a zip"""
+    if path.lower().endswith('.zip'):
+        members = zip_members(path)
+        if members is not None:
+            return path, members, None, None
+    hashes = romhash.hash_file(path)
+    return path, None, hashes, hashes.error
+
+
+def has_header(path: str) -> bool:
+    """Tell whether <path> starts with one of the headers of romhash.HEADERS"""
+    with open(path, 'rb') as f:
+        return romhash.detect_header(f.read(HEADER_PROBE)) is not None
+
+
+def default_index_cache() -> str:
+    """Return the default index cache file, next to the hash cache"""
+    return os.path.join(os.path.dirname(hashcache.default_path()), 'romident.pickle')
+
+
+def build_index(root: str, executor=None) -> Index:
+    index = Index()
+    sources = find_sources(root)
+    # The biggest DATs first, so they do not end up last in the pool, but
+    # indexed in source order so matches list dat/ before metadat/
+    order = sorted(sources, key=lambda path: -os.path.getsize(path))
+    results = dict(zip(order, executor.map(index_file, order) if executor is not None else map(index_file, order)))
+    for path in sources:
+        index.add(results.pop(path)[1])
+    return index
+
+
+def load_index(root: str, path: Optional[str], executor=None) -> Index:
+    """Return the index of <root>, from the pickle at <path> if it is current"""
+    key = [INDEX_VERSION]
+    for source in find_sources(root):
+        st = os.stat(source)
+        key.append((os.path.relpath(source, root), st.st_size, st.st_mtime_ns))
+    if path is not None:
+        try:
+            with open(path, 'rb') as f:
+                cached_key, index = pickle.load(f)
+            if cached_key == key:
+                return index
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+    index = build_index(root, executor)
+    if path is not None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((key, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    return index
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Identify ROM files against dat/ and metadat/')
+    parser.add_argument('paths', nargs='+', help='files and directories to identify')
+    parser.add_argument('--root', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                        help='repository root holding dat/ and metadat/')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('--cache', default=hashcache.default_path(), help='hash cache (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='hash every file without reading or updating the cache')
+    parser.add_argument('--index-cache', default=default_index_cache(),
+                        help='pickled DAT index (default: %(default)s)')
+    parser.add_argument('--no-index-cache', action='store_true', help='index the DATs without reading or writing the pickle')
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    cache = None if args.no_cache else hashcache.HashCache(args.cache)
+    counts = {'matched': 0, 'unmatched': 0}
+    files = errors = read = 0
+    try:
+        index = load_index(os.path.abspath(args.root), None if args.no_index_cache else args.index_cache, executor)
+        print('%d ROMs of %d DATs indexed in %.2fs' % (index.roms, index.files, time.perf_counter() - began),
+              file=sys.stderr)
+
+        # Cached hashes are answered right away, only the rest goes to the pool
+        cached: List[Result] = []
+        todo: List[str] = []
+        for path in find_files(args.paths):
+            files += 1
+            hashes = None
+            # The cache has no headerless hashes, so files with a header are always hashed
+            if cache is not None and not path.lower().endswith('.zip'):
+                try:
+                    hashes = cache.lookup(path)
+                    if hashes is not None and has_header(path):
+                        hashes = None
+                except OSError:
+                    pass
+            if hashes is not None:
+                cached.append((path, None, romhash.FileHashes(path, romhash.Digests(*hashes), None, None), None))
+            else:
+                todo.append(path)
+        if executor is not None and len(todo) > 1:
+            hashed: Iterator = executor.map(hash_path, todo, chunksize=max(1, min(64, len(todo) // (args.jobs * 8))))
+        else:
+            hashed = map(hash_path, todo)
+
+        def results():
+            nonlocal read
+            yield from cached
+            for result in hashed:
+                path, members, hashes, error = result
+                if hashes is not None and error is None:
+                    read += hashes.raw.size
+                    if cache is not None and hashes.header is None:
+                        cache.store(path, os.stat(path), tuple(hashes.raw))
+                yield result
+
+        for path, members, hashes, error in results():
+            if error is not None:
+                print('%s: %s' % (path, error), file=sys.stderr)
+                errors += 1
+                continue
+            headerless = None
+            if members is None:
+                members = [(None, hashes.raw.size, hashes.raw.crc, hashes.raw.sha1)]
+                headerless = hashes.headerless
+            for member, size, crc, sha1 in members:
+                by, entries = index.match(size, crc, sha1)
+                stripped = False
+                if not entries and headerless is not None:
+                    by, entries = index.match(headerless.size, headerless.crc, headerless.sha1)
+                    stripped = bool(entries)
+                if not entries:
+                    by, entries = index.match_name(os.path.basename(member or path))
+                record = {'path': path}
+                if member is not None:
+                    record['member'] = member
+                record['size'] = size
+                record['crc'] = crc
+                if sha1 is not None:
+                    record['sha1'] = sha1
+                if headerless is not None:
+                    record['header'] = hashes.header
+                record['status'] = 'matched' if entries else 'unmatched'
+                if entries:
+                    record['by'] = by
+                    if stripped:
+                        record['headerless'] = True
+                    record['matches'] = [{'system': system, 'game': game, 'rom': rom} for system, game, rom, _ in entries]
+                counts[record['status']] += 1
+                print(json.dumps(record, ensure_ascii=False))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if cache is not None:
+            cache.close()
+
+    seconds = time.perf_counter() - began
+    print('%d files, %d matched, %d unmatched, %d errors in %.2fs, %.1f MB hashed%s' % (
+        files, counts['matched'], counts['unmatched'], errors, seconds, read / 1e6,
+        '' if cache is None else '; ' + cache.summary()), file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
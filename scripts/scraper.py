@@ -1,38 +1,309 @@
-from lxml import html
-import requests
+#!/usr/bin/env python3
+#cheat scraper for http://bsfree.shadowflareindustries.com/
+#writes one directory per system and code type, one .cht file per game
+#run the script with "python3 scraper.py [--base-url URL] [--output DIR] [SYSTEM...]"
+#
+#Pages are fetched by --connections threads sharing one keep-alive session,
+#at most --rate requests per second, with retries on connection errors and
+#5xx/429 answers. They are parsed by --jobs worker processes. Every parsed
+#listing and every written game goes to a journal (an SQLite file next to
+#the hash cache), so running it again after an interruption only fetches
+#what is missing; --restart forgets the journal of the output directory.
+#--record DIR keeps the fetched HTML, which scraperfixture.py can serve.
+import argparse
+import collections
+import json
 import os
-from chtwrite import cheatwriter
-#cheat scraper for http://bsfree.shadowflareindustries.com/ navigate to the system and codetype you want, copy url
-#run the script with "python scraper.py 'url'"
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import chtwrite
 
 
 baseurl = 'http://bsfree.org/'
 supported = "Gameboy", "Gameboy Advance", "Sega Game Gear", "Genesis", "Nintendo Entertainment System", "Sega Master System", "Playstation", "Super Nintendo", "Sega Saturn"
 
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pages (
+	output TEXT NOT NULL,
+	url TEXT NOT NULL,
+	result TEXT NOT NULL,
+	PRIMARY KEY (output, url)
+)
+'''
+
+#pages fetched and parsed ahead of the ones being handled, per connection
+QUEUE_DEPTH = 2
+
+
+def default_journal():
+	"""Return the default journal file, next to the hash cache"""
+	base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(base, 'libretro-database', 'scraper.sqlite')
+
+
+def page_file(url):
+	"""Return the file name a page is recorded as"""
+	return (urllib.parse.quote(url, safe='') or 'index') + '.html'
+
+
+class Journal:
+	"""The parsed listings and written games of the crawls into one output directory"""
+
+	def __init__(self, path, output):
+		directory = os.path.dirname(path)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		self.output = os.path.abspath(output)
+		self.unsaved = 0
+		self._db = sqlite3.connect(path)
+		self._db.execute('PRAGMA journal_mode=WAL')
+		self._db.execute('PRAGMA synchronous=NORMAL')
+		self._db.execute(SCHEMA)
+
+	def get(self, url):
+		row = self._db.execute('SELECT result FROM pages WHERE output = ? AND url = ?', (self.output, url)).fetchone()
+		return json.loads(row[0]) if row is not None else None
+
+	def put(self, url, result):
+		self._db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', (self.output, url, json.dumps(result)))
+		self.unsaved += 1
+		if self.unsaved >= 100:
+			self.commit()
+
+	def commit(self):
+		self._db.commit()
+		self.unsaved = 0
+
+	def clear(self):
+		self._db.execute('DELETE FROM pages WHERE output = ?', (self.output,))
+		self.commit()
+
+	def close(self):
+		if self._db is not None:
+			self.commit()
+			self._db.close()
+			self._db = None
+
+
+class RateLimiter:
+	"""Space out calls to wait() to at most <rate> per second, across threads"""
+
+	def __init__(self, rate=None):
+		self.interval = 1.0 / rate if rate else 0.0
+		self.next = 0.0
+		self._lock = threading.Lock()
+
+	def wait(self):
+		if not self.interval:
+			return
+		with self._lock:
+			now = time.monotonic()
+			at = max(now, self.next)
+			self.next = at + self.interval
+		if at > now:
+			time.sleep(at - now)
+
+
+def make_session(connections, retries):
+	"""Return a requests session keeping up to <connections> connections alive"""
+	import requests
+	from requests.adapters import HTTPAdapter
+	from urllib3.util.retry import Retry
+
+	session = requests.Session()
+	adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections,
+	                      max_retries=Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)))
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	return session
+
+
+class Crawler:
+	"""Scrape the code types of some systems into <outdir>"""
+
+	def __init__(self, baseurl, outdir, journal=None, connections=8, jobs=1, rate=None, retries=3,
+	             timeout=30, record=None, verbose=False):
+		self.baseurl = baseurl
+		self.outdir = outdir
+		self.journal = journal
+		self.connections = connections
+		self.jobs = jobs
+		self.timeout = timeout
+		self.record = record
+		self.verbose = verbose
+		self.limiter = RateLimiter(rate)
+		self.session = make_session(connections, retries)
+		self.counts = collections.Counter()
+
+	def fetch(self, url):
+		self.limiter.wait()
+		response = self.session.get(self.baseurl + url, timeout=self.timeout)
+		response.raise_for_status()
+		text = response.text
+		if self.record is not None:
+			with open(os.path.join(self.record, page_file(url)), 'w', encoding='utf-8') as f:
+				f.write(text)
+		return text
+
+	def _handle(self, task, result, tasks, fresh):
+		"""Act on the parsed page of <task>: queue the pages it links to, or write its game"""
+		kind, url, target = task
+		if fresh and kind != 'game' and self.journal is not None:
+			self.journal.put(url, result)
+		if kind == 'root':
+			sysurls = dict((name, href) for href, name in result)
+			for system in target:
+				if system not in sysurls:
+					print("system not found: " + system, file=sys.stderr)
+					self.counts['failed'] += 1
+					continue
+				tasks.append(('system', sysurls[system], os.path.join(self.outdir, system)))
+		elif kind == 'system':
+			for href, name in result:
+				tasks.append(('type', href, os.path.join(target, name)))
+		elif kind == 'type':
+			if not os.path.exists(target):
+				os.makedirs(target)
+				print("created: " + target)
+			taken = set()
+			for href, name in result:
+				# Games listed under the same file name are numbered in listing order
+				base = chtwrite.file_name(name)[:-4]
+				fname = base
+				n = 1
+				while fname.lower() in taken:
+					n += 1
+					fname = '%s (%d)' % (base, n)
+				taken.add(fname.lower())
+				tasks.append(('game', href, os.path.join(target, fname + '.cht')))
+		elif not fresh:
+			self.counts['resumed'] += 1
+		else:
+			if result:
+				try:
+					chtwrite.write(target, result)
+				except OSError as e:
+					# Left out of the journal, so the next run tries again
+					print("error writing %s: %s" % (target, e), file=sys.stderr)
+					self.counts['failed'] += 1
+					return
+				self.counts['written'] += 1
+				if self.verbose:
+					print("writing %s" % (target))
+			else:
+				self.counts['empty'] += 1
+			if self.journal is not None:
+				self.journal.put(url, len(result))
+
+	def run(self, systems=supported):
+		"""Crawl; returns a Counter of fetched pages and written, resumed, empty and failed games"""
+		tasks = collections.deque([('root', '', list(systems))])
+		fetching = {}
+		parsing = {}
+		fetcher = ThreadPoolExecutor(max_workers=self.connections)
+		parser = ProcessPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+		try:
+			while tasks or fetching or parsing:
+				while tasks and len(fetching) + len(parsing) < self.connections * QUEUE_DEPTH:
+					task = tasks.popleft()
+					result = self.journal.get(task[1]) if self.journal is not None else None
+					if result is not None:
+						self._handle(task, result, tasks, False)
+					else:
+						fetching[fetcher.submit(self.fetch, task[1])] = task
+				if not fetching and not parsing:
+					continue
+				done, _ = wait(list(fetching) + list(parsing), return_when=FIRST_COMPLETED)
+				for future in done:
+					if future in fetching:
+						task = fetching.pop(future)
+						try:
+							text = future.result()
+						except Exception as e:
+							# Left out of the journal, so the next run tries again
+							print("error fetching %s: %s" % (self.baseurl + task[1], e), file=sys.stderr)
+							self.counts['failed'] += 1
+							continue
+						self.counts['fetched'] += 1
+						parse = chtwrite.parse_codes if task[0] == 'game' else chtwrite.parse_listing
+						if parser is not None:
+							parsing[parser.submit(parse, text)] = task
+							continue
+						try:
+							result = parse(text)
+						except ValueError as e:
+							print("error parsing %s: %s" % (self.baseurl + task[1], e), file=sys.stderr)
+							self.counts['failed'] += 1
+							continue
+						self._handle(task, result, tasks, True)
+					else:
+						task = parsing.pop(future)
+						try:
+							result = future.result()
+						except Exception as e:
+							print("error parsing %s: %s" % (self.baseurl + task[1], e), file=sys.stderr)
+							self.counts['failed'] += 1
+							continue
+						self._handle(task, result, tasks, True)
+		finally:
+			fetcher.shutdown(cancel_futures=True)
+			if parser is not None:
+				parser.shutdown(cancel_futures=True)
+			if self.journal is not None:
+				self.journal.commit()
+			self.session.close()
+		return self.counts
 
-page = requests.get(baseurl)
-tree = html.fromstring(page.text)
 
-sysurl = tree.xpath('//td[@class="codedescalt"]//a/@href')
-system = tree.xpath('//td[@class="codedescalt"]/a[@href]/text()')
+def scrape(baseurl=baseurl, systems=supported, outdir='.', **options):
+	"""Scrape <systems> into <outdir>; see Crawler for the options"""
+	return Crawler(baseurl, outdir, **options).run(systems)
 
-supsys = [system.index(sup) for sup in supported]
 
-for idx3 in supsys:
-	page2 = requests.get(baseurl + sysurl[idx3])
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Scrape cheat codes into .cht files')
+	parser.add_argument('systems', nargs='*', default=list(supported),
+	                    help='systems to scrape (default: %s)' % ', '.join(supported))
+	parser.add_argument('--base-url', default=baseurl, help='site to scrape (default: %(default)s)')
+	parser.add_argument('--output', default='.', help='directory to write the systems to')
+	parser.add_argument('--connections', type=int, default=8, help='pages fetched at once (default: %(default)s)')
+	parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+	                    help='number of parser processes (default: all cores)')
+	parser.add_argument('--rate', type=float, help='at most this many requests per second')
+	parser.add_argument('--retries', type=int, default=3, help='retries of a failed request (default: %(default)s)')
+	parser.add_argument('--timeout', type=float, default=30, help='request timeout in seconds (default: %(default)s)')
+	parser.add_argument('--journal', default=default_journal(), help='crawl journal (default: %(default)s)')
+	parser.add_argument('--no-journal', action='store_true', help='fetch everything and keep no journal')
+	parser.add_argument('--restart', action='store_true', help='forget the journal of this output directory first')
+	parser.add_argument('--record', metavar='DIR', help='keep the fetched pages in DIR')
+	parser.add_argument('--verbose', '-v', action='store_true', help='print every file written')
+	args = parser.parse_args(argv)
 
-	tree2 = html.fromstring(page2.text)
+	if args.record:
+		os.makedirs(args.record, exist_ok=True)
+	journal = None if args.no_journal else Journal(args.journal, args.output)
+	began = time.perf_counter()
+	try:
+		if journal is not None and args.restart:
+			journal.clear()
+		counts = scrape(args.base_url, args.systems, args.output, journal=journal,
+		                connections=args.connections, jobs=args.jobs, rate=args.rate, retries=args.retries,
+		                timeout=args.timeout, record=args.record, verbose=args.verbose)
+	finally:
+		if journal is not None:
+			journal.close()
+	seconds = time.perf_counter() - began
+	print('%d pages fetched in %.2fs (%.1f pages/s), %d games written, %d resumed, %d without codes, %d failed' % (
+		counts['fetched'], seconds, counts['fetched'] / max(seconds, 1e-9), counts['written'],
+		counts['resumed'], counts['empty'], counts['failed']), file=sys.stderr)
+	return 1 if counts['failed'] else 0
 
-	cdtype = tree2.xpath('//td[@class="codedescalt"]//a/@href')
-	nmtype = tree2.xpath('//td[@class="codedescalt"]/a[@href]/text()')
-	outdir = system[idx3]
-	if not os.path.exists(outdir):
-		os.mkdir(outdir)
-	for idxnum, chttype in enumerate(cdtype):
-	
-		contentdir = outdir + "/" + nmtype[idxnum]
-		if not os.path.exists(contentdir):
-			os.mkdir(contentdir)
-			print "created: " + contentdir
-		cheatwriter( baseurl=baseurl, chttype=chttype, outdir=contentdir )
 
+if __name__ == '__main__':
+	sys.exit(main())
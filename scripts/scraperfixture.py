@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the cheat site scraper.py crawls.
+#
+#     scraperfixture.py [--port N] [--types N] [--games N] [--cheats N]
+#                       [--latency MS] [--pages DIR]
+#
+# Serves bsfree-style HTML over HTTP: a listing of the supported systems,
+# one of --types code types per system, one of --games games per code type
+# and a code page of up to --cheats cheats per game. The pages are generated
+# from a fixed seed, so every run serves the same site. With --pages, the
+# pages recorded by `scraper.py --record DIR` are served instead. --latency
+# delays every answer, to crawl it like a remote site.
+#
+#     scraperfixture.py --port 8000 &
+#     scraper.py --base-url http://127.0.0.1:8000/ --output /tmp/cheats
+#
+# serve() runs the server on a background thread for use from other tools;
+# see bench_scraper() in benchmark.py.
+
+import argparse
+import html
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import scraper
+
+
+PAGE = '<html><head><title>%s</title></head><body>\n<table>\n%s</table>\n</body></html>\n'
+
+
+def listing(title: str, entries) -> str:
+    rows = ''.join('<tr><td class="codedescalt"><a href="%s">%s</a></td></tr>\n' % (
+        html.escape(href), html.escape(name)) for href, name in entries)
+    return PAGE % (html.escape(title), rows)
+
+
+class Site:
+    """A generated cheat site; page() returns the HTML of a URL path"""
+
+    def __init__(self, types: int = 4, games: int = 50, cheats: int = 20, seed: int = 5):
+        self.types = types
+        self.games = games
+        self.cheats = cheats
+        self.seed = seed
+
+    @property
+    def pages(self) -> int:
+        """Number of pages a full crawl of the site fetches"""
+        systems = len(scraper.supported)
+        return 1 + systems + systems * self.types * (1 + self.games)
+
+    def page(self, url: str) -> Optional[str]:
+        path, _, query = url.lstrip('/').partition('?')
+        params = dict(urllib.parse.parse_qsl(query))
+        try:
+            if path == '':
+                return listing('Systems', (('system.php?system=%d' % i, name) for i, name in enumerate(scraper.supported)))
+            system = int(params['system'])
+            if not 0 <= system < len(scraper.supported):
+                return None
+            if path == 'system.php':
+                return listing(scraper.supported[system], (
+                    ('codetype.php?system=%d&type=%d' % (system, t), 'Code Type %d' % t) for t in range(self.types)))
+            codetype = int(params['type'])
+            if not 0 <= codetype < self.types:
+                return None
+            if path == 'codetype.php':
+                return listing('Code Type %d' % codetype, (
+                    ('codes.php?system=%d&type=%d&game=%d' % (system, codetype, g), "Game %d: Part %s" % (g, 'I' * (g % 4 + 1)))
+                    for g in range(self.games)))
+            game = int(params['game'])
+            if path != 'codes.php' or not 0 <= game < self.games:
+                return None
+        except (KeyError, ValueError):
+            return None
+
+        rng = random.Random('%d/%d/%d/%d' % (self.seed, system, codetype, game))
+        rows = []
+        for c in range(rng.randrange(self.cheats + 1)):
+            codes = ['%08X %04X' % (rng.getrandbits(32), rng.getrandbits(16)) for _ in range(rng.randrange(1, 4))]
+            rows.append('<tr><td class="codedesc">Cheat %d</td><td class="code">%s</td><td class="code">%s</td></tr>\n' % (
+                c, '<br>\n'.join(codes), 'Note'))
+        return PAGE % ('Game %d' % game, ''.join(rows))
+
+
+class RecordedSite:
+    """The pages of a `scraper.py --record` directory"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def page(self, url: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self.directory, scraper.page_file(url.lstrip('/'))), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+def serve(site, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0) -> ThreadingHTTPServer:
+    """Serve <site> from a background thread; the base URL is in the `url` attribute of the server"""
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep connections alive like a real server would
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            text = site.page(self.path)
+            if text is None:
+                self.send_error(404)
+                return
+            data = text.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.url = 'http://%s:%d/' % server.server_address[:2]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the cheat site scraper.py crawls')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--types', type=int, default=4, help='code types per system (default: %(default)s)')
+    parser.add_argument('--games', type=int, default=50, help='games per code type (default: %(default)s)')
+    parser.add_argument('--cheats', type=int, default=20, help='most cheats per game (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0, help='delay of every answer in milliseconds')
+    parser.add_argument('--pages', metavar='DIR', help='serve the pages recorded by scraper.py --record DIR')
+    args = parser.parse_args(argv)
+
+    site = RecordedSite(args.pages) if args.pages else Site(args.types, args.games, args.cheats)
+    server = serve(site, args.host, args.port, args.latency / 1000)
+    print('serving on %s' % server.url, file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Runs the scripts of this directory in-process.
+#
+#     tools.py TOOL [ARG...]
+#     tools.py --batch [FILE]
+#     tools.py --list
+#
+# Every tool is a module with a main(argv) that returns its exit status and
+# does nothing when imported; the ones whose file names are not valid module
+# names (clrmamepro-sorter.py, gba-cht-decrypt.py, mame-member.py) are loaded
+# by path. With --batch, the tool invocations are read from FILE (default:
+# stdin), one shell-quoted command line per line, and run one after the other
+# in this process, so each tool is imported once instead of once per run:
+#
+#     gba-cht-decrypt "cht/Nintendo - Game Boy Advance/Some Game (USA).cht"
+#     clrmamepro-sorter --check "metadat/genre/Sega - Mega Drive - Genesis.dat"
+#
+# The tool output goes to stdout and stderr as usual; after every command of
+# a batch a JSON line with its status and run time is written to stderr.
+# Blank lines and lines starting with # are skipped. The exit status is that
+# of the single tool, or 1 if any command of the batch failed.
+
+import argparse
+import importlib.util
+import json
+import os
+import shlex
+import sys
+import time
+
+from typing import Dict, List, Optional
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+# Tool name -> file
+TOOLS: Dict[str, str] = {os.path.splitext(name)[0]: name for name in (
+    'FBNeo_dat_gen.py',
+    'benchmark.py',
+    'cht64write.py',
+    'chtfile.py',
+    'chtpack.py',
+    'chtlint.py',
+    'clrmamepro-sorter.py',
+    'clrmamepro.py',
+    'datcheck.py',
+    'datdiff.py',
+    'gba-cht-decrypt.py',
+    'hashcache.py',
+    'libretrodb.py',
+    'mame-member.py',
+    'metadatjoin.py',
+    'rdbbuild.py',
+    'rdbindex.py',
+    'rdbquery.py',
+    'romhash.py',
+    'romident.py',
+    'scraper.py',
+    'scraperfixture.py',
+)}
+
+
+def load_script(filename: str):
+    """Import scripts/<filename>, which need not be a valid module name"""
+    name = os.path.splitext(filename)[0].replace('-', '_')
+    if name in sys.modules:
+        return sys.modules[name]
+    if SCRIPTS not in sys.path:
+        sys.path.insert(0, SCRIPTS)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(SCRIPTS, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
+
+
+def tool_name(tool: str) -> Optional[str]:
+    """Return the name of <tool>, given with or without .py, None if there is no such tool"""
+    if tool.endswith('.py'):
+        tool = tool[:-3]
+    return tool if tool in TOOLS else None
+
+
+def run(tool: str, argv: List[str]) -> int:
+    """Run <tool> with the arguments <argv>; returns its exit status"""
+    name = tool_name(tool)
+    if name is None:
+        raise ValueError('unknown tool: %s' % tool)
+    main = load_script(TOOLS[name]).main
+    # argparse takes the program name in usage messages from sys.argv
+    saved = sys.argv
+    sys.argv = [TOOLS[name]] + list(argv)
+    try:
+        status = main(list(argv))
+    except SystemExit as e:
+        # argparse errors, --help and the older tools exit instead of returning
+        if e.code is None or isinstance(e.code, int):
+            status = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            status = 1
+    finally:
+        sys.argv = saved
+        sys.stdout.flush()
+    return status or 0
+
+
+def batch(lines) -> int:
+    """Run every command line of <lines>; returns 1 if any of them failed"""
+    failed = 0
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        began = time.perf_counter()
+        try:
+            argv = shlex.split(line)
+        except ValueError as e:
+            argv = None
+            print('line %d: %s' % (number, e), file=sys.stderr)
+        if argv is None:
+            status = 1
+        elif tool_name(argv[0]) is None:
+            print('line %d: unknown tool: %s' % (number, argv[0]), file=sys.stderr)
+            status = 1
+        else:
+            try:
+                status = run(argv[0], argv[1:])
+            except Exception as e:
+                # One broken command should not take the rest of the batch down
+                print('line %d: %s: %s' % (number, type(e).__name__, e), file=sys.stderr)
+                status = 1
+        failed += status != 0
+        print(json.dumps({'line': number, 'command': line, 'status': status,
+                          'seconds': round(time.perf_counter() - began, 4)}), file=sys.stderr)
+        sys.stderr.flush()
+    return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    # Everything after the tool name belongs to the tool, so only look at the first argument
+    if argv and not argv[0].startswith('-'):
+        if tool_name(argv[0]) is None:
+            print('unknown tool: %s' % argv[0], file=sys.stderr)
+            return 2
+        return run(argv[0], argv[1:])
+
+    parser = argparse.ArgumentParser(description='Run the database and cheat tools in-process',
+                                     usage='%(prog)s TOOL [ARG...] | --batch [FILE] | --list')
+    parser.add_argument('--batch', nargs='?', const='-', metavar='FILE',
+                        help='run the command lines of FILE (default: stdin) one after the other')
+    parser.add_argument('--list', action='store_true', help='list the tools')
+    args = parser.parse_args(argv)
+    if args.list:
+        for tool in sorted(TOOLS, key=str.lower):
+            print(tool)
+        return 0
+    if args.batch is None:
+        parser.error('no tool given')
+    if args.batch == '-':
+        return batch(sys.stdin)
+    with open(args.batch) as f:
+        return batch(f)
+
+
+if __name__ == '__main__':
+    sys.exit(main())